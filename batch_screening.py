@@ -0,0 +1,220 @@
+"""Skrining batch tanpa UI: hasil satu angkatan dari CSV/JSONL sekaligus.
+
+Contoh:
+  python batch_screening.py kelas7.csv -o hasil_kelas7.jsonl --concurrency 16
+  python batch_screening.py data.jsonl -o hasil.jsonl --no-deliver
+
+Format masukan:
+  CSV   kolom biodata (id, nama, usia, kelas, jenis_kelamin, email, nohp; juga "Email Address", "Alamat email",
+        "No HP", "Nomor telepon", dst.); setiap kolom lain dianggap pertanyaan (judul kolom) dengan isian
+        sebagai jawaban – cocok dengan ekspor Google Forms.
+  JSONL {"id": ..., "nama": ..., "usia": ..., "qa_pairs": [["pertanyaan", "jawaban"], ...]}
+        (biodata boleh juga dikelompokkan dalam objek "bio").
+
+Hasil ditulis per baris ke file keluaran begitu satu siswa selesai (urutan selesai, bukan urutan masukan).
+File keluaran sekaligus checkpoint: menjalankan ulang perintah yang sama melewati siswa yang sudah `ok`
+dan mencoba lagi yang gagal. Email/SMS lewat outbox dengan kunci dedupe per siswa, jadi tidak terkirim dua kali.
+Konfigurasi (OPENAI_API_KEY, SENDGRID_*, TWILIO_*, FAWAI_CACHE_DIR, ...) sama dengan aplikasi Streamlit.
+"""
+from __future__ import annotations
+
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterable, Iterator, List, Set, Tuple
+
+BIO_FIELDS = ("nama", "usia", "kelas", "jenis_kelamin", "email", "nohp")
+IGNORED_COLUMNS = {"id", "timestamp", "cap waktu"}
+# Judul kolom kontak yang umum di Google Forms/Excel -> field biodata (bukan pasangan tanya-jawab)
+BIO_ALIASES = {
+    **dict.fromkeys(("email address", "alamat email", "e-mail", "alamat e-mail", "surel"), "email"),
+    **dict.fromkeys(("no hp", "no. hp", "nomor hp", "no hp/wa", "no. hp/wa", "nomor hp/wa", "hp", "no telepon",
+                     "no. telepon", "nomor telepon", "telepon", "phone", "phone number", "no wa", "no. wa",
+                     "nomor wa", "nomor whatsapp", "whatsapp"), "nohp"),
+}
+
+
+def _load_app() -> Any:
+    """Impor finalproject tanpa `streamlit run` (mode bare) dan senyapkan peringatannya."""
+    os.environ.setdefault("STREAMLIT_LOGGER_LEVEL", "error")
+    import finalproject
+    return finalproject
+
+
+def _record_id(raw: Dict[str, Any]) -> str:
+    rid = str(raw.get("id") or "").strip()
+    if rid:
+        return rid
+    # Tanpa kolom id: hash isi baris, stabil antar run sehingga resume tetap bekerja
+    return hashlib.sha1(json.dumps(raw, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()[:16]
+
+
+def _from_csv_row(row: Dict[str, str]) -> Dict[str, Any]:
+    bio: Dict[str, str] = {}
+    qa_pairs: List[Tuple[str, str]] = []
+    for col, val in row.items():
+        if col is None:
+            continue
+        key = " ".join(col.lower().split()).rstrip(" :*")
+        key = BIO_ALIASES.get(key, key)
+        val = (val or "").strip()
+        if key in BIO_FIELDS:
+            if val or key not in bio:  # beberapa kolom alias: yang kosong tidak menimpa yang terisi
+                bio[key] = val
+        elif key not in IGNORED_COLUMNS and val:
+            qa_pairs.append((col.strip(), val))
+    return {"id": _record_id(row), "bio": bio, "qa_pairs": qa_pairs}
+
+
+def _from_json(obj: Dict[str, Any]) -> Dict[str, Any]:
+    bio = dict(obj.get("bio") or {})
+    for key in BIO_FIELDS:
+        if key in obj:
+            bio[key] = obj[key]
+    qa_pairs = [(str(q), str(a)) for q, a in obj.get("qa_pairs") or [] if str(a).strip()]
+    return {"id": _record_id(obj), "bio": {k: str(v) for k, v in bio.items()}, "qa_pairs": qa_pairs}
+
+
+def read_records(path: str) -> Iterator[Dict[str, Any]]:
+    """Baca masukan secara streaming: dict {id, bio, qa_pairs} per siswa."""
+    if path.lower().endswith((".jsonl", ".ndjson", ".json")):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield _from_json(json.loads(line))
+        return
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:  # -sig: CSV dari Excel memakai BOM
+        for row in csv.DictReader(f):
+            yield _from_csv_row(row)
+
+
+def load_checkpoint(out_path: str) -> Set[str]:
+    """id siswa yang sudah berstatus ok di file keluaran."""
+    done: Set[str] = set()
+    try:
+        with open(out_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    continue  # baris terakhir terpotong saat proses mati
+                if item.get("status") == "ok":
+                    done.add(str(item.get("id")))
+    except FileNotFoundError:
+        pass
+    return done
+
+
+def _screen_one(app: Any, record: Dict[str, Any], deliver: bool, store: bool) -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    out: Dict[str, Any] = {"id": record["id"], "nama": record["bio"].get("nama", "")}
+    if not record["qa_pairs"]:
+        return dict(out, status="error", error="tidak ada jawaban anamnesis", duration_s=0.0)
+    try:
+        # Referensi dipilih per siswa (indeks pedoman lokal, atau cache sumber online)
+        result = app.screen_student(record["bio"], record["qa_pairs"], None,
+                                    session_id=f"batch-{record['id']}", deliver=deliver, store=store)
+    except Exception as e:
+        return dict(out, status="error", error=f"{type(e).__name__}: {e}"[:500],
+                    duration_s=round(time.perf_counter() - t0, 3))
+    return dict(out, status="ok", duration_s=round(time.perf_counter() - t0, 3), **result)
+
+
+def run_batch(records: Iterable[Dict[str, Any]], out_path: str, concurrency: int = 8, deliver: bool = True,
+              progress: Any = None, store: bool = True) -> Dict[str, Any]:
+    """Proses semua record dengan paling banyak `concurrency` siswa berjalan bersamaan.
+
+    Hasil di-append ke `out_path` (JSONL) begitu selesai; record yang sudah ok di sana dilewati.
+    Dengan `store`, hasil juga masuk arsip petugas UKS (RESULTS_DB).
+    """
+    app = _load_app()
+    done_ids = load_checkpoint(out_path)
+    counts = {"ok": 0, "error": 0, "skipped": 0}
+    queued: List[str] = []
+    concurrency = max(1, concurrency)
+    pending: Set[Future] = set()
+
+    with open(out_path, "a", encoding="utf-8") as out, \
+            ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="batch") as pool:
+
+        def drain(block: bool) -> None:
+            finished, _ = wait(pending, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                pending.discard(fut)
+                item = fut.result()
+                out.write(json.dumps(item, ensure_ascii=False) + "\n")
+                out.flush()  # checkpoint: tiap siswa selesai langsung tersimpan
+                counts[item["status"]] += 1
+                if "antre" in (item.get("delivery") or {}).values():
+                    queued.append(f"batch-{item['id']}")
+                if progress:
+                    progress(item)
+
+        for record in records:
+            if record["id"] in done_ids:
+                counts["skipped"] += 1
+                continue
+            done_ids.add(record["id"])  # id ganda di masukan hanya diproses sekali
+            # Antrean dibatasi agar file besar tidak dimuat seluruhnya ke memori
+            while len(pending) >= concurrency * 2:
+                drain(block=True)
+            pending.add(pool.submit(_screen_one, app, record, deliver, store))
+        while pending:
+            drain(block=True)
+    # Penulis arsip berjalan di thread daemon: pastikan batch terakhir tertulis
+    archived = app.flush_results() if store else True
+
+    return dict(counts, queued_sessions=queued, archived=archived)
+
+
+def wait_for_delivery(session_ids: List[str], timeout_s: float) -> Dict[str, int]:
+    """Tunggu outbox mengirim semua email/SMS batch ini (atau sampai timeout)."""
+    app = _load_app()
+    deadline = time.time() + timeout_s
+    while True:
+        statuses = [it["status"] for sid in session_ids for it in app.delivery_status(sid)]
+        open_jobs = sum(1 for s in statuses if s in ("pending", "sending"))
+        if not open_jobs or time.time() >= deadline:
+            return {s: statuses.count(s) for s in sorted(set(statuses))}
+        time.sleep(1.0)
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("input", help="file CSV atau JSONL")
+    ap.add_argument("-o", "--output", required=True, help="file JSONL hasil (sekaligus checkpoint)")
+    ap.add_argument("--concurrency", type=int, default=8, help="jumlah siswa yang diproses bersamaan")
+    ap.add_argument("--no-deliver", action="store_true", help="jangan kirim email/SMS")
+    ap.add_argument("--no-store", action="store_true", help="jangan simpan hasil ke arsip petugas UKS")
+    ap.add_argument("--delivery-timeout", type=float, default=300.0,
+                    help="lama menunggu outbox selesai (detik); job tersisa dikirim saat aplikasi/batch jalan lagi")
+    args = ap.parse_args()
+
+    t0 = time.perf_counter()
+
+    def progress(item: Dict[str, Any]) -> None:
+        label = "ok" if item["status"] == "ok" else f"GAGAL ({item['error']})"
+        print(f"{item['id']}: {label} [{item['duration_s']:.1f}s]", file=sys.stderr)
+
+    summary = run_batch(read_records(args.input), args.output, args.concurrency,
+                        deliver=not args.no_deliver, progress=progress, store=not args.no_store)
+    wall = time.perf_counter() - t0
+    print(f"selesai: ok={summary['ok']} gagal={summary['error']} dilewati={summary['skipped']} "
+          f"dalam {wall:.1f}s", file=sys.stderr)
+    if not summary["archived"]:
+        print("PERINGATAN: sebagian hasil tidak tersimpan di arsip petugas UKS (lihat trace results_dropped)",
+              file=sys.stderr)
+    if summary["queued_sessions"]:
+        print("menunggu pengiriman email/SMS...", file=sys.stderr)
+        sent = wait_for_delivery(summary["queued_sessions"], args.delivery_timeout)
+        print("pengiriman: " + ", ".join(f"{k}={v}" for k, v in sent.items()), file=sys.stderr)
+    sys.exit(1 if summary["error"] or not summary["archived"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Benchmark & load test end-to-end tanpa kredensial: biodata -> anamnesis -> analisis -> email/SMS.
+
+Aplikasi dijalankan headless lewat Streamlit AppTest, semua layanan eksternal diarahkan ke
+server tiruan lokal (bench/fakes.py) dengan latensi & tingkat error yang bisa diatur.
+
+Contoh:
+  python bench/bench_e2e.py --students 30 --concurrency 10 --llm-latency 0.8 --llm-error-rate 0.02
+  python bench/bench_e2e.py --students 5 --json bench_output.json
+
+Laporan: p50/p95/p99 per tahap & per giliran, throughput, error, dan memori puncak.
+
+Tiap siswa simulasi berjalan di proses worker terpisah (--concurrency proses): AppTest
+memakai Runtime Streamlit global sehingga tidak bisa dijalankan paralel dalam satu proses.
+Cache disk (riset, respons model) & outbox dipakai bersama lewat FAWAI_CACHE_DIR, seperti
+beberapa proses server di belakang load balancer. Memori dilaporkan per proses worker.
+"""
+from __future__ import annotations
+
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from e2e_worker import _worker_init, run_student  # noqa: E402
+from fake_redis import FakeRedis  # noqa: E402
+from fakes import FakeServices, ServiceProfile  # noqa: E402
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    vals = sorted(values)
+    k = max(0, min(len(vals) - 1, int(round(p / 100 * len(vals) + 0.5)) - 1))
+    return vals[k]
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--students", type=int, default=10)
+    ap.add_argument("--concurrency", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--timeout", type=float, default=120.0, help="batas waktu satu rerun AppTest (detik)")
+    ap.add_argument("--llm-latency", type=float, default=0.5)
+    ap.add_argument("--llm-jitter", type=float, default=0.2)
+    ap.add_argument("--llm-error-rate", type=float, default=0.0)
+    ap.add_argument("--research-latency", type=float, default=0.3)
+    ap.add_argument("--research-error-rate", type=float, default=0.0)
+    ap.add_argument("--email-latency", type=float, default=0.2)
+    ap.add_argument("--email-error-rate", type=float, default=0.0)
+    ap.add_argument("--sms-latency", type=float, default=0.2)
+    ap.add_argument("--sms-error-rate", type=float, default=0.0)
+    ap.add_argument("--no-stream", action="store_true", help="STREAM_OUTPUT=0")
+    ap.add_argument("--structured", action="store_true", help="ANALYSIS_FORMAT=json")
+    ap.add_argument("--session-backend", choices=("sqlite", "redis"), default="sqlite",
+                    help="SESSION_BACKEND; 'redis' memakai server Redis tiruan lokal (butuh paket redis)")
+    ap.add_argument("--no-delivery", action="store_true", help="jangan tunggu outbox email/SMS")
+    ap.add_argument("--delivery-timeout", type=float, default=60.0)
+    ap.add_argument("--tracemalloc", action="store_true", help="ukur puncak alokasi Python (lebih lambat)")
+    ap.add_argument("--json", help="tulis hasil mentah + ringkasan ke file JSON")
+    ap.add_argument("--keep-cache", action="store_true", help="jangan hapus direktori cache sementara")
+    args = ap.parse_args()
+
+    random.seed(args.seed)
+    fakes = FakeServices(
+        openai=ServiceProfile(args.llm_latency, args.llm_jitter, args.llm_error_rate),
+        sendgrid=ServiceProfile(args.email_latency, 0.0, args.email_error_rate),
+        twilio=ServiceProfile(args.sms_latency, 0.0, args.sms_error_rate),
+        research=ServiceProfile(args.research_latency, 0.0, args.research_error_rate),
+    )
+    base = fakes.start()
+    cache_dir = tempfile.mkdtemp(prefix="fawai-bench-")
+    fake_redis = FakeRedis() if args.session_backend == "redis" else None
+    os.environ.update({
+        "OPENAI_API_KEY": "sk-fake",
+        "OPENAI_BASE_URL": f"{base}/v1",
+        "SENDGRID_API_KEY": "SG.fake",
+        "SENDGRID_HOST": base,
+        "EMAIL_FROM": "bench@example.com",
+        "TWILIO_ACCOUNT_SID": "ACfake",
+        "TWILIO_AUTH_TOKEN": "fake",
+        "TWILIO_FROM": "+15550000000",
+        "TWILIO_API_BASE": base,
+        "RESEARCH_SOURCES": ",".join(f"{base}/research/{n}" for n in ("who", "cdc-dengue", "cdc-malaria", "idai", "kemkes")),
+        "FAWAI_CACHE_DIR": cache_dir,
+        "STREAM_OUTPUT": "0" if args.no_stream else "1",
+        "ANALYSIS_FORMAT": "json" if args.structured else "markdown",
+        "STREAMLIT_LOGGER_LEVEL": "error",
+        "SESSION_BACKEND": args.session_backend,
+    })
+    if fake_redis is not None:
+        os.environ["SESSION_REDIS_URL"] = fake_redis.start()
+
+    t_start = time.perf_counter()
+    results: List[Dict[str, object]] = []
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(max(1, args.concurrency), initializer=_worker_init, initargs=(args.tracemalloc,)) as pool:
+        job = functools.partial(run_student, args=args, cache_dir=cache_dir)
+        for res in pool.imap_unordered(job, range(args.students)):
+            results.append(res)
+            status = "ok" if res["ok"] else f"FAIL ({res['error']})"
+            print(f"[{len(results)}/{args.students}] {status}", file=sys.stderr)
+    wall = time.perf_counter() - t_start
+    rss_peak_mb = max(float(r["rss_mb"]) for r in results)
+    py_peaks = [float(r["py_peak_mb"]) for r in results if "py_peak_mb" in r]
+
+    merged: Dict[str, List[float]] = defaultdict(list)
+    for res in results:
+        for name, vals in res["stages"].items():  # type: ignore[union-attr]
+            merged[name].extend(vals)
+
+    summary = {
+        name: {
+            "n": len(vals),
+            "p50": percentile(vals, 50),
+            "p95": percentile(vals, 95),
+            "p99": percentile(vals, 99),
+            "max": max(vals),
+            "mean": statistics.fmean(vals),
+        }
+        for name, vals in sorted(merged.items()) if vals
+    }
+    ok = sum(1 for r in results if r["ok"])
+    svc_counts: Dict[str, Dict[str, int]] = defaultdict(lambda: {"requests": 0, "errors": 0})
+    for service, _t0, _t1, status in fakes.log:
+        svc_counts[service]["requests"] += 1
+        svc_counts[service]["errors"] += int(status >= 500)
+
+    print(f"\nstudents={args.students} concurrency={args.concurrency} ok={ok} failed={args.students - ok}")
+    print(f"wall={wall:.2f}s  throughput={ok / wall * 60:.1f} sesi/menit")
+    print(f"peak RSS per worker={rss_peak_mb:.1f} MB"
+          + (f"  peak Python heap per worker={max(py_peaks):.1f} MB" if py_peaks else ""))
+    print("\n" + f"{'stage':<34}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for name, row in summary.items():
+        print(f"{name:<34}{row['n']:>6}{row['p50'] * 1e3:>10.1f}{row['p95'] * 1e3:>10.1f}"
+              f"{row['p99'] * 1e3:>10.1f}{row['max'] * 1e3:>10.1f}")
+    print("\nfake services: " + ", ".join(f"{k}={v['requests']} req/{v['errors']} err" for k, v in sorted(svc_counts.items())))
+    errors = [r["error"] for r in results if r["error"]]
+    for err in sorted(set(errors)):  # type: ignore[arg-type]
+        print(f"error x{errors.count(err)}: {err}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({
+                "args": vars(args), "wall_s": wall, "ok": ok, "rss_peak_mb": rss_peak_mb,
+                "py_peak_mb": max(py_peaks) if py_peaks else None, "stages": summary, "services": svc_counts,
+                "errors": errors,
+            }, f, indent=2)
+
+    fakes.stop()
+    if fake_redis is not None:
+        fake_redis.stop()
+    if not args.keep_cache:
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""Benchmark parser seksi analisis: parser satu-lintasan vs regex lama.
+
+Jalankan:  python bench/bench_parsers.py [--max-kb 256]
+
+Ukuran input dilipatgandakan tiap baris; ns/karakter yang konstan berarti skala linear.
+Regex lama berhenti diukur setelah satu sampel melewati --legacy-cap detik.
+Sebelum mengukur, parser baru dicek terhadap REGRESSION_CASES (hasil yang diharapkan).
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import re
+import sys
+import time
+from typing import Callable, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")  # import app tanpa kredensial asli
+
+import finalproject as fp  # noqa: E402
+
+# ---------------------------------------------------------------
+# Implementasi lama (sebelum parser satu-lintasan), disalin apa adanya
+# ---------------------------------------------------------------
+_LEGACY_PATTERNS = [
+    ("Kemungkinan Diagnosis",
+     r"(?:^|\n)\s*(?:\*\*)?\s*(?:kemungkinan\s*diagnosis|diagnosis(?:\s*diferensial)?)"
+     r"\s*(?:\*\*)?\s*[:\-]?\s*\n(.*?)(?=\n\s*(?:\*\*)?\s*"
+     r"(?:rencana|saran|edukasi|pencegahan|kesimpulan|catatan)\b|$)"),
+    ("Rencana Tindak Lanjut & Saran",
+     r"(?:^|\n)\s*(?:\*\*)?\s*(?:rencana\s*tindak\s*lanjut(?:\s*&\s*saran)?|"
+     r"rencana\s*tatalaksana|saran)\s*(?:\*\*)?\s*[:\-]?\s*\n(.*?)(?=\n\s*(?:\*\*)?\s*"
+     r"(?:edukasi|pencegahan|kemungkinan|diagnosis|kesimpulan|catatan)\b|$)"),
+    ("Edukasi Pencegahan",
+     r"(?:^|\n)\s*(?:\*\*)?\s*(?:edukasi\s*pencegahan|pencegahan)\s*(?:\*\*)?\s*[:\-]?\s*\n"
+     r"(.*?)(?=\n\s*(?:\*\*)?\s*(?:rencana|saran|kemungkinan|diagnosis|kesimpulan|catatan)\b|$)"),
+]
+_LEGACY_DIAG_BLOCK = (
+    r"(?:^|\n)\s*\*\*?\s*(?:kemungkinan\s*diagnosis|diagnosis(?:\s*diferensial)?)\s*\*\*?\s*[:\-]?\s*\n"
+    r"(.*?)(?=\n\s*\*\*|\Z)"
+)
+
+def legacy_extract_selected_sections(full_text: str) -> str:
+    text = full_text.strip()
+    out_parts = []
+    for title, pat in _LEGACY_PATTERNS:
+        m = re.search(pat, text, flags=re.IGNORECASE | re.DOTALL)
+        if m and m.group(1).strip():
+            out_parts.append(f"{title}:\n{fp._clean_md(m.group(1)).strip()}")
+    if not out_parts:
+        return fp._clean_md(text)[:6000]
+    return "\n\n".join(out_parts).strip()[:8000]
+
+def legacy_extract_diagnoses(analysis_text: str) -> List[str]:
+    m = re.search(_LEGACY_DIAG_BLOCK, analysis_text, flags=re.IGNORECASE | re.DOTALL)
+    if not m:
+        return []
+    items = re.findall(r"(?:^\s*(?:[-•]|\d+\.)\s*)(.+)$", m.group(1), flags=re.MULTILINE)
+    return [re.sub(r"[:\-–].*$", "", re.sub(r"\s*\([^)]*\)", "", it)).strip() for it in items]
+
+def legacy(text: str) -> None:
+    legacy_extract_selected_sections(text)
+    legacy_extract_diagnoses(text)
+
+def current(text: str) -> None:
+    fp.parse_analysis_sections.clear()
+    fp.extract_selected_sections(text)
+    fp._extract_diagnoses_from_analysis(text)
+
+# ---------------------------------------------------------------
+# Generator input
+# ---------------------------------------------------------------
+def make_typical(n_chars: int) -> str:
+    block = (
+        "**Ringkasan Gejala**\nDemam 3 hari, batuk berdahak.\n\n"
+        "**Kemungkinan Diagnosis**\n- Common cold (alasan: pilek)\n- Bronkitis akut: batuk berdahak\n\n"
+        "**Rencana Tindak Lanjut & Saran**\n- Istirahat, minum cukup.\n\n"
+        "**Edukasi Pencegahan**\n- Cuci tangan.\n\n"
+    )
+    filler = "- Pantau suhu tubuh dan asupan cairan setiap hari.\n"
+    return block + filler * max(1, (n_chars - len(block)) // len(filler))
+
+def make_no_headings(n_chars: int) -> str:
+    unit = "kemungkinan diagnosis belum jelas karena data kurang lengkap, "
+    return (unit * max(1, n_chars // len(unit)))[:n_chars]
+
+def make_repeated_headings(n_chars: int) -> str:
+    unit = "Diagnosis\nisi tanpa seksi penutup\n"
+    return unit * max(1, n_chars // len(unit))
+
+def make_blank_lines(n_chars: int) -> str:
+    # Deretan baris kosong: `(?:^|\n)\s*(?:\*\*)?\s*` lama melakukan backtracking bertingkat di sini.
+    return "Ringkasan\n" + "\n" * n_chars + "**Kemungkinan Diagnosis**\n- Flu\n"
+
+# (nama, teks analisis, diagnosis yang diharapkan, potongan yang wajib ada di seksi rencana)
+# (nama, teks, diagnosis yang diharapkan, potongan wajib di seksi rencana, potongan wajib di ekstrak email)
+REGRESSION_CASES: List[tuple[str, str, List[str], List[str], List[str]]] = [
+    ("butir berlabel bukan heading",
+     "**Kemungkinan Diagnosis**\n- Influenza (alasan: demam tinggi mendadak)\n- Diagnosis banding: faringitis\n"
+     "- Common cold\n\n**Rencana Tindak Lanjut & Saran**\n- Saran: minum air putih 2 liter per hari.\n"
+     "- Kontrol: ke puskesmas bila demam lebih dari 3 hari.\n\n**Edukasi Pencegahan**\n- Cuci tangan.\n",
+     ["Influenza", "Diagnosis banding", "Common cold"],  # sama dengan regex lama
+     ["Saran: minum air putih", "Kontrol: ke puskesmas"], []),
+    ("heading polos & bernomor",
+     "Ringkasan Gejala:\nDemam 2 hari.\n\nKemungkinan Diagnosis:\n- Common cold\n\n"
+     "2. Rencana Tindak Lanjut\n- Istirahat.\n\n### Edukasi Pencegahan\n- Cuci tangan.\n",
+     ["Common cold"], ["Istirahat"], []),
+    ("blok red flag ikut ekstrak",
+     "**Kemungkinan Diagnosis**\n- Demam dengue (alasan: demam 3 hari, bintik merah)\n\n**Red Flag**\n"
+     "- Segera ke IGD bila muntah terus atau gusi berdarah.\n\n**Rencana Tindak Lanjut & Saran**\n"
+     "- Minum banyak cairan.\n\n**Edukasi Pencegahan**\n- 3M plus.\n",
+     ["Demam dengue"], ["Minum banyak cairan"],
+     ["Tanda Bahaya", "Segera ke IGD bila muntah terus", "Minum banyak cairan", "3M plus"]),
+    ("baris tebal di dalam seksi",
+     "**Kemungkinan Diagnosis**\n1. Common cold\n**Paling mungkin:** pilek ringan\n2. Faringitis\n\n"
+     "**Rencana Tindak Lanjut & Saran**\n**Penting**\n- Istirahat cukup.\n",
+     ["Common cold", "Faringitis"], ["Penting", "Istirahat cukup"], []),
+]
+
+def check_regressions() -> None:
+    for name, text, want, plan_parts, extract_parts in REGRESSION_CASES:
+        fp.parse_analysis_sections.clear()
+        got = fp._extract_diagnoses_from_analysis(text)
+        plan = fp._section_text(text, "rencana")
+        extract = fp.extract_selected_sections(text)
+        missing = [p for p in plan_parts if p not in plan] + [p for p in extract_parts if p not in extract]
+        status = "ok" if got == want and not missing else "GAGAL"
+        print(f"[{status}] {name}: diagnosis={got} (diharapkan {want})" + (f", hilang {missing}" if missing else ""))
+        if status != "ok":
+            sys.exit(1)
+
+CASES: List[tuple[str, Callable[[int], str], int]] = [
+    ("typical", make_typical, 8 * 1024),
+    ("no_headings", make_no_headings, 8 * 1024),
+    ("repeated_headings", make_repeated_headings, 8 * 1024),
+    ("blank_lines", make_blank_lines, 256),
+]
+
+def timeit(fn: Callable[[str], None], text: str, budget_s: float = 0.3, cap_s: float = 2.0) -> float:
+    best, spent, runs = float("inf"), 0.0, 0
+    while (spent < budget_s or runs < 3) and spent < cap_s:
+        t0 = time.perf_counter()
+        fn(text)
+        dt = time.perf_counter() - t0
+        best, spent, runs = min(best, dt), spent + dt, runs + 1
+    return best
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--max-kb", type=int, default=256, help="ukuran input terbesar (KB)")
+    ap.add_argument("--legacy-cap", type=float, default=2.0, help="detik; di atas ini regex lama tidak diukur lagi")
+    args = ap.parse_args()
+
+    check_regressions()
+    for name, make, start in CASES:
+        print(f"\n== {name} ==")
+        print(f"{'chars':>9} {'new ms':>9} {'new ns/ch':>10} {'old ms':>10} {'old ns/ch':>10}")
+        size, legacy_on = start, True
+        while size <= args.max_kb * 1024:
+            text = make(size)
+            new = timeit(current, text)
+            row = f"{len(text):>9} {new * 1e3:>9.2f} {new / len(text) * 1e9:>10.1f}"
+            if legacy_on:
+                old = timeit(legacy, text, cap_s=args.legacy_cap)
+                row += f" {old * 1e3:>10.2f} {old / len(text) * 1e9:>10.1f}"
+                legacy_on = old < args.legacy_cap
+            else:
+                row += f" {'(skip)':>10} {'':>10}"
+            print(row)
+            size *= 2
+
+if __name__ == "__main__":
+    main()
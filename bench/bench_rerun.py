@@ -0,0 +1,137 @@
+"""Ukur waktu rerun script Streamlit (tanpa jaringan) memakai AppTest.
+
+Jalankan:  python bench/bench_rerun.py [--script finalproject.py] [--runs 50] [--messages 20]
+
+Rerun pertama (cold) dilaporkan terpisah dari rerun berikutnya (warm), karena
+resource yang di-cache per proses hanya dibuat sekali.
+
+Dengan --messages N, sesi tahap chat berisi N pesan dimuat lewat ?sid= lalu diukur tiga bentuk run:
+rerun penuh (setiap jawaban sebelum chat dipindah ke fragmen), rerun fragmen yang menggambar ulang
+semua N pesan (jawaban saat ini, bila rerun penuh terakhir terjadi sebelum wawancara), dan rerun
+fragmen tanpa pesan lama (batas bawah bila hanya pesan baru yang digambar). Yang diukur di mode ini
+waktu eksekusi script di thread runner dengan bytecode yang di-cache seperti di server: AppTest
+meng-compile ulang script tiap run dan menunggu hasilnya dengan polling, dua-duanya menenggelamkan
+selisihnya.
+"""
+from __future__ import annotations
+
+import argparse
+import functools
+import os
+import statistics
+import sys
+import tempfile
+import time
+from typing import Callable, List
+
+from streamlit.runtime.scriptrunner.script_cache import ScriptCache
+from streamlit.testing.v1 import AppTest, local_script_runner
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_script_times: List[float] = []
+
+def _timed_run_script(run_script: Callable[..., None]) -> Callable[..., None]:
+    @functools.wraps(run_script)
+    def wrapper(self, rerun_data) -> None:
+        t0 = time.perf_counter()
+        try:
+            run_script(self, rerun_data)
+        finally:
+            _script_times.append(time.perf_counter() - t0)
+    return wrapper
+
+def _time_script_runs() -> None:
+    """Catat waktu eksekusi script per run; satu ScriptCache untuk semua run, seperti server Streamlit."""
+    shared = ScriptCache()
+    local_script_runner.ScriptCache = lambda: shared
+    runner = local_script_runner.LocalScriptRunner
+    runner._run_script = _timed_run_script(runner._run_script)
+
+def _measure(fn: Callable[[], None], runs: int) -> List[float]:
+    """Waktu eksekusi script per panggilan fn (tanpa overhead AppTest)."""
+    out = []
+    for _ in range(runs):
+        del _script_times[:]
+        fn()
+        out.append(sum(_script_times))
+    return sorted(out)
+
+def _report(label: str, samples: List[float]) -> None:
+    print(f"{label:<22}: p50 {statistics.median(samples) * 1e3:8.2f} ms   "
+          f"p95 {samples[int(0.95 * (len(samples) - 1))] * 1e3:8.2f} ms  (n={len(samples)})")
+
+def _seed_session(n: int) -> str:
+    """Simpan sesi tahap chat berisi n pesan (~500 karakter) di backend sesi; hasil = session_id."""
+    sys.path.insert(0, ROOT)
+    import finalproject as fp
+
+    sess = fp.SessionData(step="chat", bio={"nama": "Bench"}, max_questions=max(10, n))
+    for i in range(n):
+        role = fp.ROLE_ASSISTANT if i % 2 == 0 else fp.ROLE_USER
+        sess.add(role, f"Pesan {i}: " + "keluhan demam, batuk, dan pusing sejak kemarin. " * 10)
+    sess.commit()
+    return sess.session_id
+
+def _fragment_run(at: AppTest) -> None:
+    """Run seperti saat chat_input di dalam fragmen dikirim: hanya fragmen yang dijalankan."""
+    fids = list(at._fragment_storage._fragments)
+    orig = local_script_runner.RerunData
+    local_script_runner.RerunData = functools.partial(orig, fragment_id_queue=fids, is_fragment_scoped_rerun=True)
+    try:
+        at.run()
+    finally:
+        local_script_runner.RerunData = orig
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--script", default=os.path.join(ROOT, "finalproject.py"))
+    ap.add_argument("--runs", type=int, default=50)
+    ap.add_argument("--messages", type=int, default=0, help="ukur rerun chat dengan N pesan (0 = halaman awal)")
+    args = ap.parse_args()
+
+    os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+    if args.messages:
+        os.environ["FAWAI_CACHE_DIR"] = tempfile.mkdtemp(prefix="fawai-rerun-")
+    at = AppTest.from_file(os.path.abspath(args.script), default_timeout=60)
+    if args.messages:
+        at.query_params["sid"] = _seed_session(args.messages)
+    t0 = time.perf_counter()
+    at.run()
+    cold = time.perf_counter() - t0
+    if at.exception:
+        raise SystemExit(f"script error: {at.exception}")
+
+    print(f"script: {args.script}")
+    print(f"cold rerun : {cold * 1e3:8.2f} ms")
+    if not args.messages:
+        warm = []
+        for _ in range(args.runs):
+            t0 = time.perf_counter()
+            at.run()
+            warm.append(time.perf_counter() - t0)
+        warm.sort()
+        print(f"warm p50   : {statistics.median(warm) * 1e3:8.2f} ms")
+        print(f"warm p95   : {warm[int(0.95 * (len(warm) - 1))] * 1e3:8.2f} ms")
+        print(f"warm mean  : {statistics.fmean(warm) * 1e3:8.2f} ms  (n={len(warm)})")
+        return
+
+    if len(at.chat_message) != args.messages:
+        raise SystemExit(f"sesi tidak dilanjutkan: {len(at.chat_message)} pesan tampil, bukan {args.messages}")
+
+    def tail_all() -> None:
+        at.session_state["fawai_chat_head"] = 0  # rerun penuh terakhir sebelum pesan pertama
+        _fragment_run(at)
+
+    def tail_none() -> None:
+        at.session_state["fawai_chat_head"] = args.messages
+        _fragment_run(at)
+
+    _time_script_runs()
+    print(f"pesan      : {args.messages}")
+    _report("rerun penuh", _measure(at.run, args.runs))
+    _report("fragmen, semua pesan", _measure(tail_all, args.runs))
+    _report("fragmen, tanpa pesan", _measure(tail_none, args.runs))
+
+if __name__ == "__main__":
+    main()
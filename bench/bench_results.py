@@ -0,0 +1,92 @@
+"""Benchmark arsip hasil skrining: tulis satu tahun hasil, lalu ukur query petugas UKS.
+
+Jalankan:  python bench/bench_results.py [--students 1200 --weeks 52]
+
+Setiap minggu `--students` siswa diskrining (tersebar di kelas 7-9, 1-3 diagnosis per siswa).
+Penulisan memakai jalur yang sama dengan penulis background (batch RESULTS_BATCH_MAX per transaksi),
+lalu tiap query diulang dan dilaporkan p50/maks dalam milidetik.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import closing
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENAI_API_KEY", "sk-bench")  # import app tanpa kredensial asli
+_TMP = tempfile.mkdtemp(prefix="fawai-results-")
+os.environ["RESULTS_DB"] = os.path.join(_TMP, "results.sqlite3")
+
+import finalproject as fp  # noqa: E402
+
+DIAGNOSES = [
+    "Common cold", "Influenza", "Faringitis akut", "Demam dengue", "Demam tifoid", "Gastroenteritis akut",
+    "Dispepsia", "Migrain", "Tension headache", "Dismenore primer", "Asma", "Rinitis alergi",
+    "Konjungtivitis", "Skabies", "Tinea", "Varisela", "Keseleo", "Anemia defisiensi besi",
+]
+
+def make_rows(students: int, weeks: int, seed: int) -> List[Dict[str, object]]:
+    rng = random.Random(seed)
+    start = datetime.combine(date.today() - timedelta(weeks=weeks - 1), datetime.min.time()).timestamp()
+    rows = []
+    for i in range(students * weeks):
+        created = start + (i // students) * 7 * 86400 + rng.uniform(0, 5 * 86400)
+        rows.append({
+            "session_id": f"bench-{i}", "created_at": created, "kelas": rng.choice("789"),
+            "nama": f"Siswa {i}", "usia": str(rng.randint(12, 15)), "jenis_kelamin": rng.choice(["Laki-Laki", "Perempuan"]),
+            "source": "batch", "analysis": "**Ringkasan Gejala**\n" + "Keluhan siswa. " * 60,
+            "diagnoses": rng.sample(DIAGNOSES, rng.randint(1, 3)), "otc": "[]",
+        })
+    return rows
+
+def measure(fn: Callable[[], object], repeat: int) -> List[float]:
+    out = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        out.append((time.perf_counter() - t0) * 1e3)
+    return out
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--students", type=int, default=1200, help="siswa diskrining per minggu")
+    ap.add_argument("--weeks", type=int, default=52)
+    ap.add_argument("--repeat", type=int, default=50)
+    ap.add_argument("--seed", type=int, default=1)
+    args = ap.parse_args()
+
+    rows = make_rows(args.students, args.weeks, args.seed)
+    fp._results_ready()
+    t0 = time.perf_counter()
+    with closing(fp._results_conn()) as conn:
+        for i in range(0, len(rows), fp.RESULTS_BATCH_MAX):
+            fp._results_write_batch(conn, rows[i:i + fp.RESULTS_BATCH_MAX])
+    wall = time.perf_counter() - t0
+    size_mb = sum(os.path.getsize(os.path.join(_TMP, f)) for f in os.listdir(_TMP)) / 1e6
+    print(f"tulis {len(rows)} hasil: {wall:.2f}s ({len(rows) / wall:,.0f} hasil/detik), DB {size_mb:.1f} MB")
+
+    month_ago = (date.today() - timedelta(days=30)).isoformat()
+    queries = {
+        "rekap 8 minggu (semua kelas)": lambda: fp.diagnosis_summary(8),
+        "rekap 52 minggu kelas 8": lambda: fp.diagnosis_summary(52, "8"),
+        "hasil terbaru kelas 7": lambda: fp.find_results(kelas="7", limit=100),
+        "diagnosis 'demam dengue' 30 hari": lambda: fp.find_results(diagnosis="Demam dengue", day_from=month_ago),
+        "diagnosis + kelas, setahun": lambda: fp.find_results(kelas="9", diagnosis="Skabies", limit=200),
+        "daftar diagnosis": fp.known_diagnoses,
+    }
+    print(f"\n{'query':<36}{'p50 ms':>9}{'max ms':>9}")
+    for name, fn in queries.items():
+        times = measure(fn, args.repeat)
+        print(f"{name:<36}{statistics.median(times):>9.2f}{max(times):>9.2f}")
+    shutil.rmtree(_TMP, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""Cek perilaku konkurensi yang tidak terlihat di benchmark: antrean adil governor OpenAI, lease job
+outbox yang pemiliknya mati, dan compare-and-set state sesi di Redis (WATCH/MULTI/EXEC).
+
+Jalankan:  python bench/check_concurrency.py
+
+Layanan eksternal memakai server tiruan lokal (bench/fakes.py, bench/fake_redis.py); keluar dengan status 1 bila ada cek gagal.
+"""
+from __future__ import annotations
+
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from contextlib import closing
+from typing import Callable, List, Tuple
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from fake_redis import FakeRedis  # noqa: E402
+from fakes import FakeServices  # noqa: E402
+
+_FAKES = FakeServices()
+_BASE = _FAKES.start()
+os.environ.update({
+    "OPENAI_API_KEY": "sk-bench",
+    "OPENAI_BASE_URL": f"{_BASE}/v1",
+    "OPENAI_RPM": "120",           # 2 request/detik: antrean terbentuk setelah bucket dikuras
+    "OPENAI_HEDGE_MODEL": "",
+    "TWILIO_ACCOUNT_SID": "ACfake",
+    "TWILIO_AUTH_TOKEN": "fake",
+    "TWILIO_FROM": "+15550000000",
+    "TWILIO_API_BASE": _BASE,
+    "DELIVERY_LEASE_S": "2",       # job 'sending' yang tak diperbarui 2 detik dianggap milik proses mati
+    "DELIVERY_WORKERS": "1",
+    "FAWAI_CACHE_DIR": tempfile.mkdtemp(prefix="fawai-check-"),
+})
+
+import finalproject as fp  # noqa: E402
+
+# Stand-in ScriptRunContext: sesi UI disimpan per thread (atribut thread), bukan contextvar, jadi tidak
+# ikut ke thread pool, persis seperti di Streamlit
+_ui_thread = threading.local()
+fp._current_session_id = lambda: getattr(_ui_thread, "sid", None)
+
+def _start_queued(gov: fp.RateGovernor, jobs: List[Tuple[str, Callable[[], None]]]) -> List[threading.Thread]:
+    """Jalankan job satu per satu, masing-masing baru setelah job sebelumnya masuk antrean governor."""
+    threads = []
+    for sid, job in jobs:
+        depth = gov.snapshot()["queue_depth"]
+        t = threading.Thread(target=job, name=f"check-{sid}")
+        t.start()
+        threads.append(t)
+        while gov.snapshot()["queue_depth"] == depth:
+            time.sleep(0.005)
+    return threads
+
+def _drained(gov: fp.RateGovernor) -> None:
+    while gov.snapshot()["requests_available"] >= 1.0:
+        gov.acquire(0, time.monotonic() + 1.0)
+
+def check_governor_round_robin() -> List[str]:
+    """4 request sesi batch lalu 1 request siswa: siswa dilayani kedua, bukan menunggu batch habis."""
+    gov = fp.RateGovernor(rpm=120, tpm=1e9)
+    _drained(gov)
+    order: List[str] = []
+
+    def job(sid: str) -> Callable[[], None]:
+        def run() -> None:
+            gov.acquire(10, time.monotonic() + 30.0, sid)
+            order.append(sid)
+        return run
+
+    threads = _start_queued(gov, [("batch", job("batch"))] * 4 + [("siswa", job("siswa"))])
+    for t in threads:
+        t.join()
+    return [] if order[:2] == ["batch", "siswa"] else [f"urutan layanan {order}"]
+
+def check_llm_race_keeps_session_key() -> List[str]:
+    """Sama, tetapi lewat _llm_race dari thread 'skrip' tiap sesi: kunci antrean harus session_id siswa,
+    bukan '-' bersama karena sesi UI tidak terbawa ke thread pool."""
+    gov = fp.get_openai_governor()
+    _drained(gov)
+    keys: List[str] = []
+    acquire = gov.acquire
+
+    def recording_acquire(tokens: int, deadline: float, key: str = "-") -> float:
+        waited = acquire(tokens, deadline, key)
+        keys.append(key)
+        return waited
+
+    def job(sid: str) -> Callable[[], None]:
+        def run() -> None:
+            _ui_thread.sid = sid
+            fp._llm_race(dict(messages=[{"role": "user", "content": "demam"}]), {"est_prompt_tokens": 10},
+                         time.monotonic() + 30.0, hedge_after_s=60.0)
+        return run
+
+    gov.acquire = recording_acquire
+    try:
+        threads = _start_queued(gov, [("batch", job("batch"))] * 4 + [("siswa", job("siswa"))])
+        for t in threads:
+            t.join()
+    finally:
+        del gov.acquire
+    return [] if keys[:2] == ["batch", "siswa"] else [f"kunci antrean {keys}"]
+
+def _wait_for(cond: Callable[[], bool], timeout: float) -> bool:
+    end = time.monotonic() + timeout
+    while not cond():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.05)
+    return True
+
+def check_outbox_lease_reclaim() -> List[str]:
+    """Job 'sending' milik proses yang mati diambil alih setelah lease habis; job yang masih dalam
+    lease tidak disentuh sebelum waktunya, dan tidak ada SMS yang terkirim dua kali."""
+    fp._outbox_init()
+    now = time.time()
+    with closing(sqlite3.connect(fp._outbox_path())) as conn, conn:
+        for key, updated in (("hidup", now), ("mati", now - fp.DELIVERY_LEASE_S - 1)):
+            conn.execute(
+                "INSERT INTO outbox (dedupe_key, session_id, channel, payload, status, next_attempt_at, created_at,"
+                " updated_at) VALUES (?, ?, 'sms', ?, 'sending', 0, ?, ?)",
+                (key, key, json.dumps({"to": "+6281234567890", "body": key}), updated, updated),
+            )
+
+    def status() -> dict:
+        with closing(sqlite3.connect(fp._outbox_path())) as conn:
+            return dict(conn.execute("SELECT dedupe_key, status FROM outbox"))
+
+    def sent() -> List[str]:
+        return sorted(m["Body"] for m in _FAKES.sms)
+
+    problems = []
+    fp._get_delivery_wake()
+    if not _wait_for(lambda: status()["mati"] == "sent", 1.5):
+        problems.append(f"job lease habis tidak diambil alih: {status()}")
+    if time.time() - now < fp.DELIVERY_LEASE_S and status()["hidup"] != "sending":
+        problems.append(f"job dalam lease diambil alih: {status()}")
+    if not _wait_for(lambda: status()["hidup"] == "sent", fp.DELIVERY_LEASE_S + 3.0):
+        problems.append(f"job tidak diambil alih setelah lease habis: {status()}")
+    if sent() != ["hidup", "mati"]:
+        problems.append(f"SMS terkirim {sent()}")
+    return problems
+
+def check_session_watch_conflict() -> List[str]:
+    """Proses lain menyimpan sesi di antara WATCH dan EXEC: simpanan ini ditolak (SessionConflict lewat
+    WatchError, bukan cek versi di awal), state terbaru dimuat, dan simpan ulang sesudahnya berhasil."""
+    server = FakeRedis()
+    url = server.start()
+    backend = fp.RedisSessionBackend(url, 60)
+    rival = fp.RedisSessionBackend(url, 60)  # koneksi "proses lain"
+    get_backend = fp.get_session_backend
+    fp.get_session_backend = lambda: backend
+    problems: List[str] = []
+    try:
+        sess = fp.SessionData(step="chat")
+        sess.add(fp.ROLE_ASSISTANT, "Apa keluhanmu?")
+        sess.commit()
+        other = fp.SessionData(session_id=sess.session_id)
+        other.reload()
+        other.add(fp.ROLE_USER, "jawaban dari proses lain")
+        raced: List[bool] = []
+        pipeline = backend._redis.pipeline
+
+        def racing_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            multi = pipe.multi
+
+            def multi_after_rival() -> None:
+                if not raced:
+                    rival.save(sess.session_id, other.to_payload(), other.version)
+                    raced.append(True)
+                multi()
+            pipe.multi = multi_after_rival
+            return pipe
+
+        backend._redis.pipeline = racing_pipeline
+        sess.add(fp.ROLE_USER, "jawaban dari tab ini")
+        if fp.commit_session(sess) or not raced:
+            problems.append(f"simpanan yang kalah tidak ditolak (raced={raced})")
+        if sess.version != 2 or sess.texts[-1] != "jawaban dari proses lain":
+            problems.append(f"state terbaru tidak dimuat: v{sess.version} {sess.texts}")
+        sess.add(fp.ROLE_ASSISTANT, "Sejak kapan?")
+        if not fp.commit_session(sess):
+            problems.append("simpan ulang setelah konflik ditolak")
+        stored = backend.load(sess.session_id)
+        texts = json.loads(stored[1])["texts"] if stored else None
+        if stored is None or stored[0] != 3 or texts != ["Apa keluhanmu?", "jawaban dari proses lain", "Sejak kapan?"]:
+            problems.append(f"state tersimpan {stored and (stored[0], texts)}")
+    finally:
+        fp.get_session_backend = get_backend
+        server.stop()
+    return problems
+
+CHECKS = [check_governor_round_robin, check_llm_race_keeps_session_key, check_outbox_lease_reclaim,
+          check_session_watch_conflict]
+
+def main() -> None:
+    failed = 0
+    for check in CHECKS:
+        t0 = time.perf_counter()
+        problems = check()
+        status = "OK" if not problems else "GAGAL"
+        print(f"{status:<5} {check.__name__:<36} {time.perf_counter() - t0:6.2f}s  {'; '.join(problems)}")
+        failed += bool(problems)
+    _FAKES.stop()
+    if failed:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Worker benchmark end-to-end: satu siswa simulasi per panggilan `run_student`.
+
+Dipisah dari bench_e2e.py karena AppTest mengganti modul `__main__` di proses worker,
+sehingga fungsi yang dikirim ke Pool harus berada di modul yang bisa di-import ulang.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import resource
+import sqlite3
+import time
+import tracemalloc
+from collections import defaultdict
+from typing import Dict, List
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP = os.path.join(ROOT, "finalproject.py")
+
+FIRST_ANSWERS = ["demam", "batuk pilek", "sakit kepala", "sakit perut dan diare", "gatal dan ruam di tangan"]
+FOLLOW_UPS = [
+    "sudah 3 hari", "38,5 derajat", "batuk berdahak", "tidak ada mual", "tidak ada bintik merah",
+    "adik saya juga flu", "tidur kurang nyenyak", "makan berkurang", "tidak sesak", "belum minum obat",
+]
+
+
+def wait_delivery(cache_dir: str, session_id: str, timeout_s: float) -> List[sqlite3.Row]:
+    """Tunggu job outbox sesi ini selesai (sent/failed) dan kembalikan barisnya."""
+    path = os.path.join(cache_dir, "outbox.sqlite3")
+    deadline = time.time() + timeout_s
+    rows: List[sqlite3.Row] = []
+    while time.time() < deadline:
+        if os.path.exists(path):
+            conn = sqlite3.connect(path, timeout=5)
+            conn.row_factory = sqlite3.Row
+            try:
+                rows = conn.execute(
+                    "SELECT channel, status, attempts, created_at, updated_at FROM outbox WHERE session_id=?",
+                    (session_id,),
+                ).fetchall()
+            except sqlite3.Error:
+                rows = []
+            finally:
+                conn.close()
+            if rows and all(r["status"] in ("sent", "failed") for r in rows):
+                return rows
+        time.sleep(0.05)
+    return rows
+
+
+def run_student(idx: int, args: argparse.Namespace, cache_dir: str) -> Dict[str, object]:
+    """Satu siswa simulasi, dijalankan di proses worker (AppTest tidak thread-safe)."""
+    from streamlit.testing.v1 import AppTest
+
+    rng = random.Random(args.seed + idx)
+    stages: Dict[str, List[float]] = defaultdict(list)
+    result: Dict[str, object] = {"ok": False, "stages": stages, "error": None}
+
+    def timed(name: str, fn) -> None:
+        t0 = time.perf_counter()
+        fn()
+        stages[name].append(time.perf_counter() - t0)
+
+    try:
+        at = AppTest.from_file(APP, default_timeout=args.timeout)
+        timed("page_load", at.run)
+        at.text_input[0].input(f"Siswa {idx}")
+        at.text_input[1].input(f"siswa{idx}@sekolah.sch.id")
+        at.text_input[2].input(f"0812{idx:08d}")
+        timed("bio_submit", lambda: at.button[0].click().run())
+
+        turn = 0
+        while at.session_state["fawai"].step == "chat" and turn < 30:
+            answer = rng.choice(FIRST_ANSWERS) if turn == 0 else rng.choice(FOLLOW_UPS)
+            t0 = time.perf_counter()
+            at.chat_input[0].set_value(answer).run()
+            dt = time.perf_counter() - t0
+            if at.exception:
+                raise RuntimeError(str(at.exception[0].message))
+            turn += 1
+            final = at.session_state["fawai"].step == "done"
+            stages["final_turn" if final else "turn"].append(dt)
+            stages[f"turn_{turn:02d}"].append(dt)
+        result["turns"] = turn
+
+        for call in at.session_state["fawai"].llm_calls:
+            helper = call.get("helper", "llm")
+            stages[f"llm:{helper}"].append(float(call.get("total_s", 0.0)))
+            if "ttft_s" in call:
+                stages[f"llm:{helper}:ttft"].append(float(call["ttft_s"]))
+
+        if not args.no_delivery:
+            for row in wait_delivery(cache_dir, at.session_state["fawai"].session_id, args.delivery_timeout):
+                stages[f"delivery:{row['channel']}"].append(row["updated_at"] - row["created_at"])
+                if row["status"] != "sent":
+                    result.setdefault("delivery_failed", []).append(row["channel"])
+        result["ok"] = at.session_state["fawai"].step == "done"
+    except Exception as e:  # satu siswa gagal tidak menghentikan benchmark
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["stages"] = dict(stages)
+    result["rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    if tracemalloc.is_tracing():
+        result["py_peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+    return result
+
+
+def _worker_init(trace: bool) -> None:
+    if trace:
+        tracemalloc.start()
@@ -0,0 +1,169 @@
+"""Server Redis tiruan lokal (protokol RESP2/RESP3) untuk menguji SESSION_BACKEND=redis tanpa Redis asli.
+
+Hanya perintah yang dipakai backend sesi & klien redis-py: HELLO (RESP2/RESP3), PING, CLIENT, SELECT,
+HGET, HGETALL, HSET, EXPIRE, DEL, WATCH/UNWATCH/MULTI/EXEC/DISCARD (transaksi optimistis), DBSIZE, FLUSHALL.
+Semua data di memori satu proses; cukup untuk beberapa proses worker benchmark sekaligus.
+"""
+from __future__ import annotations
+
+import socketserver
+import threading
+import time
+from typing import Dict, List, Tuple
+
+Reply = object  # bytes (bulk) | str (simple) | int | None | list | dict | Exception
+
+
+class FakeRedis:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._data: Dict[bytes, Dict[bytes, bytes]] = {}
+        self._expire_at: Dict[bytes, float] = {}
+        self._revision: Dict[bytes, int] = {}   # naik setiap key diubah: dasar WATCH
+        self._server: socketserver.ThreadingTCPServer | None = None
+
+    # -----------------------------------------------------------
+    def start(self) -> str:
+        store = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                watched: Dict[bytes, int] = {}
+                queued: List[List[bytes]] | None = None
+                resp3 = False
+                while True:
+                    try:
+                        cmd = _read_command(self.rfile)
+                    except (ConnectionError, ValueError):
+                        return
+                    if cmd is None:
+                        return
+                    name = cmd[0].upper()
+                    if name == b"HELLO":
+                        resp3 = len(cmd) > 1 and cmd[1] == b"3"
+                        reply = {b"server": b"redis", b"version": b"7.2.0", b"proto": 3 if resp3 else 2}
+                    elif name == b"MULTI":
+                        queued, reply = [], "OK"
+                    elif name == b"EXEC":
+                        reply = store._exec(queued or [], watched)
+                        queued = None
+                        watched = {}
+                    elif name == b"DISCARD":
+                        queued, watched, reply = None, {}, "OK"
+                    elif name == b"WATCH":
+                        with store._lock:
+                            watched.update({k: store._revision.get(k, 0) for k in cmd[1:]})
+                        reply = "OK"
+                    elif name == b"UNWATCH":
+                        watched, reply = {}, "OK"
+                    elif queued is not None:
+                        queued.append(cmd)
+                        reply = "QUEUED"
+                    else:
+                        with store._lock:
+                            reply = store._apply(cmd)
+                    self.wfile.write(_encode(reply, resp3))
+                    self.wfile.flush()
+
+        class Server(socketserver.ThreadingTCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self._server = Server(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, name="fake-redis", daemon=True).start()
+        return f"redis://127.0.0.1:{self._server.server_address[1]}/0"
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    # -----------------------------------------------------------
+    def _exec(self, queued: List[List[bytes]], watched: Dict[bytes, int]) -> Reply:
+        with self._lock:
+            if any(self._revision.get(k, 0) != rev for k, rev in watched.items()):
+                return None  # key yang di-WATCH berubah: transaksi dibatalkan (klien -> WatchError)
+            return [self._apply(cmd) for cmd in queued]
+
+    def _live(self, key: bytes) -> Dict[bytes, bytes] | None:
+        exp = self._expire_at.get(key)
+        if exp is not None and exp <= time.time():
+            self._data.pop(key, None)
+            self._expire_at.pop(key, None)
+            self._touch(key)
+        return self._data.get(key)
+
+    def _touch(self, key: bytes) -> None:
+        self._revision[key] = self._revision.get(key, 0) + 1
+
+    def _apply(self, cmd: List[bytes]) -> Reply:
+        name, args = cmd[0].upper(), cmd[1:]
+        if name == b"PING":
+            return "PONG"
+        if name in (b"CLIENT", b"SELECT"):
+            return "OK"
+        if name == b"HGET":
+            return (self._live(args[0]) or {}).get(args[1])
+        if name == b"HGETALL":
+            return dict(self._live(args[0]) or {})
+        if name == b"HSET":
+            h = self._data.setdefault(args[0], self._live(args[0]) or {})
+            added = sum(1 for f in args[1::2] if f not in h)
+            h.update(zip(args[1::2], args[2::2]))
+            self._touch(args[0])
+            return added
+        if name == b"EXPIRE":
+            if self._live(args[0]) is None:
+                return 0
+            self._expire_at[args[0]] = time.time() + int(args[1])
+            return 1
+        if name == b"DEL":
+            n = 0
+            for key in args:
+                if self._live(key) is not None:
+                    del self._data[key]
+                    self._expire_at.pop(key, None)
+                    self._touch(key)
+                    n += 1
+            return n
+        if name == b"DBSIZE":
+            return sum(1 for k in list(self._data) if self._live(k) is not None)
+        if name == b"FLUSHALL":
+            for key in list(self._data):
+                self._touch(key)
+            self._data.clear()
+            self._expire_at.clear()
+            return "OK"
+        return ValueError(f"ERR unknown command '{name.decode(errors='replace')}'")
+
+
+def _read_command(rfile) -> List[bytes] | None:
+    line = rfile.readline()
+    if not line:
+        return None
+    if not line.startswith(b"*"):
+        return line.split()  # inline command (mis. dari telnet)
+    args = []
+    for _ in range(int(line[1:])):
+        size = int(rfile.readline()[1:])
+        args.append(rfile.read(size + 2)[:-2])
+    return args
+
+
+def _encode(reply: Reply, resp3: bool = False) -> bytes:
+    if reply is None:
+        return b"_\r\n" if resp3 else b"$-1\r\n"
+    if isinstance(reply, Exception):
+        return f"-{reply}\r\n".encode()
+    if isinstance(reply, str):
+        return f"+{reply}\r\n".encode()
+    if isinstance(reply, bool) or isinstance(reply, int):
+        return f":{int(reply)}\r\n".encode()
+    if isinstance(reply, bytes):
+        return b"$%d\r\n%s\r\n" % (len(reply), reply)
+    if isinstance(reply, dict):
+        if resp3:
+            return b"%%%d\r\n" % len(reply) + b"".join(_encode(k, resp3) + _encode(v, resp3) for k, v in reply.items())
+        reply = [x for kv in reply.items() for x in kv]  # RESP2: map dikirim sebagai array datar
+    items: Tuple[Reply, ...] = tuple(reply)  # type: ignore[arg-type]
+    return b"*%d\r\n" % len(items) + b"".join(_encode(x, resp3) for x in items)
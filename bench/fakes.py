@@ -0,0 +1,229 @@
+"""Server tiruan lokal untuk OpenAI, SendGrid, Twilio & sumber riset (tanpa kredensial/jaringan).
+
+Satu ThreadingHTTPServer melayani semua layanan berdasarkan path:
+  POST /v1/chat/completions                         -> OpenAI (stream & non-stream)
+  POST /v3/mail/send                                -> SendGrid
+  POST /2010-04-01/Accounts/<sid>/Messages.json     -> Twilio
+  GET  /research/<nama>                             -> halaman riset
+
+Latensi & tingkat error tiap layanan bisa diatur lewat `ServiceProfile`.
+"""
+from __future__ import annotations
+
+import json
+import random
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+FAKE_QUESTIONS = [
+    "Sejak kapan keluhan ini mulai dirasakan?",
+    "Apakah ada demam, dan berapa suhu tertinggi yang terukur?",
+    "Apakah ada batuk, dan apakah berdahak atau kering?",
+    "Apakah ada mual, muntah, atau diare?",
+    "Apakah ada bintik merah di kulit atau mimisan?",
+    "Apakah ada teman sekelas atau keluarga dengan keluhan serupa?",
+]
+
+FAKE_ANALYSIS = """**Ringkasan Gejala**
+Demam 3 hari disertai batuk berdahak dan pilek, tanpa tanda perdarahan.
+
+**Kemungkinan Diagnosis**
+- Common cold (alasan: pilek dan batuk ringan)
+- Bronkitis akut: batuk berdahak
+- Demam dengue (perlu dipantau bila demam berlanjut)
+
+**Rencana Tindak Lanjut & Saran**
+- Istirahat cukup dan minum air putih minimal 2 liter per hari.
+- Periksa ke puskesmas bila demam lebih dari 3 hari.
+
+**Edukasi Pencegahan**
+- Cuci tangan dengan sabun dan gunakan masker saat batuk.
+- Lakukan 3M plus untuk mencegah gigitan nyamuk.
+"""
+
+FAKE_ANALYSIS_JSON = json.dumps({
+    "summary": "Demam 3 hari disertai batuk berdahak dan pilek, tanpa tanda perdarahan.",
+    "diagnoses": [
+        {"name": "Common cold", "reason": "pilek dan batuk ringan"},
+        {"name": "Bronkitis akut", "reason": "batuk berdahak"},
+        {"name": "Demam dengue", "reason": "perlu dipantau bila demam berlanjut"},
+    ],
+    "plan": ["Istirahat cukup dan minum air putih minimal 2 liter per hari.",
+             "Periksa ke puskesmas bila demam lebih dari 3 hari."],
+    "prevention": ["Cuci tangan dengan sabun dan gunakan masker saat batuk.",
+                   "Lakukan 3M plus untuk mencegah gigitan nyamuk."],
+    "red_flags": [],
+}, ensure_ascii=False)
+
+
+@dataclass
+class ServiceProfile:
+    latency_s: float = 0.0      # rata-rata latensi respons
+    jitter_s: float = 0.0       # +/- acak di sekitar rata-rata
+    error_rate: float = 0.0     # peluang respons 500/503
+
+    def delay(self) -> float:
+        return max(0.0, self.latency_s + random.uniform(-self.jitter_s, self.jitter_s))
+
+    def should_fail(self) -> bool:
+        return random.random() < self.error_rate
+
+
+@dataclass
+class FakeServices:
+    openai: ServiceProfile = field(default_factory=ServiceProfile)
+    sendgrid: ServiceProfile = field(default_factory=ServiceProfile)
+    twilio: ServiceProfile = field(default_factory=ServiceProfile)
+    research: ServiceProfile = field(default_factory=ServiceProfile)
+    ttft_fraction: float = 0.3  # porsi latensi OpenAI sebelum token pertama (mode stream)
+    # Log permintaan: (layanan, waktu diterima, waktu selesai, status)
+    log: List[tuple] = field(default_factory=list)
+    emails: List[Dict[str, object]] = field(default_factory=list)
+    sms: List[Dict[str, str]] = field(default_factory=list)
+
+    def __post_init__(self) -> None:
+        self._lock = threading.Lock()
+        self._server: ThreadingHTTPServer | None = None
+
+    # -----------------------------------------------------------
+    def start(self) -> str:
+        services = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args) -> None:  # sunyi
+                pass
+
+            def _send(self, code: int, body: bytes, ctype: str = "application/json") -> None:
+                self.send_response(code)
+                self.send_header("Content-Type", ctype)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _body(self) -> bytes:
+                n = int(self.headers.get("Content-Length") or 0)
+                return self.rfile.read(n) if n else b""
+
+            def do_GET(self) -> None:
+                t0 = time.time()
+                if not self.path.startswith("/research/"):
+                    return self._send(404, b"{}")
+                prof = services.research
+                time.sleep(prof.delay())
+                if prof.should_fail():
+                    services._log("research", t0, 503)
+                    return self._send(503, b"unavailable", "text/plain")
+                page = f"<html><head><title>{self.path}</title></head><body>Panduan {self.path}</body></html>"
+                services._log("research", t0, 200)
+                self._send(200, page.encode("utf-8"), "text/html")
+
+            def do_POST(self) -> None:
+                t0 = time.time()
+                raw = self._body()
+                if self.path.endswith("/chat/completions"):
+                    return services._openai(self, json.loads(raw or b"{}"), t0)
+                if self.path == "/v3/mail/send":
+                    prof = services.sendgrid
+                    time.sleep(prof.delay())
+                    if prof.should_fail():
+                        services._log("sendgrid", t0, 503)
+                        return self._send(503, b'{"errors":[{"message":"fake outage"}]}')
+                    with services._lock:
+                        services.emails.append(json.loads(raw or b"{}"))
+                    services._log("sendgrid", t0, 202)
+                    return self._send(202, b"")
+                if self.path.endswith("/Messages.json"):
+                    prof = services.twilio
+                    time.sleep(prof.delay())
+                    if prof.should_fail():
+                        services._log("twilio", t0, 503)
+                        return self._send(503, b'{"code":20503,"message":"fake outage","status":503}')
+                    from urllib.parse import parse_qs
+                    form = {k: v[0] for k, v in parse_qs(raw.decode("utf-8")).items()}
+                    sid = f"SM{random.getrandbits(64):016x}"
+                    with services._lock:
+                        services.sms.append(form)
+                    services._log("twilio", t0, 201)
+                    body = {"sid": sid, "status": "queued", "to": form.get("To"), "from": form.get("From"),
+                            "body": form.get("Body")}
+                    return self._send(201, json.dumps(body).encode("utf-8"))
+                self._send(404, b"{}")
+
+        class Server(ThreadingHTTPServer):
+            daemon_threads = True
+
+            def handle_error(self, request, client_address) -> None:
+                pass  # klien menutup koneksi lebih dulu (mis. worker benchmark selesai) – abaikan
+
+        self._server = Server(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self._server.serve_forever, name="fake-services", daemon=True).start()
+        return f"http://127.0.0.1:{self._server.server_port}"
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    # -----------------------------------------------------------
+    def _log(self, service: str, t0: float, status: int) -> None:
+        with self._lock:
+            self.log.append((service, t0, time.time(), status))
+
+    def completion_text(self, body: Dict[str, object]) -> str:
+        """Respons tiruan berdasarkan prompt sistem (pertanyaan vs analisis) & response_format."""
+        messages = body.get("messages") or [{}]
+        system = str(messages[0].get("content", ""))
+        if "diagnosis diferensial" in system:
+            fmt = body.get("response_format") or {}
+            return FAKE_ANALYSIS_JSON if fmt.get("type") == "json_schema" else FAKE_ANALYSIS
+        question = random.choice(FAKE_QUESTIONS)
+        if "SIAP=" in system:
+            # Wawancara adaptif: keyakinan naik 15 poin per jawaban (cukup setelah ~6 jawaban)
+            user = str(messages[-1].get("content", ""))
+            turns = user.count("\nA: ") + user.count(" → ")
+            return f"SIAP={min(95, 15 * turns)} BAHAYA=tidak\n{question}"
+        return question
+
+    def _openai(self, h: BaseHTTPRequestHandler, body: Dict[str, object], t0: float) -> None:
+        prof = self.openai
+        total = prof.delay()
+        if prof.should_fail():
+            time.sleep(total * self.ttft_fraction)
+            self._log("openai", t0, 500)
+            return h._send(500, b'{"error":{"message":"fake server error","type":"server_error"}}')
+        text = self.completion_text(body)
+        usage = {"prompt_tokens": sum(len(str(m.get("content", ""))) // 4 for m in body.get("messages", [])),
+                 "completion_tokens": len(text) // 4 + 1}
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        if not body.get("stream"):
+            time.sleep(total)
+            out = {"id": "fake", "object": "chat.completion", "created": int(t0), "model": body.get("model"),
+                   "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                                "finish_reason": "stop"}],
+                   "usage": usage}
+            self._log("openai", t0, 200)
+            return h._send(200, json.dumps(out).encode("utf-8"))
+
+        chunks = [text[i:i + 12] for i in range(0, len(text), 12)] or [""]
+        time.sleep(total * self.ttft_fraction)
+        h.send_response(200)
+        h.send_header("Content-Type", "text/event-stream")
+        h.send_header("Connection", "close")
+        h.end_headers()
+        step = total * (1 - self.ttft_fraction) / len(chunks)
+        for piece in chunks:
+            c = {"id": "fake", "object": "chat.completion.chunk", "created": int(t0), "model": body.get("model"),
+                 "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}]}
+            h.wfile.write(f"data: {json.dumps(c)}\n\n".encode("utf-8"))
+            h.wfile.flush()
+            time.sleep(step)
+        final = {"id": "fake", "object": "chat.completion.chunk", "created": int(t0), "model": body.get("model"),
+                 "choices": [], "usage": usage}
+        h.wfile.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+        h.close_connection = True
+        self._log("openai", t0, 200)
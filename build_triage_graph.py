@@ -0,0 +1,156 @@
+"""Bangun graf triase dari transkrip anamnesis lampau (langkah offline, tanpa model).
+
+Contoh:
+  python build_triage_graph.py                          # transkrip sesi UI di arsip hasil (RESULTS_DB)
+  python build_triage_graph.py lama.jsonl --min-support 10
+  python build_triage_graph.py --source ui --source batch -o /data/triage_graph.json
+
+Sumber transkrip:
+  arsip   kolom `transcript` tabel hasil, difilter `--source` (default 'ui': pertanyaan dari model;
+          hasil batch berisi judul kolom formulir, jarang berguna sebagai jalur wawancara).
+  JSONL   file dengan field "qa_pairs" (format masukan batch_screening.py), boleh lebih dari satu.
+
+Pertanyaan yang istilahnya mirip (TRIAGE_MATCH_JACCARD) digabung menjadi satu node pertanyaan, dengan
+teks yang paling sering muncul sebagai wakil. Node = keluhan jawaban pertama + jalur (pertanyaan, ya/tidak);
+setiap node menyimpan jumlah transkrip per pertanyaan berikutnya. Node dengan dukungan < --min-support dibuang.
+Hasil ditulis ke TRIAGE_GRAPH_PATH (default FAWAI_CACHE_DIR/triage_graph.json); restart aplikasi agar dimuat.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from contextlib import closing
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+from batch_screening import _load_app, read_records
+
+Transcript = List[Tuple[str, str]]
+NodeId = Tuple[str, Tuple[Tuple[int, str], ...]]
+
+
+def archive_transcripts(app: Any, sources: List[str]) -> Iterator[Transcript]:
+    app._results_ready()
+    marks = ", ".join("?" for _ in sources)
+    with closing(app._results_conn()) as conn:
+        rows = conn.execute(f"SELECT transcript FROM results WHERE transcript IS NOT NULL AND source IN ({marks})",
+                            sources)
+        for (raw,) in rows:
+            try:
+                yield [(str(q), str(a)) for q, a in json.loads(raw)]
+            except (ValueError, TypeError):
+                continue
+
+
+def file_transcripts(paths: List[str]) -> Iterator[Transcript]:
+    for path in paths:
+        for record in read_records(path):
+            yield record["qa_pairs"]
+
+
+class QuestionClusters:
+    """Pengelompokan pertanyaan serakah: masuk kelompok pertama yang cukup mirip, atau buka kelompok baru."""
+
+    def __init__(self, app: Any) -> None:
+        self.app = app
+        self.seeds: List[frozenset] = []
+        self.wordings: List[Counter] = []
+        self._by_text: Dict[str, int] = {}
+        self._postings: Dict[str, List[int]] = defaultdict(list)
+
+    def assign(self, question: str) -> int:
+        app = self.app
+        folded = app._fold(question)
+        cid = self._by_text.get(folded)
+        if cid is None:
+            terms = app.question_terms(question)
+            candidates = {i for t in terms for i in self._postings.get(t, ())}
+            score, cid = max(((app.term_similarity(terms, self.seeds[i]), i) for i in candidates),
+                             default=(0.0, -1))
+            if score < app.TRIAGE_MATCH_JACCARD:
+                cid = len(self.seeds)
+                self.seeds.append(terms)
+                self.wordings.append(Counter())
+                for t in terms:
+                    self._postings[t].append(cid)
+            self._by_text[folded] = cid
+        self.wordings[cid][" ".join(question.split())] += 1
+        return cid
+
+
+def build_graph(app: Any, transcripts: Iterable[Transcript], max_turns: int, min_support: int) -> Dict[str, Any]:
+    clusters = QuestionClusters(app)
+    edges: Dict[NodeId, Counter] = defaultdict(Counter)
+    total = 0
+    for qa in transcripts:
+        qa = qa[: max_turns + 1]
+        if len(qa) < 2:
+            continue
+        total += 1
+        complaint = app.complaint_key(qa[0][1])
+        steps: List[Tuple[int, str]] = []
+        for q, a in qa[1:]:  # setelah len(steps) + 1 jawaban, pertanyaan berikutnya adalah q
+            cid = clusters.assign(q)
+            edges[(complaint, tuple(steps))][cid] += 1
+            steps.append((cid, app.answer_class(a)))
+
+    kept = {node: counts for node, counts in edges.items() if sum(counts.values()) >= min_support}
+    # Nomori ulang hanya pertanyaan yang masih dipakai node/cabang agar file & memori tetap ringkas
+    used = sorted({cid for (_c, steps), counts in kept.items() for cid in [s for s, _ in steps] + list(counts)})
+    remap = {cid: i for i, cid in enumerate(used)}
+    questions = []
+    for cid in used:
+        text = clusters.wordings[cid].most_common(1)[0][0]
+        questions.append({"text": text, "terms": sorted(app.question_terms(text)),
+                          "count": sum(clusters.wordings[cid].values())})
+    nodes = {
+        app.triage_node_key(complaint, [(remap[s], cls) for s, cls in steps]):
+            [[remap[cid], n] for cid, n in counts.most_common()]
+        for (complaint, steps), counts in sorted(kept.items())
+    }
+    return {"version": 1, "built_at": time.time(), "transcripts": total, "max_turns": max_turns,
+            "min_support": min_support, "questions": questions, "nodes": nodes}
+
+
+def write_graph(graph: Dict[str, Any], path: str) -> None:
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(graph, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, path)  # aplikasi yang sedang memuat tidak pernah melihat file setengah jadi
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("inputs", nargs="*", help="file JSONL tambahan dengan field qa_pairs")
+    ap.add_argument("-o", "--output", help="file graf (default TRIAGE_GRAPH_PATH)")
+    ap.add_argument("--source", action="append", help="sumber arsip yang dipakai (default: ui)")
+    ap.add_argument("--no-archive", action="store_true", help="hanya pakai file masukan, bukan arsip hasil")
+    ap.add_argument("--max-turns", type=int, default=None, help="kedalaman graf (default TRIAGE_MAX_TURNS)")
+    ap.add_argument("--min-support", type=int, default=5, help="transkrip minimal agar node disimpan")
+    args = ap.parse_args()
+
+    app = _load_app()
+    max_turns = args.max_turns if args.max_turns is not None else app.TRIAGE_MAX_TURNS
+    sources: List[Iterable[Transcript]] = [file_transcripts(args.inputs)]
+    if not args.no_archive:
+        sources.append(archive_transcripts(app, args.source or ["ui"]))
+    transcripts = (qa for src in sources for qa in src)
+
+    t0 = time.perf_counter()
+    graph = build_graph(app, transcripts, max(1, max_turns), max(1, args.min_support))
+    out = args.output or app.TRIAGE_GRAPH_PATH
+    write_graph(graph, out)
+    confident = sum(1 for edges in graph["nodes"].values()
+                    if edges[0][1] / sum(n for _, n in edges) >= app.TRIAGE_MIN_CONFIDENCE
+                    and sum(n for _, n in edges) >= app.TRIAGE_MIN_SUPPORT)
+    print(f"{graph['transcripts']} transkrip -> {len(graph['nodes'])} node, {len(graph['questions'])} pertanyaan "
+          f"({confident} node dilayani tanpa model dengan ambang saat ini) dalam {time.perf_counter() - t0:.1f}s; "
+          f"ditulis ke {out}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,37 @@
 # Final Project!!
 from __future__ import annotations
 
+import functools
+import hashlib
+import hmac
+import contextvars
+import itertools
+import json
+import math
+import mmap
 import os
+import queue
+import random
 import re
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+import weakref
+import openai
 import requests
 import streamlit as st
+from array import array
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import closing, contextmanager
+from dataclasses import asdict, dataclass, field
+from datetime import date, timedelta
 from openai import OpenAI
-from typing import List, Dict, Tuple
+from requests.adapters import HTTPAdapter
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from typing import Any, Callable, Iterator, List, Dict, Set, Tuple
 
 # ===============================================================
 # Setup: Secrets/Env & Konstanta
@@ -20,13 +45,18 @@ try:
 except Exception:
     pass
 
-def get_secret(name: str, default: str | None = None) -> str:
-    """Cloud: ambil dari st.secrets; Lokal: dari os.getenv (mis. .env)."""
+@st.cache_resource(show_spinner=False)
+def _secrets_snapshot() -> Dict[str, object]:
+    """Baca st.secrets sekali per proses (bukan di setiap rerun)."""
     try:
-        # st.secrets bisa berupa Mapping-like; gunakan get agar aman
-        return st.secrets.get(name, os.getenv(name, default))  # type: ignore[attr-defined]
+        # st.secrets bisa berupa Mapping-like; salin ke dict biasa
+        return dict(st.secrets)  # type: ignore[arg-type]
     except Exception:
-        return os.getenv(name, default)
+        return {}
+
+def get_secret(name: str, default: str | None = None) -> str:
+    """Cloud: ambil dari st.secrets; Lokal: dari os.getenv (mis. .env)."""
+    return _secrets_snapshot().get(name, os.getenv(name, default))  # type: ignore[return-value]
 
 APP_TITLE = (
     "Prototype Pemanfaatan Kecerdasan Buatan (AI) sebagai Alat Bantu Diagnosis Masalah Kesehatan Siswa-Siswi SMP Labschool Jakarta"
@@ -36,40 +66,692 @@ APP_DESC = "Silakan jawab pertanyaan berikut untuk menganalisis masalah kesehata
 # Kunci & model
 OPENAI_API_KEY     = (get_secret("OPENAI_API_KEY", "") or "").strip()
 OPENAI_MODEL       = (get_secret("OPENAI_MODEL", "gpt-4o-mini") or "").strip()
+STREAM_OUTPUT      = (get_secret("STREAM_OUTPUT", "1") or "").strip().lower() not in ("0", "false", "no", "off")
+# Format analisis akhir: 'markdown' (teks bebas, diparse dengan regex) atau 'json' (structured output
+# tervalidasi skema; tidak di-stream). Bila JSON tidak valid, otomatis kembali ke jalur markdown.
+ANALYSIS_FORMAT    = (get_secret("ANALYSIS_FORMAT", "markdown") or "markdown").strip().lower()
+# Harga per 1 juta token (USD) untuk estimasi biaya di trace; default = gpt-4o-mini
+OPENAI_PRICE_INPUT  = float(get_secret("OPENAI_PRICE_INPUT", "0.15") or 0)
+OPENAI_PRICE_CACHED = float(get_secret("OPENAI_PRICE_CACHED", "0.075") or 0)
+OPENAI_PRICE_OUTPUT = float(get_secret("OPENAI_PRICE_OUTPUT", "0.60") or 0)
+# Governor OpenAI (bersama semua sesi di proses ini). Dengan beberapa proses, bagi limit per proses.
+OPENAI_RPM             = float(get_secret("OPENAI_RPM", "500") or 500)          # request/menit
+OPENAI_TPM             = float(get_secret("OPENAI_TPM", "200000") or 200000)    # token/menit
+OPENAI_TIMEOUT_S       = float(get_secret("OPENAI_TIMEOUT_S", "60") or 60)      # per percobaan
+OPENAI_DEADLINE_S      = float(get_secret("OPENAI_DEADLINE_S", "120") or 120)   # total: antre + semua retry
+OPENAI_MAX_RETRIES     = int(get_secret("OPENAI_MAX_RETRIES", "4") or 0)
+OPENAI_OUTPUT_RESERVE  = int(get_secret("OPENAI_OUTPUT_RESERVE", "600") or 600) # token output yang dipesan per panggilan
+# Tenggat per panggilan & hedging: bila OPENAI_MODEL belum memberi token pertama setelah OPENAI_HEDGE_AFTER_S,
+# permintaan yang sama dikirim juga ke OPENAI_HEDGE_MODEL (kosong = tanpa hedge); yang lebih dulu menjawab dipakai.
+# Default kosong: hedge ke model yang sama hanya menggandakan beban pada kuota & antrean yang sama.
+OPENAI_HEDGE_MODEL     = (get_secret("OPENAI_HEDGE_MODEL", "") or "").strip()
+OPENAI_HEDGE_AFTER_S   = float(get_secret("OPENAI_HEDGE_AFTER_S", "4") or 4)
+QUESTION_DEADLINE_S    = float(get_secret("QUESTION_DEADLINE_S", "15") or 15)   # lewat ini: bank pertanyaan standar
+ANALYSIS_DEADLINE_S    = float(get_secret("ANALYSIS_DEADLINE_S", "90") or 90)
 
 # SendGrid (Email)
 SENDGRID_API_KEY   = (get_secret("SENDGRID_API_KEY", "") or "").strip()
 EMAIL_FROM         = (get_secret("EMAIL_FROM", "") or "").strip()  # harus verified sender/domain di SendGrid
+SENDGRID_HOST      = (get_secret("SENDGRID_HOST", "https://api.sendgrid.com") or "").strip()
 
 # Twilio (SMS) – opsional
 TWILIO_ACCOUNT_SID = (get_secret("TWILIO_ACCOUNT_SID", "") or "").strip()
 TWILIO_AUTH_TOKEN  = (get_secret("TWILIO_AUTH_TOKEN", "") or "").strip()
 TWILIO_FROM        = (get_secret("TWILIO_FROM", "") or "").strip()
+TWILIO_API_BASE    = (get_secret("TWILIO_API_BASE", "") or "").strip()  # kosong = default Twilio
 
 MISSING_SENDGRID = not (SENDGRID_API_KEY and EMAIL_FROM)
 
+# Referensi analisis: 'local' = indeks pedoman di repo (BM25, tanpa jaringan); 'online' = fetch RESEARCH_SOURCES
+RESEARCH_MODE  = (get_secret("RESEARCH_MODE", "local") or "local").strip().lower()
+RESEARCH_TOP_K = int(get_secret("RESEARCH_TOP_K", "4") or 4)
+
+# Cache lokal (riset, dll.) & batas waktu fetch referensi
+CACHE_DIR            = (get_secret("FAWAI_CACHE_DIR", ".fawai_cache") or ".fawai_cache").strip()
+RESEARCH_TTL_S       = float(get_secret("RESEARCH_TTL_S", "21600") or 21600)   # 6 jam
+RESEARCH_DEADLINE_S  = float(get_secret("RESEARCH_DEADLINE_S", "8") or 8)      # total, semua sumber
+RESEARCH_RETRY_S     = float(get_secret("RESEARCH_RETRY_S", "300") or 300)     # jeda sebelum sumber gagal dicoba lagi
+PREFETCH_AHEAD       = int(get_secret("PREFETCH_AHEAD", "3") or 3)             # mulai persiapan tahap akhir N giliran sebelumnya
+
+# Outbox pengiriman email/SMS (dikirim di background)
+DELIVERY_WORKERS      = int(get_secret("DELIVERY_WORKERS", "2") or 2)
+DELIVERY_MAX_ATTEMPTS = int(get_secret("DELIVERY_MAX_ATTEMPTS", "5") or 5)
+DELIVERY_LEASE_S      = float(get_secret("DELIVERY_LEASE_S", "300") or 300)   # job 'sending' lebih lama dari ini: pemiliknya dianggap mati
+
+# Arsip hasil skrining untuk petugas UKS (SQLite WAL, ditulis per batch oleh thread background)
+RESULTS_DB        = (get_secret("RESULTS_DB", "") or "").strip() or os.path.join(CACHE_DIR, "results.sqlite3")
+RESULTS_FLUSH_S   = float(get_secret("RESULTS_FLUSH_S", "1.0") or 1.0)   # jeda maks. sebelum batch ditulis
+RESULTS_BATCH_MAX = int(get_secret("RESULTS_BATCH_MAX", "200") or 200)
+
+# Konteks prompt: jumlah giliran terakhir yang dikirim utuh & budget token (estimasi)
+CONTEXT_RECENT_TURNS    = int(get_secret("CONTEXT_RECENT_TURNS", "4") or 4)
+QUESTION_PROMPT_BUDGET  = int(get_secret("QUESTION_PROMPT_BUDGET", "1200") or 1200)
+ANALYSIS_PROMPT_BUDGET  = int(get_secret("ANALYSIS_PROMPT_BUDGET", "3500") or 3500)
+
+# Wawancara adaptif: pertanyaan lanjutan disertai sinyal kesiapan & red flag dari model. Analisis dimulai
+# lebih awal bila model yakin (setelah minimal INTERVIEW_MIN_QUESTIONS jawaban) atau ada red flag.
+ADAPTIVE_INTERVIEW         = (get_secret("ADAPTIVE_INTERVIEW", "1") or "").strip().lower() not in ("0", "false", "no", "off")
+INTERVIEW_MIN_QUESTIONS    = int(get_secret("INTERVIEW_MIN_QUESTIONS", "4") or 4)
+INTERVIEW_READY_CONFIDENCE = int(get_secret("INTERVIEW_READY_CONFIDENCE", "80") or 80)  # 0-100
+
+# Graf triase (dibangun offline oleh build_triage_graph.py dari transkrip arsip): pertanyaan giliran awal
+# diambil dari graf bila node-nya cukup yakin, cabang jarang tetap ke model. Default giliran < INTERVIEW_MIN_QUESTIONS
+# agar graf tidak pernah menggantikan giliran yang bisa memicu berhenti lebih awal.
+TRIAGE_GRAPH_PATH     = (get_secret("TRIAGE_GRAPH_PATH", "") or "").strip() or os.path.join(CACHE_DIR, "triage_graph.json")
+TRIAGE_MAX_TURNS      = int(get_secret("TRIAGE_MAX_TURNS", "3") or 0)         # 0 = mati
+TRIAGE_MIN_CONFIDENCE = float(get_secret("TRIAGE_MIN_CONFIDENCE", "0.6") or 0.6)  # porsi cabang terbanyak di node
+TRIAGE_MIN_SUPPORT    = int(get_secret("TRIAGE_MIN_SUPPORT", "20") or 20)     # transkrip minimal yang melewati node
+
+# Cache respons model (SQLite). *_TURNS = maks. jumlah Q/A agar respons boleh di-cache (0 = mati).
+LLM_CACHE_TTL_S          = float(get_secret("LLM_CACHE_TTL_S", "604800") or 604800)   # 7 hari
+LLM_CACHE_MAX_ENTRIES    = int(get_secret("LLM_CACHE_MAX_ENTRIES", "5000") or 5000)
+LLM_CACHE_MAX_CHARS      = int(get_secret("LLM_CACHE_MAX_CHARS", "8000") or 8000)     # respons lebih panjang tidak disimpan
+LLM_CACHE_TURNS = {
+    "generate_next_question": int(get_secret("LLM_CACHE_QUESTION_TURNS", "2") or 0),
+    "analyze_health": int(get_secret("LLM_CACHE_ANALYSIS_TURNS", "0") or 0),
+}
+
+# Tracing per tahap (JSONL + teks Prometheus di CACHE_DIR/traces) & panel admin (?admin=<token>)
+TRACE_ENABLED = (get_secret("TRACE_ENABLED", "1") or "").strip().lower() not in ("0", "false", "no", "off")
+TRACE_WINDOW  = int(get_secret("TRACE_WINDOW", "2000") or 2000)   # span terakhir per tahap untuk persentil bergulir
+ADMIN_TOKEN   = (get_secret("ADMIN_TOKEN", "") or "").strip()     # kosong = panel admin mati
+
+# Memori sesi: sesi idle dipindah (offload) ke disk & dimuat lagi saat siswa kembali
+SESSION_IDLE_S           = float(get_secret("SESSION_IDLE_S", "900") or 900)
+SESSION_MEMORY_BUDGET_MB = float(get_secret("SESSION_MEMORY_BUDGET_MB", "256") or 256)
+SESSION_OFFLOAD_TTL_S    = float(get_secret("SESSION_OFFLOAD_TTL_S", "86400") or 86400)  # hapus state sesi lebih tua
+
+# State sesi di luar proses (kunci = ?sid= di URL): beberapa proses di belakang load balancer & restart
+# tidak menghilangkan wawancara. 'sqlite' = file di CACHE_DIR (satu mesin); 'redis' = server Redis-kompatibel
+# (SESSION_REDIS_URL, butuh paket `redis`) untuk proses di beberapa mesin.
+SESSION_BACKEND   = (get_secret("SESSION_BACKEND", "sqlite") or "sqlite").strip().lower()
+SESSION_REDIS_URL = (get_secret("SESSION_REDIS_URL", "redis://localhost:6379/0") or "").strip()
+# ?sid= hanya melanjutkan sesi yang aktif dalam jendela ini: URL lama di riwayat browser tidak membuka wawancara
+SESSION_RESUME_S  = float(get_secret("SESSION_RESUME_S", "1800") or 1800)
+
 # Validasi minimum
 if not OPENAI_API_KEY:
     st.error("OPENAI_API_KEY belum disetel di Secrets/Environment. Set dulu di **Manage app → Settings → Secrets**.")
     st.stop()
 
+# ===============================================================
+# Registry Client (sekali per proses, dipakai ulang lintas rerun & sesi)
+# ===============================================================
+@st.cache_resource(show_spinner=False)
+def get_openai_client(api_key: str) -> OpenAI:
+    # Retry & timeout diatur governor (lihat _openai_create), bukan retry bawaan SDK
+    return OpenAI(api_key=api_key, max_retries=0, timeout=OPENAI_TIMEOUT_S)
+
+@st.cache_resource(show_spinner=False)
+def get_http_session() -> requests.Session:
+    """Satu Session per proses: koneksi keep-alive dipakai ulang antar sumber & antar siswa."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=16)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = "FawAI-Dokter-Remaja/1.0"
+    return session
+
+@st.cache_resource(show_spinner=False)
+def get_sendgrid_client(api_key: str, host: str = "https://api.sendgrid.com"):
+    from sendgrid import SendGridAPIClient
+    return SendGridAPIClient(api_key, host=host)
+
+@st.cache_resource(show_spinner=False)
+def get_twilio_client(account_sid: str, auth_token: str, api_base: str = ""):
+    from twilio.rest import Client as TwilioClient
+    client = TwilioClient(account_sid, auth_token)  # memakai requests.Session internal (keep-alive)
+    if api_base:
+        client.api.base_url = api_base.rstrip("/")
+    return client
+
 # Client OpenAI
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+openai_client = get_openai_client(OPENAI_API_KEY)
+
+
+# ===============================================================
+# Tracing (durasi, retry, token & biaya per tahap)
+# ===============================================================
+def _percentile(sorted_vals: List[float], p: float) -> float:
+    k = max(0, min(len(sorted_vals) - 1, int(round(p / 100 * len(sorted_vals) + 0.5)) - 1))
+    return sorted_vals[k]
+
+class Tracer:
+    """Agregat span per proses: durasi bergulir per tahap, counter kumulatif, log JSONL harian
+    (traces/spans-YYYYMMDD.jsonl) dan snapshot teks Prometheus (traces/metrics.prom)."""
+
+    COUNTERS = ("count", "errors", "retries", "seconds", "prompt_tokens", "completion_tokens",
+                "cached_tokens", "cost_usd")
+
+    def __init__(self, directory: str, window: int) -> None:
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._recent: Dict[str, deque] = defaultdict(lambda: deque(maxlen=max(1, window)))
+        self._totals: Dict[str, Dict[str, float]] = defaultdict(lambda: dict.fromkeys(self.COUNTERS, 0.0))
+        self._file: Any = None
+        self._file_day = ""
+        self._prom_at = 0.0
+        self._gauges: Dict[str, Callable[[], Dict[str, float]]] = {}
+
+    def register_gauges(self, prefix: str, provider: Callable[[], Dict[str, float]]) -> None:
+        """Sumber gauge tambahan (mis. kedalaman antrean) untuk ekspor Prometheus."""
+        self._gauges[prefix] = provider
+
+    def record(self, span: Dict[str, object]) -> None:
+        name = str(span["span"])
+        duration = float(span.get("duration_s") or 0.0)
+        line = json.dumps(span, ensure_ascii=False, default=str) + "\n"
+        with self._lock:
+            self._recent[name].append(duration)
+            tot = self._totals[name]
+            tot["count"] += 1
+            tot["seconds"] += duration
+            tot["errors"] += span.get("outcome") == "error"
+            for key in ("retries", "prompt_tokens", "completion_tokens", "cached_tokens", "cost_usd"):
+                tot[key] += float(span.get(key) or 0)
+            try:
+                self._append(line, span)
+            except OSError:
+                pass  # trace bersifat best-effort, tidak boleh mengganggu alur siswa
+
+    def _append(self, line: str, span: Dict[str, object]) -> None:
+        day = time.strftime("%Y%m%d", time.localtime(float(span.get("ts") or time.time())))
+        if day != self._file_day:
+            if self._file is not None:
+                self._file.close()
+            os.makedirs(self.directory, exist_ok=True)
+            self._file = open(os.path.join(self.directory, f"spans-{day}.jsonl"), "a", encoding="utf-8", buffering=1)
+            self._file_day = day
+        self._file.write(line)
+        if time.time() - self._prom_at >= 10:
+            self._prom_at = time.time()
+            path = os.path.join(self.directory, "metrics.prom")
+            with open(path + ".tmp", "w", encoding="utf-8") as f:
+                f.write(self._prometheus_locked())
+            os.replace(path + ".tmp", path)
+
+    def summary(self) -> List[Dict[str, object]]:
+        """Persentil bergulir per tahap (ms) + total kumulatif, untuk panel admin."""
+        with self._lock:
+            snap = {name: (sorted(vals), dict(self._totals[name])) for name, vals in self._recent.items()}
+        rows = []
+        for name, (vals, tot) in sorted(snap.items()):
+            rows.append({
+                "tahap": name,
+                "n": int(tot["count"]),
+                "p50_ms": round(_percentile(vals, 50) * 1e3, 1),
+                "p95_ms": round(_percentile(vals, 95) * 1e3, 1),
+                "p99_ms": round(_percentile(vals, 99) * 1e3, 1),
+                "error": int(tot["errors"]),
+                "retry": int(tot["retries"]),
+                "token": int(tot["prompt_tokens"] + tot["completion_tokens"]),
+                "biaya_usd": round(tot["cost_usd"], 4),
+            })
+        return rows
+
+    def prometheus(self) -> str:
+        with self._lock:
+            return self._prometheus_locked()
+
+    def _prometheus_locked(self) -> str:
+        out = [
+            "# HELP fawai_stage_duration_seconds Durasi per tahap (kuantil dari jendela bergulir).",
+            "# TYPE fawai_stage_duration_seconds summary",
+        ]
+        for name, vals in sorted(self._recent.items()):
+            ordered = sorted(vals)
+            for q in (0.5, 0.95, 0.99):
+                out.append(f'fawai_stage_duration_seconds{{stage="{name}",quantile="{q}"}} {_percentile(ordered, q * 100):.6f}')
+            out.append(f'fawai_stage_duration_seconds_sum{{stage="{name}"}} {self._totals[name]["seconds"]:.6f}')
+            out.append(f'fawai_stage_duration_seconds_count{{stage="{name}"}} {int(self._totals[name]["count"])}')
+        for metric, key, help_text in (
+            ("fawai_stage_errors_total", "errors", "Jumlah span dengan outcome error."),
+            ("fawai_stage_retries_total", "retries", "Jumlah retry (SDK OpenAI / percobaan ulang outbox)."),
+            ("fawai_llm_cost_usd_total", "cost_usd", "Estimasi biaya OpenAI (USD)."),
+        ):
+            out += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+            out += [f'{metric}{{stage="{name}"}} {tot[key]:g}' for name, tot in sorted(self._totals.items())]
+        out += ["# HELP fawai_llm_tokens_total Token OpenAI menurut usage.", "# TYPE fawai_llm_tokens_total counter"]
+        for name, tot in sorted(self._totals.items()):
+            for kind in ("prompt", "completion", "cached"):
+                if tot[f"{kind}_tokens"]:
+                    out.append(f'fawai_llm_tokens_total{{stage="{name}",kind="{kind}"}} {int(tot[f"{kind}_tokens"])}')
+        for prefix, provider in sorted(self._gauges.items()):
+            for key, val in sorted(provider().items()):
+                out += [f"# TYPE fawai_{prefix}_{key} gauge", f"fawai_{prefix}_{key} {val:g}"]
+        return "\n".join(out) + "\n"
+
+@st.cache_resource(show_spinner=False)
+def get_tracer() -> Tracer:
+    return Tracer(os.path.join(CACHE_DIR, "traces"), TRACE_WINDOW)
+
+_TRACE_SESSION: contextvars.ContextVar[str | None] = contextvars.ContextVar("fawai_trace_session", default=None)
+
+def _current_session_id() -> str | None:
+    """session_id siswa: dari konteks batch (`_TRACE_SESSION`) atau thread skrip Streamlit; None di thread lain."""
+    sid = _TRACE_SESSION.get()
+    if sid is not None:
+        return sid
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return None
+    sess = st.session_state.get("fawai")
+    return sess.session_id if sess is not None else None
+
+def trace_event(name: str, session_id: str | None = None, duration_s: float = 0.0, **attrs: object) -> None:
+    """Catat satu span yang sudah selesai."""
+    if not TRACE_ENABLED:
+        return
+    span = {"ts": time.time(), "span": name, "session_id": session_id or _current_session_id(),
+            "duration_s": round(duration_s, 6), "outcome": "ok"}
+    span.update(attrs)
+    try:
+        get_tracer().record(span)
+    except Exception:
+        pass
+
+@contextmanager
+def trace_span(name: str, session_id: str | None = None, **attrs: object) -> Iterator[Dict[str, object]]:
+    """Ukur satu tahap. Dict yang di-yield boleh diisi atribut (token, retries, outcome, ...).
+    Thread background wajib memberi `session_id` sendiri."""
+    span: Dict[str, object] = dict(attrs)
+    if not TRACE_ENABLED:
+        yield span
+        return
+    t0 = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield span
+    except Exception as e:
+        outcome = "error"
+        span.setdefault("error", f"{type(e).__name__}: {e}"[:300])
+        raise
+    except BaseException:
+        outcome = "cancelled"  # st.rerun/st.stop, atau proses dihentikan
+        raise
+    finally:
+        span.setdefault("outcome", outcome)
+        trace_event(name, session_id, time.perf_counter() - t0, **span)
+
+def traced(name: str):
+    """Decorator: bungkus seluruh fungsi dalam satu span."""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with trace_span(name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
 
 
 # ===============================================================
-# State Inisialisasi
+# State Sesi (model ringkas, akuntansi memori & offload ke disk)
 # ===============================================================
-def _init_state() -> None:
-    ss = st.session_state
-    ss.setdefault("chat_log", [])
-    ss.setdefault("qa_pairs", [])
-    ss.setdefault("step", "bio")           # 'bio' -> 'chat' -> 'done'
-    ss.setdefault("bio_data", {})
-    ss.setdefault("question_count", 0)
-    ss.setdefault("max_questions", 10)
-    ss.setdefault("final_analysis", None)
-    ss.setdefault("first_question_sent", False)
+ROLE_ASSISTANT, ROLE_USER = 0, 1
+CONTACT_FIELDS = ("email", "nohp")  # hanya di memori proses: tidak pernah ikut state sesi yang disimpan
+INTERN_MAX_CHARS = 500  # teks asisten sependek ini (pertanyaan) di-intern: satu salinan untuk semua sesi
+
+@dataclass(slots=True, weakref_slot=True)
+class SessionData:
+    """State satu siswa. Setiap pesan disimpan sekali (roles + texts); riwayat chat,
+    pasangan Q/A, jumlah pertanyaan dan analisis akhir adalah view di atasnya."""
+    session_id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    step: str = "bio"                      # 'bio' -> 'chat' -> 'done' ('analyze' = analisis gagal, menunggu ulang)
+    max_questions: int = 10
+    bio: Dict[str, str] = field(default_factory=dict)
+    roles: bytearray = field(default_factory=bytearray)   # ROLE_* per pesan (1 byte)
+    texts: List[str] = field(default_factory=list)
+    final_index: int = -1                  # indeks pesan analisis akhir di `texts`
+    llm_calls: List[Dict[str, object]] = field(default_factory=list)  # TTFT, durasi & token per panggilan
+    started_at: float = field(default_factory=time.time)
+    last_seen: float = field(default_factory=time.time)
+    saved_at: float = 0.0                  # waktu simpan terakhir di backend (batas berlakunya ?sid=)
+    final_prefetch: Any = None             # Future persiapan tahap akhir (riset dll.)
+    contact_lost: List[str] = field(default_factory=list)  # kontak yang diisi, tetapi tidak ada di proses ini
+    offloaded: bool = False
+    version: int = 0                       # versi state di backend (compare-and-set saat commit)
+    saved_mark: Tuple[object, ...] = ()    # ringkasan state saat terakhir disimpan/dimuat
+    lock: threading.RLock = field(default_factory=threading.RLock, repr=False, compare=False)
+
+    def add(self, role: int, text: str) -> int:
+        if role == ROLE_ASSISTANT and len(text) <= INTERN_MAX_CHARS:
+            text = sys.intern(text)
+        self.roles.append(role)
+        self.texts.append(text)
+        return len(self.texts) - 1
+
+    def messages(self, start: int = 0) -> Iterator[Tuple[int, str]]:
+        return zip(self.roles[start:], self.texts[start:])
+
+    @property
+    def qa_pairs(self) -> List[Tuple[str, str]]:
+        """Jawaban siswa dipasangkan dengan pesan asisten terakhir sebelumnya."""
+        pairs: List[Tuple[str, str]] = []
+        last_q = "(pertanyaan awal)"
+        for role, text in zip(self.roles, self.texts):
+            if role == ROLE_USER:
+                pairs.append((last_q, text))
+            else:
+                last_q = text
+        return pairs
+
+    @property
+    def question_count(self) -> int:
+        return self.roles.count(ROLE_USER)
+
+    @property
+    def final_analysis(self) -> str | None:
+        return self.texts[self.final_index] if self.final_index >= 0 else None
+
+    def nbytes(self) -> int:
+        """Perkiraan memori sesi (byte). Teks ter-intern dihitung penuh, jadi ini batas atas."""
+        n = sys.getsizeof(self) + sys.getsizeof(self.roles) + sys.getsizeof(self.texts)
+        n += sum(sys.getsizeof(t) for t in self.texts)
+        n += sys.getsizeof(self.bio) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in self.bio.items())
+        n += sys.getsizeof(self.llm_calls) + sum(sys.getsizeof(c) for c in self.llm_calls)
+        return n
+
+    def _mark(self) -> Tuple[object, ...]:
+        # Pesan hanya pernah ditambah, jadi jumlahnya cukup untuk mendeteksi perubahan
+        return (self.step, len(self.texts), self.final_index, len(self.llm_calls), tuple(self.bio.items()),
+                tuple(self.contact_lost))
+
+    def to_payload(self) -> str:
+        bio = {k: v for k, v in self.bio.items() if k not in CONTACT_FIELDS}
+        # Hanya NAMA kontak yang pernah diisi, agar proses lain tahu harus menanyakannya lagi
+        contact = sorted({k for k in CONTACT_FIELDS if self.bio.get(k)} | set(self.contact_lost))
+        return json.dumps({"step": self.step, "max_questions": self.max_questions, "bio": bio, "contact": contact,
+                           "roles": list(self.roles), "texts": self.texts, "final_index": self.final_index,
+                           "llm_calls": self.llm_calls, "started_at": self.started_at,
+                           "saved_at": time.time()},
+                          ensure_ascii=False, default=str)
+
+    def apply_payload(self, version: int, payload: str) -> None:
+        data = json.loads(payload)
+        self.step, self.max_questions = data["step"], data["max_questions"]
+        contact = {k: v for k, v in self.bio.items() if k in CONTACT_FIELDS}  # dari memori proses ini, bila ada
+        self.bio, self.roles, self.llm_calls = dict(data["bio"], **contact), bytearray(data["roles"]), data["llm_calls"]
+        self.texts = [sys.intern(t) if r == ROLE_ASSISTANT and len(t) <= INTERN_MAX_CHARS else t
+                      for r, t in zip(data["roles"], data["texts"])]
+        self.final_index, self.started_at = data["final_index"], data["started_at"]
+        self.contact_lost = [k for k in data.get("contact", ()) if not self.bio.get(k)]
+        self.saved_at = data.get("saved_at", self.started_at)
+        self.version, self.saved_mark, self.offloaded = version, self._mark(), False
+
+    def commit(self) -> None:
+        """Simpan ke backend bila berubah sejak disimpan/dimuat. SessionConflict bila run lain
+        (tab/proses lain) sudah menyimpan versi yang lebih baru."""
+        mark = self._mark()
+        if self.offloaded or mark == self.saved_mark:
+            return
+        self.version = get_session_backend().save(self.session_id, self.to_payload(), self.version)
+        self.saved_mark = mark
+
+    def reload(self) -> bool:
+        """Ganti isi dengan state di backend; False bila tidak ada (kedaluwarsa/hilang)."""
+        row = get_session_backend().load(self.session_id)
+        if row is None:
+            self.reset()  # kedaluwarsa (TTL): mulai dari biodata, bukan chat tanpa isi
+            return False
+        self.apply_payload(*row)
+        return True
+
+    def reset(self) -> None:
+        """Kembali ke sesi baru (tahap biodata) dengan id yang sama; lock & registry tetap."""
+        fresh = SessionData(session_id=self.session_id)
+        for name in ("step", "max_questions", "bio", "roles", "texts", "final_index", "llm_calls", "started_at",
+                     "saved_at", "final_prefetch", "contact_lost", "offloaded", "version", "saved_mark"):
+            setattr(self, name, getattr(fresh, name))
+
+    def refresh(self) -> bool:
+        """Muat ulang bila run lain sudah menyimpan versi lebih baru dari yang ada di memori."""
+        return get_session_backend().version(self.session_id) > self.version and self.reload()
+
+    def offload(self) -> None:
+        """Pastikan state tersimpan di backend; yang tersisa di memori hanya kerangka kecil."""
+        try:
+            self.commit()
+        except SessionConflict:
+            pass  # versi lebih baru sudah di backend, dimuat saat siswa kembali
+        contact = {k: v for k, v in self.bio.items() if k in CONTACT_FIELDS}
+        self.bio, self.roles, self.texts, self.llm_calls = contact, bytearray(), [], []
+        self.offloaded = True
+
+class SessionConflict(RuntimeError):
+    """State sesi sudah disimpan run lain sejak terakhir dibaca (optimistic versioning)."""
+
+class SqliteSessionBackend:
+    """State sesi di satu file SQLite (WAL): cukup untuk beberapa proses di satu mesin."""
+    errors: Tuple[type, ...] = (sqlite3.Error,)
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with closing(self._conn()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS session_state (session_id TEXT PRIMARY KEY, version INTEGER NOT NULL,"
+                         " payload TEXT NOT NULL, updated_at REAL NOT NULL)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def version(self, session_id: str) -> int:
+        with closing(self._conn()) as conn:
+            row = conn.execute("SELECT version FROM session_state WHERE session_id=?", (session_id,)).fetchone()
+        return int(row[0]) if row else 0
+
+    def load(self, session_id: str) -> Tuple[int, str] | None:
+        with closing(self._conn()) as conn:
+            row = conn.execute("SELECT version, payload FROM session_state WHERE session_id=?", (session_id,)).fetchone()
+        return (int(row[0]), row[1]) if row else None
+
+    def save(self, session_id: str, payload: str, version: int) -> int:
+        """Tulis bila versi tersimpan masih `version` (0 = belum ada); hasil = versi baru."""
+        with closing(self._conn()) as conn:
+            if version == 0:
+                cur = conn.execute("INSERT OR IGNORE INTO session_state (session_id, version, payload, updated_at)"
+                                   " VALUES (?, 1, ?, ?)", (session_id, payload, time.time()))
+            else:
+                cur = conn.execute("UPDATE session_state SET version = version + 1, payload = ?, updated_at = ?"
+                                   " WHERE session_id = ? AND version = ?", (payload, time.time(), session_id, version))
+        if not cur.rowcount:
+            raise SessionConflict(session_id)
+        return version + 1
+
+    def delete(self, session_id: str) -> None:
+        with closing(self._conn()) as conn:
+            conn.execute("DELETE FROM session_state WHERE session_id=?", (session_id,))
+
+    def purge(self, older_than: float) -> None:
+        with closing(self._conn()) as conn:
+            conn.execute("DELETE FROM session_state WHERE updated_at < ?", (older_than,))
+
+class RedisSessionBackend:
+    """State sesi di server Redis-kompatibel: satu hash {v, p} per sesi dengan EXPIRE.
+    Compare-and-set memakai WATCH/MULTI/EXEC (tanpa Lua), jadi server pengganti sederhana pun cukup."""
+
+    def __init__(self, url: str, ttl_s: float) -> None:
+        import redis  # opsional: hanya dibutuhkan untuk SESSION_BACKEND=redis
+        self._redis = redis.Redis.from_url(url, socket_timeout=5, decode_responses=True)
+        self._watch_error = redis.WatchError
+        self.errors: Tuple[type, ...] = (redis.RedisError,)
+        self.ttl_s = max(1, int(ttl_s))
+
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"fawai:session:{session_id}"
+
+    def version(self, session_id: str) -> int:
+        return int(self._redis.hget(self._key(session_id), "v") or 0)
+
+    def load(self, session_id: str) -> Tuple[int, str] | None:
+        data = self._redis.hgetall(self._key(session_id))
+        return (int(data["v"]), data["p"]) if data else None
+
+    def save(self, session_id: str, payload: str, version: int) -> int:
+        key = self._key(session_id)
+        with self._redis.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                if int(pipe.hget(key, "v") or 0) != version:
+                    raise SessionConflict(session_id)
+                pipe.multi()
+                pipe.hset(key, mapping={"v": version + 1, "p": payload})
+                pipe.expire(key, self.ttl_s)
+                pipe.execute()
+            except self._watch_error:
+                raise SessionConflict(session_id) from None
+        return version + 1
+
+    def delete(self, session_id: str) -> None:
+        self._redis.delete(self._key(session_id))
+
+    def purge(self, older_than: float) -> None:
+        pass  # kedaluwarsa lewat EXPIRE
+
+@st.cache_resource(show_spinner=False)
+def get_session_backend() -> SqliteSessionBackend | RedisSessionBackend:
+    if SESSION_BACKEND == "redis":
+        return RedisSessionBackend(SESSION_REDIS_URL, SESSION_OFFLOAD_TTL_S)
+    return SqliteSessionBackend(os.path.join(CACHE_DIR, "sessions.sqlite3"))
+
+@st.cache_resource(show_spinner=False)
+def _session_registry() -> Dict[str, object]:
+    """Sesi hidup di proses ini (weakref: sesi yang dibuang Streamlit ikut hilang dari sini)."""
+    registry: Dict[str, object] = {"sessions": weakref.WeakValueDictionary(), "lock": threading.Lock(), "swept_at": 0.0}
+    get_tracer().register_gauges("sessions", session_memory_stats)
+    return registry
+
+def session_memory_stats() -> Dict[str, float]:
+    """Jumlah sesi & perkiraan byte di memori (untuk panel admin & metrics)."""
+    reg = _session_registry()
+    with reg["lock"]:
+        sessions = list(reg["sessions"].values())
+    live = [x for x in sessions if not x.offloaded]
+    return {"active": len(live), "offloaded": len(sessions) - len(live), "bytes": sum(x.nbytes() for x in live)}
+
+def _sweep_sessions(current: SessionData) -> None:
+    """Offload sesi idle > SESSION_IDLE_S, lalu sesi paling lama idle bila total melewati budget.
+    Sesi yang sedang berjalan (lock dipegang thread skripnya) dilewati."""
+    reg = _session_registry()
+    backend = get_session_backend()
+    now = time.time()
+    with reg["lock"]:
+        if now - reg["swept_at"] < 30:
+            return
+        reg["swept_at"] = now
+        sessions = [x for x in reg["sessions"].values() if x is not current and not x.offloaded]
+    sessions.sort(key=lambda x: x.last_seen)
+    total = current.nbytes() + sum(x.nbytes() for x in sessions)
+    budget = SESSION_MEMORY_BUDGET_MB * 1024 * 1024
+    for sess in sessions:
+        if now - sess.last_seen < SESSION_IDLE_S and total <= budget:
+            break
+        if not sess.lock.acquire(blocking=False):
+            continue
+        try:
+            size = sess.nbytes()
+            sess.offload()
+            total -= size
+        except backend.errors:
+            pass
+        finally:
+            sess.lock.release()
+    backend.purge(now - SESSION_OFFLOAD_TTL_S)
+
+_SESSION_ID_RE = re.compile(r"[0-9a-f]{32}")
+
+def get_session() -> SessionData:
+    """Sesi run ini. Browser baru dengan ?sid= yang masih ada di backend melanjutkan wawancaranya
+    (tab lain, setelah restart, atau dilayani proses lain di belakang load balancer). Sesi yang sudah
+    selesai tidak pernah dilanjutkan, agar siswa berikutnya di komputer bersama mulai dari awal. ?sid=
+    bersifat bearer, jadi hanya berlaku SESSION_RESUME_S sejak aktivitas terakhir: URL yang tertinggal di
+    riwayat browser atau dibagikan tidak lagi membuka wawancara (medis, anak di bawah umur) setelahnya.
+    Email/no. HP tidak disimpan, jadi sesi yang dilanjutkan di proses lain tidak membawanya: namanya
+    tercatat di `contact_lost` dan _contact_form memintanya lagi."""
+    sess = st.session_state.get("fawai")
+    if sess is None:
+        reg = _session_registry()
+        sid = str(st.query_params.get("sid", ""))
+        with reg["lock"]:
+            sess = reg["sessions"].get(sid) if sid else None
+        now = time.time()
+        if sess is None or sess.step == "done" or now - sess.last_seen > SESSION_RESUME_S:
+            sess = SessionData()
+            if _SESSION_ID_RE.fullmatch(sid):
+                resumed = SessionData(session_id=sid)
+                try:
+                    # sid tak dikenal/kedaluwarsa: sesi baru ber-id acak
+                    if resumed.reload() and resumed.step != "done" and now - resumed.saved_at <= SESSION_RESUME_S:
+                        sess = resumed
+                except get_session_backend().errors as e:
+                    trace_event("session_store_error", sid, error=f"{type(e).__name__}: {e}"[:300])
+            with reg["lock"]:
+                sess = reg["sessions"].setdefault(sess.session_id, sess)
+        st.session_state["fawai"] = sess
+        if sid != sess.session_id:
+            st.query_params["sid"] = sess.session_id
+    return sess
+
+def start_new_session() -> None:
+    """Lupakan sesi di browser ini (hapus ?sid= & state tersimpannya), mis. untuk siswa berikutnya."""
+    sess = st.session_state.pop("fawai", None)
+    st.session_state.pop("fawai_seen_version", None)
+    st.session_state.pop("fawai_chat_head", None)
+    st.query_params.pop("sid", None)
+    if sess is not None:
+        backend = get_session_backend()
+        try:
+            backend.delete(sess.session_id)
+        except backend.errors as e:
+            trace_event("session_store_error", sess.session_id, error=f"{type(e).__name__}: {e}"[:300])
+
+def commit_session(sess: SessionData) -> bool:
+    """Simpan state sesi bila berubah. False = run lain (tab/proses lain) menyimpan lebih dulu;
+    isi sesi sudah diganti versi terbaru itu. Backend tidak tersedia: sesi tetap jalan di memori."""
+    backend = get_session_backend()
+    try:
+        sess.commit()
+    except SessionConflict:
+        trace_event("session_conflict", sess.session_id)
+        try:
+            sess.reload()
+        except backend.errors:
+            pass
+        return False
+    except backend.errors as e:
+        trace_event("session_store_error", sess.session_id, error=f"{type(e).__name__}: {e}"[:300])
+    return True
+
+@contextmanager
+def session_scope() -> Iterator[SessionData]:
+    """Pegang sesi selama satu run (penuh atau fragment): dimuat dari backend bila sempat di-offload
+    atau bila run lain sudah menyimpan versi lebih baru, disimpan lagi di akhir run (juga saat st.rerun),
+    dan tidak bisa di-offload selama run berlangsung."""
+    sess = get_session()
+    backend = get_session_backend()
+    with sess.lock:
+        try:
+            if sess.offloaded:
+                ctx = get_script_run_ctx()
+                if not sess.reload() and ctx is not None and ctx.fragment_ids_this_run:
+                    st.rerun()  # state kedaluwarsa saat rerun fragment: rerun penuh agar form biodata tampil
+            else:
+                sess.refresh()
+        except backend.errors as e:
+            trace_event("session_store_error", sess.session_id, error=f"{type(e).__name__}: {e}"[:300])
+        sess.last_seen = time.time()
+        try:
+            yield sess
+        finally:
+            commit_session(sess)
+            # Per browser, bukan per SessionData: dua tab pada ?sid= yang sama di satu proses berbagi objek sesi
+            st.session_state["fawai_seen_version"] = sess.version
+    try:
+        _sweep_sessions(sess)
+    except backend.errors:
+        pass
 
 
 # ===============================================================
@@ -83,42 +765,103 @@ def _clean_md(s: str) -> str:
     s = re.sub(r"^\s*[-•]\s*", "- ", s, flags=re.MULTILINE)
     return s.strip()
 
+# Kata kunci heading -> kunci seksi. Dicocokkan sebagai awalan heading yang sudah dinormalisasi.
+_SECTION_HEADINGS: List[Tuple[str, str]] = [
+    ("ringkasan", "ringkasan"),
+    ("kemungkinan diagnosis", "diagnosis"),
+    ("diagnosis", "diagnosis"),
+    ("rencana", "rencana"),
+    ("saran", "rencana"),
+    ("edukasi", "edukasi"),
+    ("pencegahan", "edukasi"),
+    ("tanda bahaya", "bahaya"),
+    ("tanda darurat", "bahaya"),
+    ("red flag", "bahaya"),
+    ("kesimpulan", "lainnya"),
+    ("catatan", "lainnya"),
+]
+_HEADING_NUM_RE = re.compile(r"^\(?\d{1,2}[.)]\s*")
+_HEADING_PAREN_RE = re.compile(r"\([^()]{0,80}\)")
+_ITEM_NUM_RE = re.compile(r"^\d{1,3}[.)]\s*")
+_BULLET_RE = re.compile(r"^[-*•–](?!\*)\s")
+
+def _classify_heading(line: str) -> Tuple[str | None, int]:
+    """Kembalikan (kunci seksi, offset isi inline) bila baris adalah heading, else (None, 0).
+
+    Hanya memeriksa satu baris pendek, jadi total biaya parser tetap linear.
+    """
+    s = line.strip()
+    if not s or len(s) > 120 or _BULLET_RE.match(s):
+        return None, 0  # butir daftar ("- Saran: ...") selalu isi seksi, bukan heading
+    marked = s.startswith("#") or bool(_HEADING_NUM_RE.match(s))
+    s = s.lstrip("#").lstrip()
+    bold = s.startswith("**")
+    close = s.find("**", 2) if bold else -1
+    if bold:
+        head, rest = (s[2:close], s[close + 2:]) if close != -1 else (s[2:], "")
+    elif ":" in s:
+        head, rest = s.split(":", 1)
+    else:
+        head, rest = s, ""
+    rest = rest.strip(" \t\r\n:-–*")
+    if rest and not (marked or bold):
+        return None, 0  # baris biasa "Diagnosis banding: ..." adalah isi; heading polos harus berdiri sendiri
+    inline = line.rfind(rest) if rest else len(line)   # "**Diagnosis:** Flu" -> isi mulai di "Flu"
+
+    head = _HEADING_NUM_RE.sub("", head.strip(" *_:-–"))
+    head = " ".join(_HEADING_PAREN_RE.sub("", head).lower().split())
+    if head and len(head.split()) <= 6:
+        for prefix, key in _SECTION_HEADINGS:
+            if head.startswith(prefix):
+                return key, inline
+    return None, 0  # baris tebal lain (mis. nama diagnosis) adalah isi seksi yang sedang berjalan
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def parse_analysis_sections(text: str) -> Dict[str, Tuple[int, int]]:
+    """Pindai teks analisis SEKALI dan kembalikan span (awal, akhir) isi tiap seksi:
+    'ringkasan', 'diagnosis', 'bahaya', 'rencana', 'edukasi' (kemunculan pertama saja)."""
+    spans: Dict[str, Tuple[int, int]] = {}
+    current: str | None = None
+    body_start = 0
+    pos = 0
+    for line in text.splitlines(keepends=True):
+        key, inline = _classify_heading(line)
+        if key is not None:
+            if current and current not in spans:
+                spans[current] = (body_start, pos)
+            current = key
+            body_start = pos + inline
+        pos += len(line)
+    if current and current not in spans:
+        spans[current] = (body_start, pos)
+    spans.pop("lainnya", None)
+    return spans
+
+def _section_text(text: str, key: str) -> str:
+    span = parse_analysis_sections(text).get(key)
+    return text[span[0]:span[1]].strip() if span else ""
+
+@traced("extract_selected_sections")
 def extract_selected_sections(full_text: str) -> str:
     """
     Ambil hanya:
       1) Kemungkinan diagnosis
-      2) Rencana tindak lanjut & saran
-      3) Edukasi pencegahan
+      2) Tanda bahaya (red flag), bila ada – sama dengan StructuredAnalysis.selected_text()
+      3) Rencana tindak lanjut & saran
+      4) Edukasi pencegahan
     Toleran variasi heading.
     """
     text = full_text.strip()
-    patterns = {
-        "diagnosis": (
-            r"(?:^|\n)\s*(?:\*\*)?\s*(?:kemungkinan\s*diagnosis|diagnosis(?:\s*diferensial)?)"
-            r"\s*(?:\*\*)?\s*[:\-]?\s*\n(.*?)(?=\n\s*(?:\*\*)?\s*"
-            r"(?:rencana|saran|edukasi|pencegahan|kesimpulan|catatan)\b|$)"
-        ),
-        "plan": (
-            r"(?:^|\n)\s*(?:\*\*)?\s*(?:rencana\s*tindak\s*lanjut(?:\s*&\s*saran)?|"
-            r"rencana\s*tatalaksana|saran)\s*(?:\*\*)?\s*[:\-]?\s*\n(.*?)(?=\n\s*(?:\*\*)?\s*"
-            r"(?:edukasi|pencegahan|kemungkinan|diagnosis|kesimpulan|catatan)\b|$)"
-        ),
-        "edu": (
-            r"(?:^|\n)\s*(?:\*\*)?\s*(?:edukasi\s*pencegahan|pencegahan)\s*(?:\*\*)?\s*[:\-]?\s*\n"
-            r"(.*?)(?=\n\s*(?:\*\*)?\s*(?:rencana|saran|kemungkinan|diagnosis|kesimpulan|catatan)\b|$)"
-        ),
-    }
-
     out_parts = []
-    for title, pat in [
-        ("Kemungkinan Diagnosis", patterns["diagnosis"]),
-        ("Rencana Tindak Lanjut & Saran", patterns["plan"]),
-        ("Edukasi Pencegahan", patterns["edu"]),
+    for title, key in [
+        ("Kemungkinan Diagnosis", "diagnosis"),
+        ("Tanda Bahaya (segera ke fasilitas kesehatan)", "bahaya"),
+        ("Rencana Tindak Lanjut & Saran", "rencana"),
+        ("Edukasi Pencegahan", "edukasi"),
     ]:
-        m = re.search(pat, text, flags=re.IGNORECASE | re.DOTALL)
-        if m and m.group(1).strip():
-            content = _clean_md(m.group(1))
-            out_parts.append(f"{title}:\n{content.strip()}")
+        body = _section_text(text, key)
+        if body:
+            out_parts.append(f"{title}:\n{_clean_md(body)}")
 
     if not out_parts:
         fallback = _clean_md(text)
@@ -150,7 +893,6 @@ def send_email_via_sendgrid(to_email: str, subject: str, html_body: str, text_bo
         raise RuntimeError("SENDGRID_API_KEY / EMAIL_FROM belum di-set.")
     if not to_email:
         raise RuntimeError("Alamat email tujuan kosong.")
-    from sendgrid import SendGridAPIClient
     from sendgrid.helpers.mail import Mail
 
     message = Mail(
@@ -160,37 +902,50 @@ def send_email_via_sendgrid(to_email: str, subject: str, html_body: str, text_bo
         html_content=html_body,
         plain_text_content=text_body,
     )
-    sg = SendGridAPIClient(SENDGRID_API_KEY)
-    sg.send(message)
+    get_sendgrid_client(SENDGRID_API_KEY, SENDGRID_HOST).send(message)
 
 def send_sms_via_twilio(text_body: str, to_number: str) -> str:
     if not (TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN and TWILIO_FROM):
         raise RuntimeError("Kredensial Twilio belum lengkap (TWILIO_ACCOUNT_SID/AUTH_TOKEN/TWILIO_FROM).")
     if not to_number:
         raise RuntimeError("Nomor tujuan SMS kosong.")
-    from twilio.rest import Client as TwilioClient
-
-    t_client = TwilioClient(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+    t_client = get_twilio_client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN, TWILIO_API_BASE)
     msg = t_client.messages.create(from_=TWILIO_FROM, to=to_number, body=text_body)
     return msg.sid
 
+def _strip_parens(s: str) -> str:
+    out, depth = [], 0
+    for ch in s:
+        if ch == "(":
+            depth += 1
+        elif ch == ")" and depth:
+            depth -= 1
+        elif not depth:
+            out.append(ch)
+    return "".join(out)
+
+@traced("extract_diagnoses")
 def _extract_diagnoses_from_analysis(analysis_text: str) -> List[str]:
     """Ambil daftar diagnosis dari blok 'Kemungkinan Diagnosis'."""
-    pat = (
-        r"(?:^|\n)\s*\*\*?\s*(?:kemungkinan\s*diagnosis|diagnosis(?:\s*diferensial)?)\s*\*\*?\s*[:\-]?\s*\n"
-        r"(.*?)(?=\n\s*\*\*|\Z)"
-    )
-    m = re.search(pat, analysis_text, flags=re.IGNORECASE | re.DOTALL)
-    if not m:
+    block = _section_text(analysis_text.strip(), "diagnosis")
+    if not block:
         return []
 
-    block = m.group(1)
-    items = re.findall(r"(?:^\s*(?:[-•]|\d+\.)\s*)(.+)$", block, flags=re.MULTILINE)
     diagnoses: List[str] = []
-    for it in items:
-        it = re.sub(r"\s*\([^)]*\)", "", it)
-        it = re.sub(r"[:\-–].*$", "", it).strip()
-        diagnoses.append(it)
+    for ln in block.splitlines():
+        it = ln.strip()
+        if it[:1] in ("-", "•", "*") and not it.startswith("**"):
+            it = it[1:]
+        elif _ITEM_NUM_RE.match(it):
+            it = _ITEM_NUM_RE.sub("", it, count=1)
+        else:
+            continue
+        it = _strip_parens(it).replace("**", "")
+        for sep in (":", "-", "–"):
+            it = it.split(sep, 1)[0]
+        it = " ".join(it.split())
+        if it:
+            diagnoses.append(it)
     if not diagnoses:
         diagnoses = [ln.strip() for ln in block.splitlines() if ln.strip()]
 
@@ -202,6 +957,85 @@ def _extract_diagnoses_from_analysis(analysis_text: str) -> List[str]:
             out.append(d)
     return out
 
+OTC_RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "otc_rules.json")
+
+class KeywordMatcher:
+    """Automaton Aho-Corasick: semua kata kunci dicari dalam SATU lintasan teks.
+
+    Semantik sama dengan `kata in teks` (substring), tapi biaya pencocokan
+    tidak bertambah dengan jumlah aturan/kata kunci.
+    """
+
+    def __init__(self, keywords: List[Tuple[str, int]]) -> None:
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[Tuple[int, ...]] = [()]
+        for word, rule_idx in keywords:
+            state = 0
+            for ch in word.lower():
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto[state][ch] = nxt
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append(())
+                state = nxt
+            if rule_idx not in self._out[state]:
+                self._out[state] += (rule_idx,)
+        # BFS: hitung fail link & gabungkan output dari sufiks (anak root: fail = root)
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                f = self._fail[state]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                self._out[nxt] += tuple(r for r in self._out[self._fail[nxt]] if r not in self._out[nxt])
+
+    def find(self, text: str) -> Set[int]:
+        """Kembalikan himpunan indeks aturan yang kata kuncinya muncul di `text`."""
+        goto, fail, out = self._goto, self._fail, self._out
+        found: Set[int] = set()
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                found.update(out[state])
+        return found
+
+@st.cache_resource(show_spinner=False)
+def _get_otc_engine(path: str = OTC_RULES_PATH) -> Tuple[Dict[str, object], KeywordMatcher]:
+    """Muat tabel aturan OTC & kompilasi matcher sekali per proses."""
+    with open(path, "r", encoding="utf-8") as f:
+        table = json.load(f)
+    keywords = [(kw, i) for i, rule in enumerate(table["rules"]) for kw in rule["keywords"]]
+    return table, KeywordMatcher(keywords)
+
+@st.cache_resource(show_spinner=False, max_entries=256)
+def _render_otc(rule_ids: Tuple[int, ...]) -> Tuple[Tuple[str, ...], str, str]:
+    """Bullet + md + html untuk satu kombinasi aturan (di-cache per kombinasi)."""
+    table, _ = _get_otc_engine()
+    bullets: List[str] = []
+    for i in rule_ids:
+        bullets += table["rules"][i]["advice"]
+    bl = bullets[: int(table.get("max_bullets", 7))]
+    sf = table["safety"]
+    title = "Saran Obat OTC & Perawatan di Rumah"
+    md = "### " + title + "\n" + "\n".join(f"- {b}" for b in bl) + "\n\n" + "\n".join(f"- {s}" for s in sf)
+    li_bullets = "".join(f"<li>{i}</li>" for i in bl)
+    li_safety = "".join(f"<li>{i}</li>" for i in sf)
+    html = (
+        f"<h3 style='margin:0 0 8px'>{title}</h3>"
+        f"<ul style='margin:0 8px 8px 20px'>{li_bullets}</ul>"
+        f"<ul style='color:#444;margin:0 0 0 20px'>{li_safety}</ul>"
+    )
+    return tuple(bl), md, html
+
+@traced("suggest_otc_plan")
 def suggest_otc_plan(diagnoses: List[str], usia_tahun: int | str = 15, context_hint: str = "") -> Dict[str, object]:
     """Saran Obat OTC & Perawatan di Rumah (maks 7 poin)."""
     try:
@@ -209,148 +1043,1800 @@ def suggest_otc_plan(diagnoses: List[str], usia_tahun: int | str = 15, context_h
     except Exception:
         usia = 15
 
+    table, matcher = _get_otc_engine()
     pool = " ".join(diagnoses or []).lower() + " " + (context_hint or "").lower()
-    bullets: List[str] = []
+    rule_ids = tuple(sorted(matcher.find(pool)))  # urutan aturan = urutan di tabel
+    bullets, md, html = _render_otc(rule_ids)
+    return {
+        "title": "Saran Obat OTC & Perawatan di Rumah",
+        "bullets": list(bullets),
+        "safety": list(table["safety"]),
+        "md": md,
+        "html": html,
+    }
 
-    if any(k in pool for k in ["ruam", "kemerahan", "gatal", "biduran", "urtikaria", "dermatitis", "alergi kulit"]):
-        bullets += [
-            "Oles **hydrocortisone 1%** tipis 1–2×/hari (maks 7 hari; jangan pada luka/infeksi).",
-            "**Cetirizine 10 mg** atau **loratadine** 1×/hari untuk gatal.",
-            "**Lotion calamine** / **moisturizer hipoalergenik** secara rutin.",
-            "Hindari pemicu (sabun keras, pewangi, makanan/paparan yang dicurigai).",
-        ]
-    if any(k in pool for k in ["batuk berdahak", "dahak", "lendir", "bronkitis", "mukus"]):
-        bullets += [
-            "**Guaifenesin** sesuai label (ekspektoran).",
-            "Alternatif: **Bromhexine**/**Ambroxol**.",
-            "**Semprot saline** hidung + inhalasi uap hangat 2–3×/hari.",
-            "Madu 1 sdt sebelum tidur (khusus usia > 1 tahun).",
-            "Dekongestan lokal **oksimetazolin 0,05%** sebelum tidur, **maks 3 hari**.",
-        ]
-    if any(k in pool for k in ["batuk kering", "non produktif"]):
-        bullets += [
-            "**Dextromethorphan** bila batuk mengganggu tidur.",
-            "Hidrasi hangat, humidifier, dan permen pelega.",
-        ]
-    if any(k in pool for k in ["pilek", "hidung tersumbat", "flu", "rhinitis", "nasal congestion"]):
-        bullets += [
-            "**Semprot saline** rutin.",
-            "**Xylometazoline 0,1%** atau **Oxymetazoline 0,05%** sebelum tidur, **maks 3 hari**.",
-            "Jika alergi dominan: **cetirizine/loratadine** 1×/hari.",
-        ]
-    if any(k in pool for k in ["keseleo", "sprain", "strain", "terkilir", "tendinit"]):
-        bullets += [
-            "**RICE**: Rest, Ice 10–15 menit 3–4×/hari (48 jam pertama), Compression, Elevation.",
-            "Oles **gel diklofenak 1%** 3–4×/hari.",
-            "Gunakan penyangga sendi sementara; kembali ke aktivitas bertahap.",
-        ]
-    if any(k in pool for k in ["diare", "gastroenteritis", "mencret"]):
-        bullets += [
-            "**Oralit (ORS)** tiap BAB cair; minum sedikit tapi sering.",
-            "**Zinc** 10–20 mg/hari selama 10–14 hari (bila tersedia).",
-            "Hindari gorengan/pedas sementara; makan porsi kecil.",
-        ]
-    if any(k in pool for k in ["nyeri tenggorokan", "sakit tenggorokan", "faringitis", "radang tenggorokan"]):
-        bullets += [
-            "Kumur **air garam hangat** 3–4×/hari; pelega tenggorokan/lozenges.",
-            "Spray kumur antiseptik (mis. **povidone-iodine**) sesuai label.",
+
+# ===============================================================
+# Analisis Terstruktur (ANALYSIS_FORMAT=json)
+# ===============================================================
+_STR_LIST = {"type": "array", "items": {"type": "string"}}
+ANALYSIS_SCHEMA: Dict[str, object] = {
+    "type": "object",
+    "additionalProperties": False,
+    "required": ["summary", "diagnoses", "plan", "prevention", "red_flags"],
+    "properties": {
+        "summary": {"type": "string"},
+        "diagnoses": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "additionalProperties": False,
+                "required": ["name", "reason"],
+                "properties": {"name": {"type": "string"}, "reason": {"type": "string"}},
+            },
+        },
+        "plan": _STR_LIST,
+        "prevention": _STR_LIST,
+        "red_flags": _STR_LIST,
+    },
+}
+_JSON_TYPES = {"object": dict, "array": list, "string": str}
+
+def validate_schema(value: object, schema: Dict[str, object], path: str = "$") -> None:
+    """Validasi subset JSON Schema yang dipakai di sini (object/array/string, required,
+    additionalProperties=false). Melempar ValueError dengan path field yang salah."""
+    kind = str(schema["type"])
+    if not isinstance(value, _JSON_TYPES[kind]):
+        raise ValueError(f"{path}: harus {kind}")
+    if kind == "object":
+        props: Dict[str, Dict[str, object]] = schema.get("properties", {})  # type: ignore[assignment]
+        for key in schema.get("required", []):  # type: ignore[union-attr]
+            if key not in value:  # type: ignore[operator]
+                raise ValueError(f"{path}.{key}: wajib ada")
+        for key, item in value.items():  # type: ignore[union-attr]
+            if key not in props:
+                if schema.get("additionalProperties", True) is False:
+                    raise ValueError(f"{path}.{key}: field tidak dikenal")
+                continue
+            validate_schema(item, props[key], f"{path}.{key}")
+    elif kind == "array":
+        for i, item in enumerate(value):  # type: ignore[arg-type]
+            validate_schema(item, schema["items"], f"{path}[{i}]")  # type: ignore[arg-type]
+
+def _clean_items(items: List[str]) -> List[str]:
+    return [" ".join(i.split()) for i in items if i.strip()]
+
+@dataclass(slots=True)
+class Diagnosis:
+    name: str
+    reason: str
+
+@dataclass(slots=True)
+class StructuredAnalysis:
+    """Hasil analisis mode JSON. Tampilan markdown & email dirender dari field, bukan diparse ulang."""
+    summary: str
+    diagnoses: List[Diagnosis]
+    plan: List[str]
+    prevention: List[str]
+    red_flags: List[str]
+
+    @classmethod
+    def from_json(cls, text: str) -> "StructuredAnalysis":
+        """Parse & validasi respons model; ValueError bila bukan JSON sesuai ANALYSIS_SCHEMA."""
+        obj = json.loads(text)
+        validate_schema(obj, ANALYSIS_SCHEMA)
+        diagnoses = [Diagnosis(" ".join(d["name"].split()), d["reason"].strip())
+                     for d in obj["diagnoses"] if d["name"].strip()]
+        if not diagnoses:
+            raise ValueError("$.diagnoses: kosong")
+        return cls(obj["summary"].strip(), diagnoses, _clean_items(obj["plan"]),
+                   _clean_items(obj["prevention"]), _clean_items(obj["red_flags"]))
+
+    @property
+    def diagnosis_names(self) -> List[str]:
+        return [d.name for d in self.diagnoses]
+
+    @property
+    def clinical_text(self) -> str:
+        """Teks untuk pencocokan aturan OTC: ringkasan + diagnosis & alasannya. Rencana/edukasi
+        sengaja tidak ikut (menyebut penyakit lain, mis. '3M plus' untuk DBD)."""
+        return " ".join([self.summary] + [f"{d.name} {d.reason}" for d in self.diagnoses])
+
+    def _sections(self) -> List[Tuple[str, List[str]]]:
+        return [
+            ("Kemungkinan Diagnosis", [f"{d.name}: {d.reason}" if d.reason else d.name for d in self.diagnoses]),
+            ("Tanda Bahaya (segera ke fasilitas kesehatan)", self.red_flags),
+            ("Rencana Tindak Lanjut & Saran", self.plan),
+            ("Edukasi Pencegahan", self.prevention),
         ]
 
-    bullets = bullets[:7]
-    safety = [
-        "Selalu baca label & **ikuti dosis kemasan** (usia/berat).",
-        "Hentikan bila muncul reaksi alergi/ruam hebat/bengkak/napas sesak.",
-        "Ke IGD jika **red flag**: sesak berat, demam ≥39°C >3 hari, muntah terus, lemas/pingsan, nyeri hebat memburuk, perdarahan, kaku kuduk.",
-    ]
+    def to_markdown(self) -> str:
+        parts = [f"**Ringkasan Gejala**\n{self.summary}"]
+        parts += [f"**{title}**\n" + "\n".join(f"- {i}" for i in items) for title, items in self._sections() if items]
+        return "\n\n".join(parts)
 
-    def _md(title: str, bl: List[str], sf: List[str]) -> str:
-        return "### " + title + "\n" + "\n".join(f"- {b}" for b in bl) + "\n\n" + "\n".join(f"- {s}" for s in sf)
+    def selected_text(self) -> str:
+        """Padanan extract_selected_sections() untuk email (tanpa ringkasan)."""
+        return "\n\n".join(f"{title}:\n" + "\n".join(f"- {i}" for i in items)
+                           for title, items in self._sections() if items)
 
-    def _html(title: str, bl: List[str], sf: List[str]) -> str:
-        li_bullets = "".join(f"<li>{i}</li>" for i in bl)
-        li_safety = "".join(f"<li>{i}</li>" for i in sf)
-        return (
-            f"<h3 style='margin:0 0 8px'>{title}</h3>"
-            f"<ul style='margin:0 8px 8px 20px'>{li_bullets}</ul>"
-            f"<ul style='color:#444;margin:0 0 0 20px'>{li_safety}</ul>"
-        )
+def otc_from_analysis(analysis: str, structured: StructuredAnalysis | None, usia: int | str,
+                      last_answer: str) -> Tuple[List[str], Dict[str, object]]:
+    """Diagnosis + saran OTC: akses field langsung bila ada hasil terstruktur, else parser regex."""
+    if structured is not None:
+        diagnoses, hint = structured.diagnosis_names, structured.clinical_text
+    else:
+        diagnoses, hint = _extract_diagnoses_from_analysis(analysis), analysis
+    return diagnoses, suggest_otc_plan(diagnoses, usia, context_hint=(hint + " " + last_answer))
 
-    title = "Saran Obat OTC & Perawatan di Rumah"
-    return {"title": title, "bullets": bullets, "safety": safety, "md": _md(title, bullets, safety), "html": _html(title, bullets, safety)}
+
+# ===============================================================
+# Konteks Percakapan (kompaksi & budget token)
+# ===============================================================
+# Prompt sistem sengaja konstan (tidak berisi data siswa) agar prefix prompt identik
+# di setiap panggilan -> bisa kena prompt caching di sisi provider.
+_QUESTION_PROMPT_BASE = (
+    "Kamu adalah Dokter Spesialis, lulusan FK UI & S2 Johns Hopkins. "
+    "Lakukan anamnesis MEDIS TERSTRUKTUR, berbasis bukti, fokus penyakit umum tropis. "
+    "Pertanyaan lanjutan wajib berdasar jawaban terakhir dan relevansi klinis. "
+    "Boleh cek red flag (sesak berat, nyeri dada hebat, kejang, penurunan kesadaran, bibir/kuku membiru, perdarahan hebat) dengan pertanyaan spesifik. "
+)
+QUESTION_SYSTEM_PROMPT = _QUESTION_PROMPT_BASE + "KELUARAN: hanya SATU kalimat tanya paling diagnostik."
+# Mode wawancara adaptif: baris status dulu, agar keputusan berhenti bisa diambil sebelum pertanyaan di-stream
+QUESTION_STATUS_SYSTEM_PROMPT = _QUESTION_PROMPT_BASE + (
+    "KELUARAN dua baris. Baris 1 persis berformat 'SIAP=<0-100> BAHAYA=<ya/tidak>': SIAP = keyakinanmu (persen) "
+    "bahwa informasi sudah cukup untuk analisis akhir; BAHAYA=ya hanya bila jawaban siswa menunjukkan red flag. "
+    "Baris 2: hanya SATU kalimat tanya paling diagnostik."
+)
+ANALYSIS_SYSTEM_PROMPT = (
+    "Kamu adalah Dokter Spesialis lulusan FK UI dan S2 Johns Hopkins. "
+    "Lakukan analisis berbasis bukti dan buat diagnosis diferensial dari anamnesis. "
+    "Susun output dengan heading tebal: "
+    "(1) Ringkasan Gejala, (2) Kemungkinan Diagnosis (dengan alasan), "
+    "(3) Rencana Tindak Lanjut & Saran (spesifik), (4) Edukasi Pencegahan. "
+    "Hindari kepastian absolut; tandai red flag bila ada."
+)
+ANALYSIS_JSON_SYSTEM_PROMPT = (
+    "Kamu adalah Dokter Spesialis lulusan FK UI dan S2 Johns Hopkins. "
+    "Lakukan analisis berbasis bukti dan buat diagnosis diferensial dari anamnesis. "
+    "Jawab HANYA dengan objek JSON: summary (ringkasan gejala), "
+    "diagnoses (kemungkinan diagnosis, tiap item berisi name dan reason), "
+    "plan (rencana tindak lanjut & saran spesifik), prevention (edukasi pencegahan), "
+    "red_flags (tanda bahaya yang ditemukan atau perlu diwaspadai; kosong bila tidak ada). "
+    "Semua teks dalam Bahasa Indonesia. Hindari kepastian absolut."
+)
+PROMPT_VERSION = "2"  # naikkan bila template pesan user berubah (membatalkan cache respons)
+_TAG_RE = re.compile(r"<(script|style)\b.*?</\1\s*>|<[^>]{0,2000}>", re.IGNORECASE | re.DOTALL)
+
+def estimate_tokens(text: str) -> int:
+    """Estimasi kasar (~4 karakter/token) – cukup untuk menegakkan budget tanpa tokenizer."""
+    return len(text) // 4 + 1
+
+def _shorten(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(" ", 1)[0] + "…"
+
+def _compact_turn(q: str, a: str) -> str:
+    """Satu baris ringkasan klinis: pertanyaan dipendekkan, jawaban (fakta klinis) dipertahankan."""
+    return f"- {_shorten(q, 70)} → {_shorten(a, 240)}"
+
+def build_conversation_context(qa_pairs: List[Tuple[str, str]], budget_tokens: int,
+                               recent_turns: int | None = None) -> str:
+    """Susun konteks Q/A: giliran lama -> ringkasan klinis ringkas, giliran terakhir utuh.
+
+    Ringkasan bersifat append-only (giliran yang sudah diringkas tidak berubah), jadi
+    awal prompt tetap stabil antar giliran. Bila melebihi budget: jendela giliran utuh
+    diperkecil dulu, lalu baris ringkasan tertua dibuang (keluhan utama selalu disimpan).
+    """
+    qa = list(qa_pairs)
+    n_recent = min(len(qa), max(1, CONTEXT_RECENT_TURNS if recent_turns is None else recent_turns))
+    summary = [_compact_turn(q, a) for q, a in qa[: len(qa) - n_recent]]
+    recent = qa[len(qa) - n_recent:]
+    dropped = 0
+
+    def render() -> str:
+        parts = []
+        if summary:
+            head = "Ringkasan klinis jawaban sebelumnya:\n"
+            lines = summary if not dropped else summary[:1] + [f"- (… {dropped} jawaban lain diringkas)"] + summary[1:]
+            parts.append(head + "\n".join(lines))
+        parts.append("Berikut riwayat percakapan:\n" + "\n".join(f"Q: {q}\nA: {a}" for q, a in recent))
+        return "\n\n".join(parts)
+
+    out = render()
+    while estimate_tokens(out) > budget_tokens and len(recent) > 1:
+        q, a = recent.pop(0)
+        summary.append(_compact_turn(q, a))
+        out = render()
+    while estimate_tokens(out) > budget_tokens and len(summary) > 1:
+        summary.pop(1)
+        dropped += 1
+        out = render()
+    return out
+
+def compact_research(research_summary: str, budget_tokens: int) -> str:
+    """Buang tag/skrip HTML dan potong cuplikan riset agar muat di sisa budget."""
+    text = _TAG_RE.sub(" ", research_summary or "")
+    text = "\n".join(" ".join(ln.split()) for ln in text.splitlines() if ln.strip())
+    limit = max(0, budget_tokens) * 4
+    return text if len(text) <= limit else text[:limit].rsplit(" ", 1)[0] + "…"
+
+
+# ===============================================================
+# Cache Respons Model (SQLite, LRU + TTL)
+# ===============================================================
+@st.cache_resource(show_spinner=False)
+def llm_cache_stats() -> Dict[str, int]:
+    """Counter per proses: hits, misses, stores, evictions."""
+    return {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+def _llm_cache_conn() -> sqlite3.Connection:
+    conn = sqlite3.connect(os.path.join(CACHE_DIR, "llm_cache.sqlite3"), timeout=5, isolation_level=None)
+    conn.execute("PRAGMA synchronous=NORMAL")  # cache boleh hilang saat crash; hindari fsync per tulis
+    return conn
+
+@st.cache_resource(show_spinner=False)
+def _llm_cache_init() -> bool:
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        with closing(_llm_cache_conn()) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                " key TEXT PRIMARY KEY, helper TEXT NOT NULL, response TEXT NOT NULL,"
+                " created_at REAL NOT NULL, last_used REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_lru ON llm_cache(last_used)")
+        return True
+    except sqlite3.Error:
+        return False  # cache mati, aplikasi tetap jalan
+
+def _fold(text: str) -> str:
+    return " ".join(str(text).lower().split())
+
+def llm_cache_key(helper: str, system_prompt: str, qa_pairs: List[Tuple[str, str]], extra: str = "") -> str | None:
+    """Kunci cache: model + versi prompt + Q/A ternormalisasi. None bila helper/giliran ini tidak di-cache."""
+    if not qa_pairs or len(qa_pairs) > LLM_CACHE_TURNS.get(helper, 0):
+        return None
+    material = json.dumps(
+        [helper, OPENAI_MODEL, PROMPT_VERSION, system_prompt, [[_fold(q), _fold(a)] for q, a in qa_pairs], _fold(extra)],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+def llm_cache_get(key: str) -> str | None:
+    stats = llm_cache_stats()
+    if not _llm_cache_init():
+        return None
+    now = time.time()
+    try:
+        with closing(_llm_cache_conn()) as conn:
+            row = conn.execute(
+                "SELECT response FROM llm_cache WHERE key=? AND created_at>?", (key, now - LLM_CACHE_TTL_S)
+            ).fetchone()
+            if row is not None:
+                conn.execute("UPDATE llm_cache SET last_used=?, hits=hits+1 WHERE key=?", (now, key))
+    except sqlite3.Error:
+        row = None
+    stats["hits" if row is not None else "misses"] += 1
+    return row[0] if row is not None else None
+
+def llm_cache_drop(key: str) -> None:
+    """Hapus entri (mis. respons JSON yang ternyata tidak lolos validasi skema)."""
+    if not _llm_cache_init():
+        return
+    try:
+        with closing(_llm_cache_conn()) as conn:
+            conn.execute("DELETE FROM llm_cache WHERE key=?", (key,))
+    except sqlite3.Error:
+        pass
+
+def llm_cache_put(key: str, helper: str, response: str) -> None:
+    if not response or len(response) > LLM_CACHE_MAX_CHARS or not _llm_cache_init():
+        return
+    stats = llm_cache_stats()
+    now = time.time()
+    try:
+        with closing(_llm_cache_conn()) as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, helper, response, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+                (key, helper, response, now, now),
+            )
+            # Eviction: buang yang kedaluwarsa, lalu yang paling lama tidak dipakai di atas batas
+            cur = conn.execute("DELETE FROM llm_cache WHERE created_at<=?", (now - LLM_CACHE_TTL_S,))
+            evicted = cur.rowcount
+            cur = conn.execute(
+                "DELETE FROM llm_cache WHERE key IN "
+                "(SELECT key FROM llm_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (LLM_CACHE_MAX_ENTRIES,),
+            )
+            evicted += cur.rowcount
+    except sqlite3.Error:
+        return
+    stats["stores"] += 1
+    stats["evictions"] += max(0, evicted)
+
+
+# ===============================================================
+# Governor OpenAI (rate limit & backoff bersama semua sesi)
+# ===============================================================
+class LLMUnavailable(RuntimeError):
+    """Model tidak bisa dipanggil dalam tenggat (antrean penuh, 429/5xx berulang)."""
+
+class RateGovernor:
+    """Token bucket request/menit & token/menit untuk satu proses, dengan antrean adil.
+
+    - Antrean round-robin per sesi: satu sesi yang banyak memanggil (mis. batch) tidak
+      menyerobot giliran siswa lain; di dalam satu sesi urutannya FIFO.
+    - Sadar tenggat: penunggu menyerah begitu tenggatnya lewat (LLMUnavailable).
+    - Adaptif: 429 menahan semua penunggu sampai Retry-After dan memotong laju isi
+      ulang separuh; setiap sukses mengembalikannya perlahan (AIMD).
+    """
+
+    BURST_S = 10.0  # kapasitas bucket = jatah 10 detik, agar lonjakan satu kelas diratakan
+
+    def __init__(self, rpm: float, tpm: float) -> None:
+        self._cond = threading.Condition()
+        self._rates = (max(rpm, 1.0) / 60.0, max(tpm, 1.0) / 60.0)
+        self._caps = (max(1.0, self._rates[0] * self.BURST_S), max(1.0, self._rates[1] * self.BURST_S))
+        self._levels = list(self._caps)
+        self._refilled_at = time.monotonic()
+        self._factor = 1.0
+        self._cooldown_until = 0.0
+        self._queues: "OrderedDict[str, deque]" = OrderedDict()
+        self.stats = {"granted": 0, "throttled": 0, "retries": 0, "timeouts": 0, "wait_s": 0.0}
+
+    def _refill(self, now: float) -> None:
+        dt = now - self._refilled_at
+        self._refilled_at = now
+        for i in (0, 1):
+            self._levels[i] = min(self._caps[i], self._levels[i] + dt * self._rates[i] * self._factor)
+
+    def _head(self) -> object | None:
+        for q in self._queues.values():
+            return q[0]
+        return None
+
+    def _dequeue(self, key: str, ticket: object) -> None:
+        q = self._queues.get(key)
+        if q is None:
+            return
+        q.remove(ticket)
+        if q:
+            self._queues.move_to_end(key)  # sesi ini sudah dapat giliran -> ke belakang
+        else:
+            del self._queues[key]
+
+    def acquire(self, tokens: int, deadline: float, key: str = "-") -> float:
+        """Tunggu jatah 1 request + `tokens` token. Kembalikan lama menunggu (detik)."""
+        need = min(float(tokens), self._caps[1])
+        ticket = object()
+        t0 = time.monotonic()
+        with self._cond:
+            self._queues.setdefault(key, deque()).append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    wait_s: float | None = None  # None = tunggu giliran (notify)
+                    if self._head() is ticket:
+                        if now < self._cooldown_until:
+                            wait_s = self._cooldown_until - now
+                        elif self._levels[0] >= 1.0 and self._levels[1] >= need:
+                            self._levels[0] -= 1.0
+                            self._levels[1] -= need
+                            self._dequeue(key, ticket)
+                            self.stats["granted"] += 1
+                            self.stats["wait_s"] += now - t0
+                            self._cond.notify_all()
+                            return now - t0
+                        else:
+                            wait_s = max(
+                                (1.0 - self._levels[0]) / (self._rates[0] * self._factor),
+                                (need - self._levels[1]) / (self._rates[1] * self._factor),
+                                0.005,
+                            )
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self.stats["timeouts"] += 1
+                        raise LLMUnavailable("Antrean model terlalu panjang, coba lagi sebentar.")
+                    self._cond.wait(remaining if wait_s is None else min(wait_s, remaining))
+            except BaseException:
+                if ticket in self._queues.get(key, ()):
+                    self._dequeue(key, ticket)
+                    self._cond.notify_all()
+                raise
+
+    def settle(self, reserved: int, used: int) -> None:
+        """Kembalikan selisih token yang dipesan vs dipakai (usage sebenarnya)."""
+        with self._cond:
+            self._levels[1] = min(self._caps[1], self._levels[1] + min(float(reserved), self._caps[1]) - used)
+            self._cond.notify_all()
+
+    def on_throttled(self, retry_after: float) -> None:
+        with self._cond:
+            self.stats["throttled"] += 1
+            self._factor = max(0.1, self._factor * 0.5)
+            self._cooldown_until = max(self._cooldown_until, time.monotonic() + retry_after)
+
+    def on_success(self) -> None:
+        with self._cond:
+            self._factor = min(1.0, self._factor + 0.05)
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._cond:
+            self._refill(time.monotonic())
+            return {
+                "queue_depth": sum(len(q) for q in self._queues.values()),
+                "queue_sessions": len(self._queues),
+                "rate_factor": round(self._factor, 3),
+                "requests_available": round(self._levels[0], 2),
+                "tokens_available": round(self._levels[1]),
+                "granted_total": self.stats["granted"],
+                "throttled_total": self.stats["throttled"],
+                "retries_total": self.stats["retries"],
+                "queue_timeouts_total": self.stats["timeouts"],
+                "queue_wait_seconds_total": round(self.stats["wait_s"], 3),
+            }
+
+@st.cache_resource(show_spinner=False)
+def get_openai_governor() -> RateGovernor:
+    governor = RateGovernor(OPENAI_RPM, OPENAI_TPM)
+    get_tracer().register_gauges("openai_governor", governor.snapshot)
+    return governor
+
+def _retry_after(err: Exception) -> float | None:
+    response = getattr(err, "response", None)
+    try:
+        return max(0.0, float(response.headers.get("retry-after")))
+    except (AttributeError, TypeError, ValueError):
+        return None
+
+def _openai_create(timing: Dict[str, object], deadline: float | None = None, key: str | None = None,
+                   admission: "_Admission | None" = None, **kwargs: Any) -> Any:
+    """chat.completions.create lewat governor: antre adil, timeout sesuai sisa tenggat,
+    retry 429/5xx/koneksi dengan backoff eksponensial + jitter (atau Retry-After).
+    `deadline` = time.monotonic() absolut; default OPENAI_DEADLINE_S dari sekarang.
+    `key` = antrean governor (session_id); wajib diberikan bila dipanggil dari thread pool.
+    `admission` (opsional) dicatat setiap kali permintaan lolos/kembali ke antrean governor."""
+    governor = get_openai_governor()
+    deadline = time.monotonic() + OPENAI_DEADLINE_S if deadline is None else deadline
+    reserve = int(timing["est_prompt_tokens"]) + OPENAI_OUTPUT_RESERVE
+    key = key or _current_session_id() or "-"
+    timing["queue_wait_s"] = 0.0
+    attempt = 0
+    while True:
+        timing["queue_wait_s"] += governor.acquire(reserve, deadline, key)
+        if admission is not None:
+            if admission.cancelled:  # balapan sudah dimenangkan percobaan lain: jangan kirim, jangan pakai kuota
+                governor.settle(reserve, 0)
+                raise LLMUnavailable("Percobaan dibatalkan.")
+            admission.mark(time.monotonic())
+        remaining = deadline - time.monotonic()
+        try:
+            raw = openai_client.chat.completions.with_raw_response.create(timeout=max(1.0, min(OPENAI_TIMEOUT_S, remaining)), **kwargs)
+        except (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError) as e:
+            governor.settle(reserve, 0)
+            retry_after = _retry_after(e)
+            if isinstance(e, openai.RateLimitError):
+                governor.on_throttled(retry_after or 1.0)
+            attempt += 1
+            delay = retry_after if retry_after is not None else min(20.0, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5)
+            if attempt > OPENAI_MAX_RETRIES or time.monotonic() + delay >= deadline:
+                timing["retries"] = attempt - 1
+                raise LLMUnavailable(f"Model sedang sibuk ({type(e).__name__}), coba lagi sebentar.") from e
+            governor.stats["retries"] += 1
+            if admission is not None:
+                admission.mark(None)  # kembali antre: belum boleh di-hedge
+            time.sleep(delay)
+            continue
+        except Exception:
+            governor.settle(reserve, 0)
+            raise
+        governor.on_success()
+        timing["retries"] = attempt
+        timing["reserved_tokens"] = reserve
+        return raw
+
+@st.cache_resource(show_spinner=False)
+def _get_llm_pool() -> ThreadPoolExecutor:
+    """Thread untuk percobaan primer & hedge (masing-masing memblok sampai respons pertama)."""
+    return ThreadPoolExecutor(max_workers=64, thread_name_prefix="llm")
+
+@dataclass(slots=True)
+class _Admission:
+    """Status antrean satu percobaan: kapan lolos governor (None = masih antre), `changed` membangunkan
+    _llm_race, `cancelled` = sudah kalah balapan sehingga tidak dikirim lagi ke API."""
+    at: float | None = None
+    changed: threading.Event = field(default_factory=threading.Event)
+    cancelled: bool = False
+
+    def mark(self, at: float | None) -> None:
+        self.at = at
+        self.changed.set()
+
+def _llm_attempt(model: str, timing: Dict[str, object], deadline: float, key: str,
+                 kwargs: Dict[str, Any], admission: _Admission | None = None) -> Tuple[Any, List[Any]]:
+    """Satu percobaan sampai respons pertama: (respons, []) atau, untuk stream, (stream, chunk yang
+    sudah dibaca sampai token konten pertama)."""
+    resp = _openai_create(timing, deadline=deadline, key=key, admission=admission, model=model, **kwargs).parse()
+    head: List[Any] = []
+    if kwargs.get("stream"):
+        for chunk in resp:
+            head.append(chunk)
+            if chunk.choices and chunk.choices[0].delta.content:
+                break
+    return resp, head
+
+def _discard_attempt(timing: Dict[str, object], fut: Any) -> None:
+    """Percobaan yang kalah balapan: tutup stream-nya & kembalikan token yang dipesan ke governor."""
+    if fut.cancelled() or fut.exception() is not None:
+        return
+    resp, _ = fut.result()
+    usage = getattr(resp, "usage", None)
+    if hasattr(resp, "close"):
+        resp.close()
+    used = (usage.prompt_tokens + usage.completion_tokens) if usage is not None else int(timing["est_prompt_tokens"])
+    get_openai_governor().settle(int(timing.pop("reserved_tokens", 0)), used)
+
+def _llm_race(kwargs: Dict[str, Any], timing: Dict[str, object], deadline: float,
+              hedge_after_s: float) -> Tuple[Any, List[Any]]:
+    """Panggil OPENAI_MODEL; bila belum ada respons pertama `hedge_after_s` setelah primer lolos antrean
+    governor (atau primer gagal), kirim duplikat ke OPENAI_HEDGE_MODEL. Selama primer masih antre tidak ada
+    hedge: lambatnya karena antrean sendiri, dan duplikat hanya menambah antrean itu.
+    Yang pertama berhasil dipakai, sisanya ditutup.
+    LLMUnavailable bila tidak ada yang berhasil sebelum `deadline` (time.monotonic())."""
+    pool = _get_llm_pool()
+    backups = [OPENAI_HEDGE_MODEL] if OPENAI_HEDGE_MODEL else []
+    attempts: Dict[Any, Tuple[str, Dict[str, object], _Admission]] = {}
+    errors: List[BaseException] = []
+    # Diambil di thread pemanggil: ScriptRunContext Streamlit (atribut thread) tidak ikut ke thread pool,
+    # jadi tanpa ini semua siswa UI berbagi satu antrean governor
+    key = _current_session_id() or "-"
+    admission = _Admission()
+
+    def launch(model: str, gate: _Admission) -> None:
+        attempt_timing = dict(timing)
+        fut = pool.submit(contextvars.copy_context().run, _llm_attempt, model, attempt_timing, deadline, key,
+                          kwargs, gate)
+        fut.add_done_callback(lambda _f: admission.changed.set())
+        attempts[fut] = (model, attempt_timing, gate)
+
+    def abandon() -> None:
+        for fut, (_, attempt_timing, gate) in attempts.items():
+            gate.cancelled = True
+            fut.add_done_callback(functools.partial(_discard_attempt, attempt_timing))
+
+    launch(OPENAI_MODEL, admission)
+    while True:
+        admission.changed.clear()
+        for fut in [f for f in attempts if f.done()]:
+            model, attempt_timing, _ = attempts.pop(fut)
+            if fut.exception() is not None:
+                errors.append(fut.exception())
+                continue
+            abandon()
+            timing.update(attempt_timing, model=model)
+            return fut.result()
+        now = time.monotonic()
+        admitted_at = admission.at
+        hedge_at = admitted_at + hedge_after_s if admitted_at is not None else None
+        if backups and now < deadline and (not attempts or (hedge_at is not None and now >= hedge_at)):
+            launch(backups.pop(0), _Admission())
+            timing["hedged"] = True
+            continue
+        if not attempts or now >= deadline:
+            break
+        wake = min(deadline, hedge_at) if backups and hedge_at is not None else deadline
+        admission.changed.wait(timeout=max(0.0, wake - now))
+
+    abandon()
+    if errors and not isinstance(errors[0], (LLMUnavailable, openai.APIError)):
+        raise errors[0]
+    if errors and not attempts:
+        raise errors[-1]  # semua percobaan gagal sebelum tenggat: pakai alasan aslinya
+    raise LLMUnavailable("Model tidak merespons dalam tenggat, coba lagi sebentar.") from (errors[-1] if errors else None)
 
 
 # ===============================================================
 # Model Helpers (OpenAI)
 # ===============================================================
-def generate_next_question(qa_pairs: List[Tuple[str, str]]) -> str:
+def _record_llm_call(timing: Dict[str, object]) -> None:
+    if get_script_run_ctx(suppress_warning=True) is None:
+        return  # di luar sesi Streamlit (mis. skrip batch) tidak ada tempat menyimpan
+    get_session().llm_calls.append(timing)
+
+def _record_usage(timing: Dict[str, object], usage: Any) -> None:
+    if usage is None:
+        return
+    timing["prompt_tokens"] = usage.prompt_tokens
+    timing["completion_tokens"] = usage.completion_tokens
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", 0) or 0
+    timing["cached_tokens"] = cached
+    timing["cost_usd"] = round((
+        (usage.prompt_tokens - cached) * OPENAI_PRICE_INPUT
+        + cached * OPENAI_PRICE_CACHED
+        + usage.completion_tokens * OPENAI_PRICE_OUTPUT
+    ) / 1e6, 8)
+
+def _iter_stream_text(stream: Any, t0: float, timing: Dict[str, object], deadline: float | None = None) -> Iterator[str]:
+    for chunk in stream:
+        if deadline is not None and time.monotonic() > deadline:
+            raise LLMUnavailable("Respons model terlalu lama, coba lagi sebentar.")
+        if getattr(chunk, "usage", None) is not None:
+            _record_usage(timing, chunk.usage)  # chunk terakhir (stream_options.include_usage)
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta.content or ""
+        if delta:
+            if "ttft_s" not in timing:
+                timing["ttft_s"] = time.perf_counter() - t0
+            yield delta
+
+_STATUS_RE = re.compile(r"^\W*SIAP\s*[=:]\s*(\d{1,3})\W+BAHAYA\s*[=:]\s*(ya|tidak|yes|no)\b", re.IGNORECASE)
+
+_STATUS_TAIL_RE = re.compile(r"^[\s*_:;,.|)\]–—-]+")  # sisa markup/pemisah setelah status di baris yang sama
+
+def _status_stream_tail(first: str, chunks: Iterator[str]) -> Iterator[str]:
+    """Teruskan pertanyaan tanpa spasi awal; tidak ada isi bila model hanya menulis baris status."""
+    started = False
+    for piece in itertools.chain([first], chunks):
+        if not started:
+            piece = piece.lstrip()
+            if not piece:
+                continue
+            started = True
+        yield piece
+
+@dataclass(slots=True)
+class InterviewStatus:
+    """Sinyal dari baris pertama respons pertanyaan: `SIAP=<0-100> BAHAYA=<ya/tidak>`.
+    Bila baris itu tidak ada/tidak terbaca, seluruh respons dianggap pertanyaan (perilaku lama)."""
+    allow_ready: bool = True          # False sebelum INTERVIEW_MIN_QUESTIONS jawaban terkumpul
+    confidence: int | None = None     # None = baris status tidak terbaca
+    red_flag: bool = False
+
+    @property
+    def stop(self) -> bool:
+        """Wawancara cukup: ada red flag, atau model yakin dan batas minimal giliran terpenuhi."""
+        if self.confidence is None:
+            return False
+        return self.red_flag or (self.allow_ready and self.confidence >= INTERVIEW_READY_CONFIDENCE)
+
+    def parse(self, line: str) -> str | None:
+        """Baca status di awal baris; kembalikan sisa baris sesudahnya ('' bila tidak ada), None bila tidak terbaca."""
+        m = _STATUS_RE.match(line.strip())
+        if not m:
+            return None
+        self.confidence = min(100, int(m.group(1)))
+        self.red_flag = m.group(2).lower() in ("ya", "yes")
+        return _STATUS_TAIL_RE.sub("", line.strip()[m.end():])
+
+    def split(self, text: str) -> str:
+        """Pisahkan status dari respons lengkap; kembalikan pertanyaan ('' bila stop atau hanya ada status).
+        Pertanyaan boleh satu baris dengan status."""
+        head, nl, rest = text.partition("\n")
+        same_line = self.parse(head)
+        if same_line is None:
+            return text
+        if self.stop:
+            return ""
+        return (same_line + nl + rest).strip()
+
+    def split_stream(self, chunks: Iterator[str]) -> Iterator[str]:
+        """Versi stream dari split(): baca sampai baris pertama lengkap, sisanya diteruskan apa adanya."""
+        buf = ""
+        for piece in chunks:
+            buf += piece
+            if "\n" in buf:
+                break
+        head, nl, rest = buf.partition("\n")
+        same_line = self.parse(head)
+        if same_line is None:
+            return itertools.chain([buf], chunks)
+        if self.stop:
+            return iter(())
+        return _status_stream_tail(same_line + nl + rest, chunks)
+
+    def join(self, question: str) -> str:
+        """Kebalikan split(): bentuk yang disimpan di cache respons."""
+        if self.confidence is None:
+            return question
+        return f"SIAP={self.confidence} BAHAYA={'ya' if self.red_flag else 'tidak'}\n{question}"
+
+def _chat_completion(messages: List[Dict[str, str]], helper: str, stream_to: Any = None,
+                     cache_key: str | None = None, response_format: Dict[str, object] | None = None,
+                     status: InterviewStatus | None = None, deadline_s: float | None = None) -> str:
+    """Panggil model. Jika `stream_to` (container Streamlit, mis. st.chat_message) diberikan,
+    token ditulis ke sana begitu tiba; teks lengkap tetap dikembalikan.
+    Jika `cache_key` diberikan, respons dicari/disimpan di cache respons.
+    `response_format` (structured output) hanya untuk panggilan tanpa stream.
+    Jika `status` diberikan, baris status pertama dipisahkan (tidak ditampilkan/dikembalikan) dan
+    bila `status.stop` sisa respons tidak dibaca sama sekali.
+    Seluruh panggilan (antre, retry, hedge, stream) dibatasi `deadline_s` (default OPENAI_DEADLINE_S);
+    lewat tenggat -> LLMUnavailable."""
+    t0 = time.perf_counter()
+    deadline_s = OPENAI_DEADLINE_S if deadline_s is None else deadline_s
+    deadline = time.monotonic() + deadline_s
+    timing: Dict[str, object] = {
+        "helper": helper,
+        "stream": stream_to is not None,
+        "est_prompt_tokens": sum(estimate_tokens(m["content"]) for m in messages),
+    }
+    with trace_span(helper) as span:
+        if cache_key is not None:
+            cached = llm_cache_get(cache_key)
+            timing["cache"] = "hit" if cached is not None else "miss"
+            if cached is not None:
+                if status is not None:
+                    cached = status.split(cached)
+                if stream_to is not None and cached:
+                    stream_to.markdown(cached)
+                timing["ttft_s"] = timing["total_s"] = time.perf_counter() - t0
+                _record_llm_call(timing)
+                span.update(timing)
+                return cached
+        if stream_to is None:
+            extra = {"response_format": response_format} if response_format else {}
+            # Tanpa stream tidak ada "token pertama": hedge baru dikirim setelah separuh tenggat
+            resp, _ = _llm_race(dict(messages=messages, **extra), timing, deadline,
+                                max(OPENAI_HEDGE_AFTER_S, deadline_s / 2))
+            text = resp.choices[0].message.content or ""
+            timing["ttft_s"] = time.perf_counter() - t0
+            _record_usage(timing, resp.usage)
+            if status is not None:
+                text = status.split(text)
+        else:
+            stream, head = _llm_race(dict(messages=messages, stream=True, stream_options={"include_usage": True}),
+                                     timing, deadline, OPENAI_HEDGE_AFTER_S)
+            try:
+                chunks = _iter_stream_text(itertools.chain(head, stream), t0, timing, deadline)
+                if status is not None:
+                    chunks = status.split_stream(chunks)
+                if status is not None and status.stop:
+                    text = ""
+                else:
+                    with stream_to:
+                        out = st.write_stream(chunks, cursor="▌")
+                    text = out if isinstance(out, str) else "".join(str(o) for o in out)
+            except BaseException:
+                stream.close()
+                get_openai_governor().settle(int(timing.pop("reserved_tokens", 0)), int(timing["est_prompt_tokens"]))
+                raise
+            if status is not None and status.stop:
+                stream.close()  # pertanyaan tidak dipakai: hentikan generasi, hemat token output
+        if status is not None:
+            timing.update(confidence=status.confidence, red_flag=status.red_flag)
+        used = int(timing.get("prompt_tokens", 0)) + int(timing.get("completion_tokens", 0))
+        get_openai_governor().settle(int(timing.pop("reserved_tokens")), used or int(timing["est_prompt_tokens"]))
+        timing["total_s"] = time.perf_counter() - t0
+        _record_llm_call(timing)
+        span.update(timing)
+    if cache_key is not None and (text.strip() or (status is not None and status.stop)):
+        llm_cache_put(cache_key, helper, status.join(text.strip()) if status is not None else text.strip())
+    return text.strip()
+
+def generate_next_question(qa_pairs: List[Tuple[str, str]], stream_to: Any = None,
+                           status: InterviewStatus | None = None) -> str:
+    """Pertanyaan lanjutan. Dengan `status` (wawancara adaptif) model juga menilai kesiapan & red flag;
+    hasilnya diisikan ke `status` dan bila `status.stop` tidak ada pertanyaan (string kosong).
+    Bila model gagal/terlambat (QUESTION_DEADLINE_S), dipakai pertanyaan dari bank standar.
+    Giliran awal yang jalurnya umum dilayani dari graf triase tanpa memanggil model."""
+    question = triage_next_question(qa_pairs)
+    if question is not None:
+        if status is not None:
+            status.confidence = None  # graf tidak menilai kesiapan: wawancara berlanjut
+        if stream_to is not None:
+            stream_to.markdown(question)
+        return question
+    system_prompt = QUESTION_STATUS_SYSTEM_PROMPT if status is not None else QUESTION_SYSTEM_PROMPT
     messages = [
-        {
-            "role": "system",
-            "content": (
-                "Kamu adalah Dokter Spesialis, lulusan FK UI & S2 Johns Hopkins. "
-                "Lakukan anamnesis MEDIS TERSTRUKTUR, berbasis bukti, fokus penyakit umum tropis. "
-                "Pertanyaan lanjutan wajib berdasar jawaban terakhir dan relevansi klinis. "
-                "Boleh cek red flag (sesak berat, nyeri dada hebat, kejang, penurunan kesadaran, bibir/kuku membiru, perdarahan hebat) dengan pertanyaan spesifik. "
-                "KELUARAN: hanya SATU kalimat tanya paling diagnostik."
-            ),
-        },
-        {
-            "role": "user",
-            "content": "Berikut riwayat percakapan:\n" + "\n".join([f"Q: {q}\nA: {a}" for q, a in qa_pairs]),
-        },
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": build_conversation_context(qa_pairs, QUESTION_PROMPT_BUDGET)},
     ]
-    resp = openai_client.chat.completions.create(model=OPENAI_MODEL, messages=messages)
-    return (resp.choices[0].message.content or "").strip()
+    cache_key = llm_cache_key("generate_next_question", system_prompt, qa_pairs)
+    try:
+        question = _chat_completion(messages, "generate_next_question", stream_to, cache_key, status=status,
+                                    deadline_s=QUESTION_DEADLINE_S)
+    except (LLMUnavailable, openai.APIError) as e:
+        trace_event("question_fallback", error=f"{type(e).__name__}: {e}"[:300])
+        if status is not None:
+            status.confidence = None  # sinyal model tidak ada: jangan berhenti karena respons yang gagal
+        return fallback_question(qa_pairs)
+    if not question and not (status is not None and status.stop):
+        # Model hanya menulis baris status (atau respons kosong): jangan tampilkan/simpan teks status
+        trace_event("question_fallback", error="respons tanpa pertanyaan")
+        question = fallback_question(qa_pairs)
+        if stream_to is not None:
+            stream_to.markdown(question)
+    return question
+
+# Bank pertanyaan anamnesis standar untuk saat model tidak menjawab dalam tenggat.
+# (pertanyaan, kata kunci topik): dilewati bila sudah ditanyakan atau topiknya sudah muncul di jawaban siswa.
+FALLBACK_QUESTIONS: Tuple[Tuple[str, Tuple[str, ...]], ...] = (
+    ("Sejak kapan keluhan ini mulai dirasakan, dan apakah makin berat, membaik, atau hilang timbul?",
+     ("sejak", "hari", "minggu", "kemarin", "tadi")),
+    ("Apakah ada demam? Jika ya, berapa suhu tertinggi dan sudah berapa hari?", ("demam", "panas", "suhu")),
+    ("Apakah ada batuk, pilek, sakit tenggorokan, atau sesak napas?", ("batuk", "pilek", "tenggorokan", "sesak")),
+    ("Apakah ada mual, muntah, diare, atau nyeri perut?", ("mual", "muntah", "diare", "mencret", "perut")),
+    ("Apakah ada sakit kepala, nyeri otot atau sendi? Di bagian mana tepatnya?", ("kepala", "otot", "sendi", "pusing")),
+    ("Apakah ada ruam, bintik merah, gatal, mimisan, atau gusi berdarah?", ("ruam", "bintik", "gatal", "mimisan", "darah")),
+    ("Apakah masih bisa makan dan minum seperti biasa, dan buang air kecil lancar?", ("makan", "minum", "kencing")),
+    ("Apakah sudah minum obat untuk keluhan ini? Jika ya, obat apa dan bagaimana hasilnya?", ("obat", "parasetamol", "paracetamol")),
+    ("Apakah ada teman sekelas atau anggota keluarga dengan keluhan serupa?", ("teman", "keluarga", "adik", "kakak", "serupa")),
+    ("Apakah Anda punya riwayat alergi, asma, atau penyakit lain yang sering kambuh?", ("alergi", "asma", "riwayat")),
+    ("Apakah keluhan ini mengganggu tidur, sekolah, atau aktivitas sehari-hari?", ("tidur", "sekolah", "aktivitas")),
+    ("Apakah ada hal lain yang ingin Anda ceritakan tentang keluhan ini?", ()),
+)
 
-def fetch_research_summary() -> str:
-    """Ambil cuplikan dari sumber resmi (best-effort, offline fallback aman)."""
+def fallback_question(qa_pairs: List[Tuple[str, str]]) -> str:
+    """Pertanyaan standar berikutnya yang belum ditanyakan, utamakan topik yang belum disinggung."""
+    asked = {_fold(q) for q, _ in qa_pairs}
+    answers = _fold(" ".join(a for _, a in qa_pairs))
+    remaining = [(q, kws) for q, kws in FALLBACK_QUESTIONS if _fold(q) not in asked]
+    for question, keywords in remaining:
+        if not any(k in answers for k in keywords):
+            return question
+    return remaining[0][0] if remaining else FALLBACK_QUESTIONS[-1][0]
+
+# ===============================================================
+# Graf Triase (pertanyaan awal dari transkrip lampau, tanpa model)
+# ===============================================================
+# Keluhan kanonik -> istilah (keluaran _index_terms). Node graf dikunci keluhan dari jawaban pertama.
+COMPLAINT_TERMS: Dict[str, Tuple[str, ...]] = {
+    "demam": ("demam", "panas", "meriang", "menggigil", "suhu"),
+    "batuk": ("batuk", "dahak", "berdahak"),
+    "pilek": ("pilek", "flu", "ingus", "hidung", "bersin"),
+    "tenggorokan": ("tenggorokan", "menelan", "radang"),
+    "kepala": ("kepala", "pusing", "migrain"),
+    "diare": ("diare", "mencret", "bab"),
+    "mual": ("mual", "muntah", "eneg"),
+    "perut": ("perut", "maag", "lambung", "ulu"),
+    "kulit": ("ruam", "bintik", "gatal", "bentol", "kulit", "jerawat"),
+    "haid": ("haid", "menstruasi", "mens", "kram"),
+    "sesak": ("sesak", "napas", "nafas", "mengi", "asma"),
+    "mata": ("mata", "belek"),
+    "cedera": ("keseleo", "terkilir", "jatuh", "memar", "luka", "bengkak"),
+    "lemas": ("lemas", "lelah", "capek", "lesu", "letih"),
+    "gigi": ("gigi", "gusi"),
+    "telinga": ("telinga", "kuping"),
+}
+_COMPLAINT_OF = {term: c for c, terms in COMPLAINT_TERMS.items() for term in terms}
+# Jawaban yang menyebut istilah ini (termasuk "tidak sesak") selalu dinilai model, bukan graf
+_TRIAGE_RED_FLAGS = frozenset("sesak kejang pingsan darah berdarah mimisan biru lumpuh kaku lemah".split())
+TRIAGE_MATCH_JACCARD = 0.6  # kemiripan istilah minimal agar dua pertanyaan dianggap node yang sama
+
+def complaint_key(answer: str) -> str:
+    """Dua keluhan kanonik pertama yang disebut siswa, urut abjad (mis. 'batuk+demam'); 'lain' bila tak dikenali."""
+    found = list(dict.fromkeys(_COMPLAINT_OF[t] for t in _index_terms(answer) if t in _COMPLAINT_OF))
+    return "+".join(sorted(found[:2])) or "lain"
+
+def answer_class(answer: str) -> str:
+    """'t' untuk penyangkalan, 'y' selain itu: cabang keputusan di graf."""
+    return "t" if is_negative_answer(answer) else "y"
+
+def question_terms(question: str) -> frozenset:
+    return frozenset(_index_terms(question))
+
+def term_similarity(a: frozenset, b: frozenset) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+def triage_node_key(complaint: str, steps: List[Tuple[int, str]]) -> str:
+    """Kunci node: keluhan + jalur (id pertanyaan, kelas jawaban), mis. 'batuk+demam|3y|7t'."""
+    return "|".join([complaint] + [f"{qid}{cls}" for qid, cls in steps])
+
+class TriageGraph:
+    """Graf keputusan hasil build_triage_graph.py dalam bentuk ringkas untuk lookup O(1).
+
+    Setiap node hanya menyimpan cabang terbanyak: (id pertanyaan, keyakinan = porsi cabang, jumlah transkrip).
+    Pertanyaan dicocokkan ke node lewat teks persis atau kemiripan istilah (indeks terbalik).
+    """
+    __slots__ = ("questions", "best", "_exact", "_terms", "_postings")
+
+    def __init__(self, data: Dict[str, Any]) -> None:
+        self.questions: List[str] = [q["text"] for q in data["questions"]]
+        self._terms = [frozenset(q["terms"]) for q in data["questions"]]
+        self._exact = {_fold(text): i for i, text in enumerate(self.questions)}
+        self._postings: Dict[str, List[int]] = {}
+        for i, terms in enumerate(self._terms):
+            for t in terms:
+                self._postings.setdefault(t, []).append(i)
+        self.best: Dict[str, Tuple[int, float, int]] = {}
+        for key, edges in data["nodes"].items():
+            support = sum(n for _, n in edges)
+            qid, n = max(edges, key=lambda e: e[1])
+            self.best[key] = (int(qid), n / support, support)
+
+    def match(self, question: str) -> int | None:
+        qid = self._exact.get(_fold(question))
+        if qid is not None:
+            return qid
+        terms = question_terms(question)
+        candidates = {i for t in terms for i in self._postings.get(t, ())}
+        scored = max(((term_similarity(terms, self._terms[i]), i) for i in candidates), default=(0.0, None))
+        return scored[1] if scored[0] >= TRIAGE_MATCH_JACCARD else None
+
+    def node_key(self, qa_pairs: List[Tuple[str, str]]) -> str | None:
+        """None bila ada pertanyaan di jalur yang tidak dikenal graf (cabang jarang -> model)."""
+        steps = []
+        for q, a in qa_pairs[1:]:  # pertanyaan pembuka selalu sama
+            qid = self.match(q)
+            if qid is None:
+                return None
+            steps.append((qid, answer_class(a)))
+        return triage_node_key(complaint_key(qa_pairs[0][1]), steps)
+
+@st.cache_resource(show_spinner=False)
+def get_triage_graph(path: str = TRIAGE_GRAPH_PATH) -> TriageGraph | None:
+    """Graf dimuat sekali per proses (restart aplikasi setelah membangun ulang); None bila belum ada."""
     try:
-        sources = [
-            "https://www.who.int/health-topics/dengue-and-severe-dengue",
-            "https://www.cdc.gov/dengue/index.html",
-            "https://www.cdc.gov/malaria/index.html",
-            "https://www.idai.or.id/",
-            "https://www.kemkes.go.id/",
-        ]
+        with open(path, "r", encoding="utf-8") as f:
+            return TriageGraph(json.load(f))
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        trace_event("triage_graph_error", error=f"{type(e).__name__}: {e}"[:300])
+        return None
+
+def triage_next_question(qa_pairs: List[Tuple[str, str]]) -> str | None:
+    """Pertanyaan berikutnya dari graf bila node cukup yakin & didukung cukup transkrip; None = tanya model."""
+    if not qa_pairs or len(qa_pairs) > TRIAGE_MAX_TURNS:
+        return None
+    graph = get_triage_graph()
+    if graph is None or any(_TRIAGE_RED_FLAGS.intersection(_index_terms(a)) for _, a in qa_pairs):
+        return None
+    with trace_span("triage_graph", turns=len(qa_pairs)) as span:
+        key = graph.node_key(qa_pairs)
+        hit = graph.best.get(key) if key is not None else None
+        span.update(node=key, hit=False)
+        if hit is None or hit[1] < TRIAGE_MIN_CONFIDENCE or hit[2] < TRIAGE_MIN_SUPPORT:
+            return None
+        question = graph.questions[hit[0]]
+        if any(_fold(q) == _fold(question) for q, _ in qa_pairs):
+            return None
+        span.update(hit=True, confidence=round(hit[1], 3), support=hit[2])
+        return question
+
+RESEARCH_SOURCES = [
+    u.strip() for u in (get_secret("RESEARCH_SOURCES", "") or "").split(",") if u.strip()
+] or [
+    "https://www.who.int/health-topics/dengue-and-severe-dengue",
+    "https://www.cdc.gov/dengue/index.html",
+    "https://www.cdc.gov/malaria/index.html",
+    "https://www.idai.or.id/",
+    "https://www.kemkes.go.id/",
+]
+RESEARCH_SNIPPET_CHARS = 1500
+
+@st.cache_resource(show_spinner=False)
+def _get_research_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=len(RESEARCH_SOURCES), thread_name_prefix="riset")
+
+@st.cache_resource(show_spinner=False)
+def _research_memo() -> Tuple[Dict[str, Dict[str, object]], threading.Lock]:
+    """Lapisan memori di depan cache disk (url -> entri)."""
+    return {}, threading.Lock()
+
+@st.cache_resource(show_spinner=False)
+def _research_failures() -> Dict[str, float]:
+    """url -> waktu gagal terakhir; sumber yang sedang down tidak ditunggu di tiap analisis."""
+    return {}
+
+def _research_cache_path(url: str) -> str:
+    return os.path.join(CACHE_DIR, "research", hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+def _research_cache_load(url: str) -> Dict[str, object] | None:
+    memo, lock = _research_memo()
+    with lock:
+        if url in memo:
+            return memo[url]
+    try:
+        with open(_research_cache_path(url), "r", encoding="utf-8") as f:
+            entry = json.load(f)
+    except Exception:
+        return None
+    with lock:
+        memo[url] = entry
+    return entry
+
+def _research_cache_store(url: str, entry: Dict[str, object]) -> None:
+    memo, lock = _research_memo()
+    with lock:
+        memo[url] = entry
+    path = _research_cache_path(url)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp, path)  # atomik: pembaca tidak pernah melihat file setengah jadi
+    except OSError:
+        pass  # cache disk bersifat best-effort
+
+def _fetch_research_source(url: str, cached: Dict[str, object] | None, timeout: float,
+                           session_id: str | None = None) -> Dict[str, object] | None:
+    """GET bersyarat (ETag/Last-Modified). Hasil langsung disimpan ke cache,
+    jadi fetch yang selesai setelah tenggat tetap menghangatkan cache untuk siswa berikutnya."""
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = str(cached["etag"])
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = str(cached["last_modified"])
+    with trace_span("research_fetch", session_id, url=url) as span:
+        try:
+            resp = get_http_session().get(url, headers=headers, timeout=timeout)
+        except Exception as e:
+            _research_failures()[url] = time.time()
+            span.update(outcome="error", error=f"{type(e).__name__}: {e}"[:300])
+            return None
+        span["status"] = resp.status_code
+        if resp.status_code == 304 and cached:
+            entry = dict(cached, fetched_at=time.time())
+            span["outcome"] = "not_modified"
+        elif resp.ok:
+            entry = {
+                "url": url,
+                "fetched_at": time.time(),
+                "etag": resp.headers.get("ETag"),
+                "last_modified": resp.headers.get("Last-Modified"),
+                "snippet": resp.text[:RESEARCH_SNIPPET_CHARS],
+            }
+        else:
+            _research_failures()[url] = time.time()
+            span["outcome"] = "error"
+            return None
+    _research_failures().pop(url, None)
+    _research_cache_store(url, entry)
+    return entry
+
+def fetch_research_summary(deadline_s: float | None = None, session_id: str | None = None) -> str:
+    """Ambil cuplikan dari sumber resmi (best-effort, offline fallback aman).
+
+    Sumber yang masih segar di cache tidak di-fetch ulang; sisanya di-fetch paralel
+    dengan satu tenggat total. Sumber yang gagal/terlambat memakai cache lama bila ada.
+    """
+    deadline = RESEARCH_DEADLINE_S if deadline_s is None else deadline_s
+    session_id = session_id or _current_session_id()
+    with trace_span("fetch_research_summary", session_id) as span:
+        now = time.time()
+        entries: Dict[str, Dict[str, object] | None] = {}
+        pending = {}
+        failures = _research_failures()
+        for url in RESEARCH_SOURCES:
+            cached = _research_cache_load(url)
+            entries[url] = cached
+            if cached and now - float(cached.get("fetched_at", 0)) < RESEARCH_TTL_S:
+                continue
+            if now - failures.get(url, 0.0) < RESEARCH_RETRY_S:
+                continue
+            pending[_get_research_pool().submit(_fetch_research_source, url, cached, deadline, session_id)] = url
+
+        late = 0
+        if pending:
+            done, _ = wait(pending, timeout=deadline)
+            late = len(pending) - len(done)
+            for fut in done:
+                fresh = fut.result()  # satu sumber gagal tidak menjatuhkan sumber lain
+                if fresh:
+                    entries[pending[fut]] = fresh
+        span.update(sources=len(RESEARCH_SOURCES), fetched=len(pending), late=late)
+
         summary = ""
-        for url in sources:
-            resp = requests.get(url, timeout=10)
-            if resp.ok:
-                text_snippet = resp.text[:1500]
-                summary += f"Sumber: {url}\nCuplikan: {text_snippet}\n\n"
+        for url in RESEARCH_SOURCES:
+            entry = entries.get(url)
+            if entry and entry.get("snippet"):
+                summary += f"Sumber: {url}\nCuplikan: {entry['snippet']}\n\n"
         return summary or "Tidak ada ringkasan yang dapat diambil saat ini."
-    except Exception:
-        return "Tidak dapat mengambil ringkasan riset saat ini."
 
-def analyze_health(bio: Dict[str, str], qa_pairs: List[Tuple[str, str]], research_summary: str) -> str:
+# ===============================================================
+# Indeks Pedoman Lokal (BM25, postings di-mmap)
+# ===============================================================
+GUIDELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "guidelines.json")
+_WORD_RE = re.compile(r"[a-z0-9]+")
+_STOPWORDS = frozenset("""
+    ada adalah agak akan aku anda apa apakah atau bagaimana banyak bawah beberapa belum berapa bila bisa boleh
+    dalam dan dari dengan di dia hanya harus ini itu jadi jika juga kadang kalau kami kamu karena ke kecuali
+    kemudian kok lagi lalu lebih mana masih mau maupun mereka misalnya nya oleh pada para pernah pun saat saja
+    sama sampai sangat saya se sebelum sedang sejak selain sementara semua sering setelah sih sudah supaya
+    tapi tentu terasa tersebut tetapi tidak untuk yang ya yg gak nggak enggak aja dong deh kah lah
+""".split())
+_NEGATIVE_ANSWERS = frozenset(("tidak", "nggak", "gak", "enggak", "belum", "tdk", "no"))
+
+def is_negative_answer(answer: str) -> bool:
+    """Penyangkalan bila kata pertama jawaban adalah kata negatif ('no, ...' ya; 'normal'/'nonstop' tidak)."""
+    m = _WORD_RE.search(answer.lower())
+    return m is not None and m.group() in _NEGATIVE_ANSWERS
+
+def _index_terms(text: str) -> List[str]:
+    """Token huruf kecil tanpa kata umum; akhiran -nya/-lah/-kah dipangkas (stemming ringan)."""
+    out = []
+    for w in _WORD_RE.findall(text.lower()):
+        for suffix in ("nya", "lah", "kah"):
+            if len(w) > len(suffix) + 3 and w.endswith(suffix):
+                w = w[: -len(suffix)]
+                break
+        if w not in _STOPWORDS and len(w) > 1:
+            out.append(w)
+    return out
+
+class GuidelineIndex:
+    """Inverted index BM25 atas potongan pedoman. Postings (doc_id, tf) berupa uint32 di file
+    yang di-mmap; kamus term & panjang dokumen kecil dan disimpan di JSON pendamping."""
+
+    K1, B = 1.2, 0.75
+
+    def __init__(self, passages: List[Dict[str, str]], index_dir: str, source_hash: str) -> None:
+        self.passages = passages
+        base = os.path.join(index_dir, f"{source_hash}-{sys.byteorder}")
+        if not os.path.exists(base + ".json"):
+            self._build(base)
+        with open(base + ".json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.terms: Dict[str, Tuple[int, int]] = {t: (o, d) for t, (o, d) in meta["terms"].items()}
+        self.doc_len: List[int] = meta["doc_len"]
+        self.avgdl = max(1.0, sum(self.doc_len) / max(1, len(self.doc_len)))
+        with open(base + ".postings", "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._postings = memoryview(self._mm).cast("I")
+
+    def _build(self, base: str) -> None:
+        postings: Dict[str, List[Tuple[int, int]]] = defaultdict(list)
+        doc_len = []
+        for doc_id, p in enumerate(self.passages):
+            # Judul ikut diindeks (dua kali: bobot lebih) karena memuat nama penyakit
+            counts = Counter(_index_terms(f"{p['title']} {p['title']} {p['text']}"))
+            doc_len.append(sum(counts.values()))
+            for term, tf in counts.items():
+                postings[term].append((doc_id, tf))
+        flat = array("I")
+        terms = {}
+        for term in sorted(postings):
+            terms[term] = (len(flat), len(postings[term]))
+            for doc_id, tf in postings[term]:
+                flat.extend((doc_id, tf))
+        os.makedirs(os.path.dirname(base), exist_ok=True)
+        tmp = f"{base}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            flat.tofile(f)
+        os.replace(tmp, base + ".postings")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"terms": terms, "doc_len": doc_len}, f)
+        os.replace(tmp, base + ".json")  # JSON terakhir: penanda indeks lengkap
+
+    def search(self, query_terms: List[str], k: int) -> List[Tuple[float, int]]:
+        n = len(self.doc_len)
+        scores: Dict[int, float] = defaultdict(float)
+        for term in set(query_terms):
+            entry = self.terms.get(term)
+            if entry is None:
+                continue
+            offset, df = entry
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            for i in range(offset, offset + 2 * df, 2):
+                doc_id, tf = self._postings[i], self._postings[i + 1]
+                norm = tf + self.K1 * (1 - self.B + self.B * self.doc_len[doc_id] / self.avgdl)
+                scores[doc_id] += idf * tf * (self.K1 + 1) / norm
+        return sorted(((sc, d) for d, sc in scores.items()), reverse=True)[:k]
+
+@st.cache_resource(show_spinner=False)
+def get_guideline_index(path: str = GUIDELINES_PATH) -> GuidelineIndex:
+    """Muat pedoman & buka indeksnya sekali per proses (dibangun ulang otomatis bila file berubah)."""
+    with open(path, "rb") as f:
+        raw = f.read()
+    passages = json.loads(raw.decode("utf-8"))["passages"]
+    return GuidelineIndex(passages, os.path.join(CACHE_DIR, "guidelines"), hashlib.sha1(raw).hexdigest()[:16])
+
+def _guideline_query(qa_pairs: List[Tuple[str, str]]) -> List[str]:
+    """Jawaban siswa selalu dipakai; pertanyaan hanya bila jawabannya bukan penyangkalan
+    (mis. 'Apakah ada mimisan?' -> 'tidak' tidak boleh menarik pedoman perdarahan)."""
+    terms: List[str] = []
+    for q, a in qa_pairs:
+        if not is_negative_answer(a):
+            terms += _index_terms(q)
+        terms += _index_terms(a)
+    return terms
+
+@traced("retrieve_guidelines")
+def retrieve_guidelines(qa_pairs: List[Tuple[str, str]], k: int = RESEARCH_TOP_K) -> str:
+    """Top-k potongan pedoman paling relevan dengan anamnesis, siap masuk prompt analisis."""
+    index = get_guideline_index()
+    hits = index.search(_guideline_query(qa_pairs), k)
+    parts = []
+    for _score, doc_id in hits:
+        p = index.passages[doc_id]
+        parts.append(f"Sumber: {p['source']}\n{p['title']}: {p['text']}")
+    return "\n\n".join(parts) or "Tidak ada pedoman yang relevan di indeks lokal."
+
+def research_for(qa_pairs: List[Tuple[str, str]]) -> str:
+    """Referensi untuk analisis sesuai RESEARCH_MODE."""
+    if RESEARCH_MODE == "online":
+        return fetch_research_summary()
+    return retrieve_guidelines(qa_pairs)
+
+def _analysis_request(bio: Dict[str, str], qa_pairs: List[Tuple[str, str]], research_summary: str,
+                      system_prompt: str) -> Tuple[List[Dict[str, str]], str]:
+    """Pesan untuk analisis akhir + materi tambahan kunci cache (biodata & riset)."""
+    biodata = (
+        f"Biodata:\n"
+        f"Nama: {bio.get('nama','-')}\n"
+        f"Usia: {bio.get('usia','-')}\n"
+        f"Kelas: {bio.get('kelas','-')}\n"
+        f"Jenis Kelamin: {bio.get('jenis_kelamin','-')}\n\n"
+    )
+    # Analisis akhir: semua giliran dikirim utuh selama muat; riset mengisi sisa budget.
+    budget = ANALYSIS_PROMPT_BUDGET - estimate_tokens(system_prompt) - estimate_tokens(biodata)
+    conversation = build_conversation_context(qa_pairs, int(budget * 0.6), recent_turns=len(qa_pairs))
+    research = compact_research(research_summary, budget - estimate_tokens(conversation))
     messages = [
-        {
-            "role": "system",
-            "content": (
-                "Kamu adalah Dokter Spesialis lulusan FK UI dan S2 Johns Hopkins. "
-                "Lakukan analisis berbasis bukti dan buat diagnosis diferensial dari anamnesis. "
-                "Susun output dengan heading tebal: "
-                "(1) Ringkasan Gejala, (2) Kemungkinan Diagnosis (dengan alasan), "
-                "(3) Rencana Tindak Lanjut & Saran (spesifik), (4) Edukasi Pencegahan. "
-                "Hindari kepastian absolut; tandai red flag bila ada."
-            ),
-        },
+        {"role": "system", "content": system_prompt},
         {
             "role": "user",
             "content": (
-                f"Biodata:\n"
-                f"Nama: {bio.get('nama','-')}\n"
-                f"Usia: {bio.get('usia','-')}\n"
-                f"Kelas: {bio.get('kelas','-')}\n"
-                f"Jenis Kelamin: {bio.get('jenis_kelamin','-')}\n\n"
-                f"Percakapan Q/A:\n" + "\n".join([f"Q: {q}\nA: {a}" for q, a in qa_pairs]) +
-                f"\n\nRingkasan riset (opsional):\n{research_summary}\n"
+                biodata
+                + "Percakapan Q/A:\n" + conversation
+                + f"\n\nRingkasan riset (opsional):\n{research}\n"
                 "\nBerikan analisis sesuai format."
             ),
         },
     ]
-    resp = openai_client.chat.completions.create(model=OPENAI_MODEL, messages=messages)
-    return (resp.choices[0].message.content or "").strip()
+    # Biodata & riset ikut menentukan hasil, jadi ikut masuk kunci cache
+    return messages, biodata + research
+
+def analyze_health(bio: Dict[str, str], qa_pairs: List[Tuple[str, str]], research_summary: str,
+                   stream_to: Any = None) -> str:
+    messages, extra = _analysis_request(bio, qa_pairs, research_summary, ANALYSIS_SYSTEM_PROMPT)
+    cache_key = llm_cache_key("analyze_health", ANALYSIS_SYSTEM_PROMPT, qa_pairs, extra=extra)
+    return _chat_completion(messages, "analyze_health", stream_to, cache_key, deadline_s=ANALYSIS_DEADLINE_S)
+
+def analyze_health_structured(bio: Dict[str, str], qa_pairs: List[Tuple[str, str]],
+                              research_summary: str) -> StructuredAnalysis:
+    """Analisis sebagai JSON tervalidasi ANALYSIS_SCHEMA; ValueError bila respons tidak valid."""
+    messages, extra = _analysis_request(bio, qa_pairs, research_summary, ANALYSIS_JSON_SYSTEM_PROMPT)
+    cache_key = llm_cache_key("analyze_health", ANALYSIS_JSON_SYSTEM_PROMPT, qa_pairs, extra=extra)
+    response_format = {"type": "json_schema",
+                       "json_schema": {"name": "analisis_kesehatan", "strict": True, "schema": ANALYSIS_SCHEMA}}
+    text = _chat_completion(messages, "analyze_health", cache_key=cache_key, response_format=response_format,
+                            deadline_s=ANALYSIS_DEADLINE_S)
+    try:
+        return StructuredAnalysis.from_json(text)
+    except ValueError:
+        if cache_key is not None:
+            llm_cache_drop(cache_key)
+        raise
+
+def run_analysis(bio: Dict[str, str], qa_pairs: List[Tuple[str, str]], research_summary: str,
+                 stream_to: Any = None) -> Tuple[str, StructuredAnalysis | None]:
+    """Analisis akhir sesuai ANALYSIS_FORMAT: (markdown untuk ditampilkan, hasil terstruktur atau None).
+
+    Mode JSON tidak di-stream; bila respons tidak lolos skema, dipanggil ulang dalam mode markdown
+    dan hilir kembali memakai parser regex.
+    """
+    if ANALYSIS_FORMAT == "json":
+        try:
+            structured = analyze_health_structured(bio, qa_pairs, research_summary)
+            return structured.to_markdown(), structured
+        except ValueError as e:
+            trace_event("analysis_schema_invalid", error=str(e)[:200])
+    return analyze_health(bio, qa_pairs, research_summary, stream_to), None
+
+
+# ===============================================================
+# Prefetch Tahap Akhir
+# ===============================================================
+@st.cache_resource(show_spinner=False)
+def _get_prefetch_pool() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="prefetch")
+
+def _prepare_final_stage(session_id: str) -> str | None:
+    """Dijalankan di background beberapa giliran sebelum akhir: ambil riset & panaskan resource.
+    Mode lokal cukup membuka indeks; pencarian butuh jawaban terakhir, jadi dilakukan di giliran akhir."""
+    _get_otc_engine()
+    if not MISSING_SENDGRID:
+        _get_delivery_wake()
+        get_sendgrid_client(SENDGRID_API_KEY, SENDGRID_HOST)
+    if RESEARCH_MODE == "online":
+        return fetch_research_summary(session_id=session_id)
+    get_guideline_index()
+    return None
+
+def maybe_prefetch_final_stage(question_count: int, max_questions: int) -> None:
+    """Mulai persiapan tahap akhir sekali per sesi, saat wawancara tinggal PREFETCH_AHEAD giliran
+    (dihitung dari giliran paling awal wawancara bisa berakhir)."""
+    sess = get_session()
+    earliest = min(max_questions, INTERVIEW_MIN_QUESTIONS) if ADAPTIVE_INTERVIEW else max_questions
+    if sess.final_prefetch is None and question_count >= earliest - PREFETCH_AHEAD:
+        sess.final_prefetch = _get_prefetch_pool().submit(_prepare_final_stage, sess.session_id)
+
+def take_research_summary(qa_pairs: List[Tuple[str, str]]) -> str:
+    """Pakai hasil prefetch bila ada; jika belum/ gagal, ambil langsung seperti biasa."""
+    sess = get_session()
+    fut, sess.final_prefetch = sess.final_prefetch, None
+    if fut is not None:
+        try:
+            summary = fut.result(timeout=RESEARCH_DEADLINE_S + 1)
+            if summary is not None:
+                return summary
+        except Exception:
+            pass
+    return research_for(qa_pairs)
+
+
+# ===============================================================
+# Outbox Pengiriman (Email/SMS) – SQLite + worker background
+# ===============================================================
+def _outbox_path() -> str:
+    return os.path.join(CACHE_DIR, "outbox.sqlite3")
+
+def _outbox_conn() -> sqlite3.Connection:
+    conn = sqlite3.connect(_outbox_path(), timeout=10, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def _outbox_init() -> None:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    with closing(_outbox_conn()) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS outbox (
+                id              INTEGER PRIMARY KEY AUTOINCREMENT,
+                dedupe_key      TEXT NOT NULL UNIQUE,
+                session_id      TEXT NOT NULL,
+                channel         TEXT NOT NULL,          -- 'email' | 'sms'
+                payload         TEXT NOT NULL,          -- JSON
+                status          TEXT NOT NULL,          -- pending | sending | sent | failed
+                attempts        INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL,
+                last_error      TEXT,
+                result          TEXT,
+                created_at      REAL NOT NULL,
+                updated_at      REAL NOT NULL
+            )
+            """
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_outbox_due ON outbox(status, next_attempt_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS ix_outbox_session ON outbox(session_id)")
+
+def _deliver(channel: str, payload: Dict[str, str]) -> str:
+    if channel == "email":
+        send_email_via_sendgrid(payload["to"], payload["subject"], payload["html"], payload["text"])
+        return ""
+    if channel == "sms":
+        return send_sms_via_twilio(payload["body"], payload["to"])
+    raise RuntimeError(f"Channel tidak dikenal: {channel}")
+
+def _outbox_claim(conn: sqlite3.Connection) -> sqlite3.Row | None:
+    """Ambil satu job jatuh tempo secara atomik (aman untuk banyak worker/proses).
+
+    Job 'sending' diambil alih hanya bila tidak diperbarui selama DELIVERY_LEASE_S (proses pengirimnya
+    mati), bukan saat proses lain start: job yang sedang dikirim proses lain tidak terkirim dua kali."""
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        row = conn.execute(
+            "SELECT * FROM outbox WHERE (status='pending' AND next_attempt_at<=?) "
+            "OR (status='sending' AND updated_at<=?) ORDER BY id LIMIT 1",
+            (now, now - DELIVERY_LEASE_S),
+        ).fetchone()
+        if row is not None:
+            conn.execute("UPDATE outbox SET status='sending', updated_at=? WHERE id=?", (time.time(), row["id"]))
+        conn.execute("COMMIT")
+        return row
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+_DELIVERY_SPANS = {"email": "send_email_via_sendgrid", "sms": "send_sms_via_twilio"}
+
+def _outbox_update(conn: sqlite3.Connection, sql: str, args: Tuple[object, ...]) -> None:
+    """UPDATE status job; dicoba lagi bila DB terkunci agar job yang sudah terkirim tidak diambil alih lagi."""
+    for attempt in range(3):
+        try:
+            conn.execute(sql, args)
+            return
+        except sqlite3.Error:
+            if attempt == 2:
+                raise
+            time.sleep(1.0)
+
+def _mask_contact(to: str) -> str:
+    """Alamat tujuan yang disamarkan untuk status pengiriman: b***@contoh.com, +62812****789."""
+    if "@" in to:
+        name, domain = to.split("@", 1)
+        return f"{name[:1]}***@{domain}"
+    return f"{to[:6]}****{to[-3:]}" if len(to) > 9 else "****"
+
+def _outbox_run_one(conn: sqlite3.Connection, row: sqlite3.Row) -> None:
+    attempts = row["attempts"] + 1
+    span_name = _DELIVERY_SPANS.get(row["channel"], f"deliver_{row['channel']}")
+    payload = json.loads(row["payload"])
+    # Status akhir: isi pesan (analisis) & alamat lengkap tidak disimpan lagi, hanya alamat tersamar
+    spent = json.dumps({"to": _mask_contact(payload.get("to", ""))}, ensure_ascii=False)
+    try:
+        with trace_span(span_name, row["session_id"], attempt=attempts, retries=int(attempts > 1)):
+            result = _deliver(row["channel"], payload)
+    except Exception as e:
+        if attempts >= DELIVERY_MAX_ATTEMPTS:
+            status, next_at, kept = "failed", time.time(), spent
+        else:
+            # Backoff eksponensial + jitter: ~2s, 4s, 8s, ... (maks 5 menit)
+            status, next_at = "pending", time.time() + min(300.0, 2.0 ** attempts) * random.uniform(0.5, 1.5)
+            kept = row["payload"]
+        _outbox_update(
+            conn,
+            "UPDATE outbox SET status=?, attempts=?, next_attempt_at=?, last_error=?, payload=?, updated_at=? WHERE id=?",
+            (status, attempts, next_at, str(e)[:500], kept, time.time(), row["id"]),
+        )
+        return
+    _outbox_update(
+        conn,
+        "UPDATE outbox SET status='sent', attempts=?, result=?, last_error=NULL, payload=?, updated_at=? WHERE id=?",
+        (attempts, result, spent, time.time(), row["id"]),
+    )
+
+def _outbox_worker(wake: threading.Event) -> None:
+    conn = _outbox_conn()
+    while True:
+        row = None
+        try:
+            row = _outbox_claim(conn)
+            if row is not None:
+                _outbox_run_one(conn, row)
+                continue
+        except sqlite3.Error as e:
+            # Worker tetap hidup; job yang statusnya gagal ditulis diambil alih lagi setelah DELIVERY_LEASE_S
+            trace_event("outbox_error", row["session_id"] if row is not None else None, outcome="error",
+                        error=f"{type(e).__name__}: {e}"[:300])
+        wake.wait(timeout=1.0)
+        wake.clear()
+
+@st.cache_resource(show_spinner=False)
+def _get_delivery_wake() -> threading.Event:
+    """Start worker pengiriman sekali per proses; Event dipakai untuk membangunkannya."""
+    _outbox_init()
+    wake = threading.Event()
+    for i in range(max(1, DELIVERY_WORKERS)):
+        threading.Thread(target=_outbox_worker, args=(wake,), name=f"outbox-{i}", daemon=True).start()
+    return wake
+
+def enqueue_delivery(session_id: str, channel: str, payload: Dict[str, str]) -> None:
+    """Masukkan job ke outbox. Satu job per (sesi, channel): submit ganda diabaikan."""
+    wake = _get_delivery_wake()
+    now = time.time()
+    with closing(_outbox_conn()) as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO outbox (dedupe_key, session_id, channel, payload, status, next_attempt_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, ?, 'pending', ?, ?, ?)",
+            (f"{session_id}:{channel}", session_id, channel, json.dumps(payload, ensure_ascii=False), now, now, now),
+        )
+    wake.set()
+
+def delivery_status(session_id: str) -> List[Dict[str, object]]:
+    with closing(_outbox_conn()) as conn:
+        rows = conn.execute(
+            "SELECT channel, payload, status, attempts, last_error, result FROM outbox WHERE session_id=? ORDER BY id",
+            (session_id,),
+        ).fetchall()
+    out = []
+    for r in rows:
+        item = dict(r)
+        item["to"] = json.loads(item.pop("payload")).get("to", "")
+        out.append(item)
+    return out
+
+
+# ===============================================================
+# Arsip Hasil Skrining (SQLite WAL) – penulis batch background
+# ===============================================================
+_RESULTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    id            INTEGER PRIMARY KEY,
+    session_id    TEXT NOT NULL UNIQUE,
+    created_at    REAL NOT NULL,
+    day           TEXT NOT NULL,          -- YYYY-MM-DD (waktu lokal server)
+    week          TEXT NOT NULL,          -- minggu ISO, YYYY-Www
+    kelas         TEXT NOT NULL,
+    nama          TEXT,
+    usia          TEXT,
+    jenis_kelamin TEXT,
+    source        TEXT NOT NULL,          -- 'ui' | 'batch'
+    analysis      TEXT NOT NULL,
+    otc           TEXT NOT NULL,          -- JSON: daftar saran OTC
+    transcript    TEXT                    -- JSON: pasangan [pertanyaan, jawaban] (bahan graf triase)
+);
+CREATE INDEX IF NOT EXISTS ix_results_day ON results(day);
+CREATE INDEX IF NOT EXISTS ix_results_kelas_day ON results(kelas, day);
+CREATE TABLE IF NOT EXISTS result_diagnoses (
+    diagnosis TEXT NOT NULL,              -- dinormalisasi: huruf kecil, tanpa keterangan dalam kurung
+    day       TEXT NOT NULL,
+    result_id INTEGER NOT NULL,
+    kelas     TEXT NOT NULL,
+    PRIMARY KEY (diagnosis, day, result_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_result_diagnoses_result ON result_diagnoses(result_id);
+-- Agregat dipelihara di transaksi yang sama dengan insert: rekap tidak pernah men-scan tabel hasil
+CREATE TABLE IF NOT EXISTS diagnosis_weekly (
+    week      TEXT NOT NULL,
+    kelas     TEXT NOT NULL,
+    diagnosis TEXT NOT NULL,
+    n         INTEGER NOT NULL,
+    PRIMARY KEY (week, kelas, diagnosis)
+) WITHOUT ROWID;
+"""
+_RESULT_COLUMNS = "r.id, r.session_id, r.created_at, r.day, r.kelas, r.nama, r.usia, r.jenis_kelamin, r.source, r.analysis, r.otc"
+
+def _results_conn() -> sqlite3.Connection:
+    conn = sqlite3.connect(RESULTS_DB, timeout=10, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA synchronous=NORMAL")
+    return conn
+
+@st.cache_resource(show_spinner=False)
+def _results_ready() -> bool:
+    os.makedirs(os.path.dirname(os.path.abspath(RESULTS_DB)), exist_ok=True)
+    with closing(_results_conn()) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(_RESULTS_SCHEMA)
+    return True
+
+def _week_key(day: date) -> str:
+    year, week, _ = day.isocalendar()
+    return f"{year}-W{week:02d}"
+
+def normalize_diagnosis(name: str) -> str:
+    return " ".join(_strip_parens(name).lower().split())[:120]
+
+def _results_write_batch(conn: sqlite3.Connection, rows: List[Dict[str, object]]) -> int:
+    """Tulis satu batch dalam SATU transaksi (satu fsync WAL). Sesi yang sudah ada dilewati."""
+    inserted = 0
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for r in rows:
+            d = date.fromtimestamp(float(r["created_at"]))
+            day, week, kelas = d.isoformat(), _week_key(d), str(r["kelas"])
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO results (session_id, created_at, day, week, kelas, nama, usia, jenis_kelamin,"
+                " source, analysis, otc, transcript) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (r["session_id"], r["created_at"], day, week, kelas, r["nama"], r["usia"], r["jenis_kelamin"],
+                 r["source"], r["analysis"], r["otc"], r.get("transcript")),
+            )
+            if not cur.rowcount:
+                continue
+            inserted += 1
+            diagnoses = list(dict.fromkeys(filter(None, map(normalize_diagnosis, r["diagnoses"]))))  # type: ignore[arg-type]
+            conn.executemany("INSERT OR IGNORE INTO result_diagnoses (diagnosis, day, result_id, kelas) VALUES (?, ?, ?, ?)",
+                             [(dx, day, cur.lastrowid, kelas) for dx in diagnoses])
+            conn.executemany("INSERT INTO diagnosis_weekly (week, kelas, diagnosis, n) VALUES (?, ?, ?, 1)"
+                             " ON CONFLICT(week, kelas, diagnosis) DO UPDATE SET n = n + 1",
+                             [(week, kelas, dx) for dx in diagnoses])
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return inserted
+
+@dataclass(slots=True)
+class _ResultsFlush:
+    """Permintaan flush di antrean arsip: `done` di-set setelah semua hasil sebelumnya tertulis atau dibuang."""
+    done: threading.Event = field(default_factory=threading.Event)
+    dropped: int = 0   # jumlah hasil yang dibuang proses ini sampai flush diproses
+
+def _results_writer(q: queue.Queue) -> None:
+    """Kumpulkan hasil selama RESULTS_FLUSH_S (atau sampai RESULTS_BATCH_MAX), lalu tulis sekaligus.
+    Item _ResultsFlush = permintaan flush: batch ditulis segera dan flush selesai sesudahnya."""
+    conn = _results_conn()
+    dropped = 0
+    while True:
+        batch = [q.get()]
+        deadline = time.monotonic() + RESULTS_FLUSH_S
+        while len(batch) < RESULTS_BATCH_MAX and not isinstance(batch[-1], _ResultsFlush):
+            try:
+                batch.append(q.get(timeout=max(0.0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        rows = [b for b in batch if isinstance(b, dict)]
+        retry: List[Dict[str, object]] = []
+        if rows:
+            with trace_span("results_write", rows=len(rows)) as span:
+                try:
+                    span["inserted"] = _results_write_batch(conn, rows)
+                except Exception as e:  # bukan hanya sqlite3.Error: thread penulis tidak boleh mati
+                    error = f"{type(e).__name__}: {e}"[:300]
+                    span.update(outcome="error", error=error)
+                    attempts = [dict(r, attempts=int(r.get("attempts", 0)) + 1) for r in rows]
+                    retry = [r for r in attempts if int(r["attempts"]) < 5]  # mis. DB terkunci lama
+                    lost = [r for r in attempts if int(r["attempts"]) >= 5]
+                    if lost:
+                        dropped += len(lost)
+                        trace_event("results_dropped", outcome="error", rows=len(lost), error=error,
+                                    sessions=[str(r["session_id"]) for r in lost][:20])
+            for r in retry:
+                q.put(r)
+            if retry:
+                time.sleep(1.0)
+        for b in batch:
+            if not isinstance(b, _ResultsFlush):
+                continue
+            if retry:
+                q.put(b)  # selesai setelah hasil yang dicoba lagi tertulis atau dibuang
+            else:
+                b.dropped = dropped
+                b.done.set()
+
+@st.cache_resource(show_spinner=False)
+def _get_results_queue() -> queue.Queue:
+    """Start penulis arsip sekali per proses."""
+    _results_ready()
+    q: queue.Queue = queue.Queue()
+    threading.Thread(target=_results_writer, args=(q,), name="results-writer", daemon=True).start()
+    return q
+
+def record_result(session_id: str, bio: Dict[str, str], analysis: str, diagnoses: List[str],
+                  otc_bullets: List[str], source: str = "ui", qa_pairs: List[Tuple[str, str]] | None = None) -> None:
+    """Masukkan hasil satu siswa ke antrean arsip (tidak menunggu disk). Biodata kontak tidak disimpan;
+    transkrip anamnesis (`qa_pairs`) disimpan sebagai bahan build_triage_graph.py."""
+    _get_results_queue().put({
+        "session_id": session_id,
+        "created_at": time.time(),
+        "kelas": bio.get("kelas") or "-",
+        "nama": bio.get("nama", ""),
+        "usia": bio.get("usia", ""),
+        "jenis_kelamin": bio.get("jenis_kelamin", ""),
+        "source": source,
+        "analysis": analysis,
+        "diagnoses": list(diagnoses),
+        "otc": json.dumps(list(otc_bullets), ensure_ascii=False),
+        "transcript": json.dumps([list(p) for p in qa_pairs], ensure_ascii=False) if qa_pairs else None,
+    })
+
+def flush_results(timeout_s: float = 10.0) -> bool:
+    """Tunggu sampai semua hasil yang sudah diantre tertulis (dipakai skrip batch sebelum keluar).
+    False bila waktu habis atau ada hasil proses ini yang dibuang (event trace `results_dropped`)."""
+    flush = _ResultsFlush()
+    _get_results_queue().put(flush)
+    return flush.done.wait(timeout_s) and flush.dropped == 0
+
+def diagnosis_summary(weeks: int = 8, kelas: str | None = None) -> List[Dict[str, object]]:
+    """Jumlah siswa per (minggu, kelas, diagnosis) untuk `weeks` minggu terakhir, dari tabel agregat."""
+    _results_ready()
+    since = _week_key(date.today() - timedelta(weeks=max(1, weeks) - 1))
+    sql, args = "SELECT week, kelas, diagnosis, n FROM diagnosis_weekly WHERE week >= ?", [since]
+    if kelas:
+        sql, args = sql + " AND kelas = ?", args + [kelas]
+    with closing(_results_conn()) as conn:
+        rows = conn.execute(sql + " ORDER BY week DESC, n DESC, kelas", args).fetchall()
+    return [dict(r) for r in rows]
+
+def known_diagnoses() -> List[str]:
+    _results_ready()
+    with closing(_results_conn()) as conn:
+        return [r[0] for r in conn.execute("SELECT DISTINCT diagnosis FROM diagnosis_weekly ORDER BY diagnosis")]
+
+def find_results(kelas: str | None = None, diagnosis: str | None = None, day_from: str | None = None,
+                 day_to: str | None = None, limit: int = 100) -> List[Dict[str, object]]:
+    """Hasil terbaru sesuai filter (tanggal YYYY-MM-DD, inklusif). Setiap filter memakai indeks."""
+    _results_ready()
+    args: List[object] = [day_from or "0000-00-00", day_to or "9999-99-99"]
+    if diagnosis:
+        sql = (f"SELECT {_RESULT_COLUMNS} FROM result_diagnoses d JOIN results r ON r.id = d.result_id"
+               " WHERE d.diagnosis = ? AND d.day BETWEEN ? AND ?")
+        args.insert(0, normalize_diagnosis(diagnosis))
+        if kelas:
+            sql, args = sql + " AND d.kelas = ?", args + [kelas]
+        sql += " ORDER BY d.day DESC, d.result_id DESC LIMIT ?"
+    else:
+        sql = f"SELECT {_RESULT_COLUMNS} FROM results r WHERE r.day BETWEEN ? AND ?"
+        if kelas:
+            sql, args = sql + " AND r.kelas = ?", args + [kelas]
+        sql += " ORDER BY r.day DESC, r.id DESC LIMIT ?"
+    with closing(_results_conn()) as conn:
+        rows = conn.execute(sql, args + [limit]).fetchall()
+        out = [dict(r, otc=json.loads(r["otc"])) for r in rows]
+        if out:
+            ids = [r["id"] for r in out]
+            dx: Dict[int, List[str]] = defaultdict(list)
+            for rid, name in conn.execute(
+                f"SELECT result_id, diagnosis FROM result_diagnoses WHERE result_id IN ({','.join('?' * len(ids))})", ids
+            ):
+                dx[rid].append(name)
+            for r in out:
+                r["diagnoses"] = dx.get(r["id"], [])
+    return out
+
+
+# ===============================================================
+# Hasil & Skrining Tanpa UI (dipakai juga oleh batch_screening.py)
+# ===============================================================
+def compose_result_messages(nama: str, analysis: str, otc_plan: Dict[str, object],
+                            structured: StructuredAnalysis | None = None) -> Dict[str, str]:
+    """Subjek, isi email (teks & HTML) dan teks SMS untuk hasil satu siswa."""
+    selected = structured.selected_text() if structured is not None else extract_selected_sections(analysis)
+    subject = f"Hasil FawAI Dokter Remaja - {nama}"
+
+    text_body = (
+        f"Halo {nama},\n\n"
+        "Berikut hasil analisis FawAI Dokter Remaja:\n\n"
+        f"{selected}\n\n"
+        "-----\n"
+        "Saran Obat OTC & Perawatan di Rumah\n"
+        + "\n".join(f"- {b}" for b in otc_plan["bullets"]) + "\n\n"
+        + "\n".join(f"- {s}" for s in otc_plan["safety"]) + "\n\n"
+        "Disclaimer: Ini bukan diagnosis resmi. Jika Anda mengalami tanda bahaya atau nyeri berat, segera cari pertolongan medis darurat."
+    )
+
+    html_body = (
+        f"<p>Halo <b>{nama}</b>,</p>"
+        f"<p>Berikut hasil analisis <b>FawAI Dokter Remaja</b>:</p>"
+        f"<div style='border:1px solid #eee;padding:12px;border-radius:8px;white-space:pre-wrap;font-family:system-ui,Segoe UI,Arial;'>"
+        f"{selected}</div>"
+        f"<div style='height:10px'></div>"
+        f"<div style='border:1px solid #eee;padding:12px;border-radius:8px;font-family:system-ui,Segoe UI,Arial;'>"
+        f"{otc_plan['html']}</div>"
+        "<p style='color:#666'><i>Disclaimer: Ini bukan diagnosis resmi. "
+        "Jika Anda mengalami tanda bahaya atau nyeri berat, segera cari pertolongan medis darurat.</i></p>"
+    )
+
+    sms_text = (
+        f"Halo {nama}, hasil FawAI Dokter Remaja sudah dikirim ke email Anda. "
+        f"Silakan cek inbox/SPAM dengan subjek: '{subject}'."
+    )
+    return {"subject": subject, "text": text_body, "html": html_body, "sms": sms_text}
+
+def screen_student(bio: Dict[str, str], qa_pairs: List[Tuple[str, str]], research_summary: str | None,
+                   session_id: str, deliver: bool = True, store: bool = True) -> Dict[str, object]:
+    """Alur tahap akhir tanpa UI: analisis -> diagnosis -> saran OTC -> arsip -> antre email/SMS.
+
+    `session_id` dipakai untuk trace & kunci dedupe outbox, jadi menjalankan ulang
+    siswa yang sama tidak mengirim email/SMS dua kali. Aman dipanggil dari banyak thread.
+    """
+    token = _TRACE_SESSION.set(session_id)
+    try:
+        with trace_span("screen_student", session_id):
+            if research_summary is None:
+                research_summary = research_for(qa_pairs)
+            analysis, structured = run_analysis(bio, qa_pairs, research_summary)
+            last_answer = qa_pairs[-1][1] if qa_pairs else ""
+            diagnoses, otc_plan = otc_from_analysis(analysis, structured, bio.get("usia", "15"), last_answer)
+            nama = bio.get("nama") or "Siswa"
+            msg = compose_result_messages(nama, analysis, otc_plan, structured)
+            if store:
+                record_result(session_id, bio, analysis, diagnoses, otc_plan["bullets"], source="batch",
+                              qa_pairs=qa_pairs)
+
+            delivery: Dict[str, str] = {}
+            to_email = (bio.get("email") or "").strip()
+            if not deliver:
+                delivery["email"] = delivery["sms"] = "dilewati"
+            else:
+                if not to_email:
+                    delivery["email"] = "tidak ada email"
+                elif MISSING_SENDGRID:
+                    delivery["email"] = "kredensial SendGrid belum disetel"
+                else:
+                    enqueue_delivery(session_id, "email",
+                                     {"to": to_email, "subject": msg["subject"], "html": msg["html"], "text": msg["text"]})
+                    delivery["email"] = "antre"
+                to_num = normalize_msisdn(bio.get("nohp", ""))
+                if not to_num:
+                    delivery["sms"] = "tidak ada nomor HP"
+                elif not (TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN and TWILIO_FROM):
+                    delivery["sms"] = "kredensial Twilio belum lengkap"
+                else:
+                    enqueue_delivery(session_id, "sms", {"to": to_num, "body": msg["sms"]})
+                    delivery["sms"] = "antre"
+    finally:
+        _TRACE_SESSION.reset(token)
+    return {
+        "analysis": analysis,
+        "analysis_json": asdict(structured) if structured is not None else None,
+        "diagnoses": diagnoses,
+        "otc_bullets": otc_plan["bullets"],
+        "delivery": delivery,
+    }
 
 
 # ===============================================================
@@ -361,40 +2847,67 @@ def _render_header() -> None:
     st.markdown(f"<p style='text-align: center;'>{APP_DESC}</p>", unsafe_allow_html=True)
     st.divider()
 
+_CONTACT_LABELS = {"email": "Email", "nohp": "Nomor HP"}
+
+def _contact_form() -> None:
+    """Sesi yang dilanjutkan setelah restart/di proses lain tidak membawa email & no. HP (tidak pernah
+    disimpan): minta diisi lagi sebelum hasil dikirim. Dikosongkan = tidak dikirim."""
+    sess = get_session()
+    placeholder = st.empty()
+    with placeholder.container():
+        with st.form("contact_form"):
+            fields = " & ".join(_CONTACT_LABELS[k] for k in sess.contact_lost)
+            st.markdown(f"**{fields} yang Anda isi tadi tidak ikut tersimpan (demi privasi).** "
+                        "Isi lagi agar hasil bisa dikirim, atau kosongkan untuk melewati.")
+            values = {k: st.text_input(_CONTACT_LABELS[k], key=f"contact_{k}") for k in sess.contact_lost}
+            submit = st.form_submit_button("Simpan kontak")
+    if submit:
+        email, nohp = values.get("email", "").strip(), values.get("nohp", "").strip()
+        if "email" in values:
+            sess.bio["email"] = email
+        if "nohp" in values:
+            sess.bio["nohp"] = normalize_msisdn(nohp) if nohp else ""
+        if email and not is_valid_email(email):
+            st.warning("Format email kurang tepat. Pengiriman email mungkin gagal.")
+        sess.contact_lost = []
+        placeholder.empty()
+        st.rerun()
+
 def _bio_form() -> None:
     """Form biodata yang menghilang setelah tombol 'Lanjut' ditekan."""
+    sess = get_session()
     placeholder = st.empty()
     with placeholder.container():
         st.markdown("**Isi biodata singkat:**")
         with st.form("bio_form", clear_on_submit=False):
             nama = st.text_input("Nama (opsional)",
-                                 value=st.session_state.bio_data.get("nama", ""))
+                                 value=sess.bio.get("nama", ""))
             try:
-                usia_default = int(st.session_state.bio_data.get("usia", 13))
+                usia_default = int(sess.bio.get("usia", 13))
             except Exception:
                 usia_default = 13
             usia = st.number_input("Usia (tahun)", min_value=7, max_value=20, step=1, value=usia_default)
 
-            kelas_current = str(st.session_state.bio_data.get("kelas", "7"))
+            kelas_current = str(sess.bio.get("kelas", "7"))
             kelas = st.selectbox("Kelas", options=["7", "8", "9"],
                                  index=["7", "8", "9"].index(kelas_current) if kelas_current in ["7", "8", "9"] else 0)
 
             jk = st.selectbox("Jenis Kelamin", options=["Laki-Laki", "Perempuan"],
-                              index=0 if st.session_state.bio_data.get("jenis_kelamin", "L") == "L" else 1)
+                              index=0 if sess.bio.get("jenis_kelamin", "L") == "L" else 1)
 
             email = st.text_input("Email (untuk menerima hasil lengkap via email)",
                                   placeholder="nama@sekolah.sch.id",
-                                  value=st.session_state.bio_data.get("email", ""))
+                                  value=sess.bio.get("email", ""))
 
             nohp = st.text_input("Nomor HP (untuk menerima SMS notifikasi)",
                                  placeholder="+62812xxxxxxx",
-                                 value=st.session_state.bio_data.get("nohp", ""))
+                                 value=sess.bio.get("nohp", ""))
 
             submit = st.form_submit_button("Lanjut")
 
     if submit:
         norm = normalize_msisdn(nohp) if nohp else ""
-        st.session_state.bio_data.update({
+        sess.bio.update({
             "nama": nama.strip(),
             "usia": str(usia),
             "kelas": str(kelas),
@@ -405,147 +2918,278 @@ def _bio_form() -> None:
         if email and not is_valid_email(email):
             st.warning("Format email kurang tepat. Anda tetap bisa lanjut, tetapi pengiriman email mungkin gagal.")
 
-        st.session_state.step = "chat"
-        if not st.session_state.first_question_sent:
-            q = "Bisa diceritakan dengan lengkap, Anda saat ini mengalami keluhan kesehatan apa?"
-            st.session_state.chat_log.append({"role": "assistant", "content": q})
-            st.session_state.first_question_sent = True
+        sess.step = "chat"
+        if not sess.texts:
+            sess.add(ROLE_ASSISTANT, "Bisa diceritakan dengan lengkap, Anda saat ini mengalami keluhan kesehatan apa?")
 
         placeholder.empty()
         st.rerun()
 
+def _render_message(role: int, text: str) -> None:
+    st.chat_message("assistant" if role == ROLE_ASSISTANT else "user").markdown(text)
+
 def _render_chat_history() -> None:
-    for msg in st.session_state.chat_log:
-        role = "assistant" if msg["role"] == "assistant" else "user"
-        st.chat_message(role).markdown(msg["content"])
+    """Riwayat lengkap, hanya saat rerun penuh; sesudahnya _chat_fragment menggambar pesan setelahnya saja.
+
+    Batasnya disimpan per browser (st.session_state), bukan di SessionData yang dibagi antar tab."""
+    sess = get_session()
+    for role, text in sess.messages():
+        _render_message(role, text)
+    st.session_state["fawai_chat_head"] = len(sess.texts)
+
+@st.fragment
+def _chat_fragment() -> None:
+    """Area chat yang rerun sendiri: mengirim jawaban hanya menjalankan fungsi ini (bukan seluruh skrip).
+
+    Yang dihemat adalah skrip di luar fragmen, bukan pesan: semua pesan sejak rerun penuh terakhir (biasanya
+    seluruh wawancara setelah biodata, paling banyak ~2 x max_questions) dikirim ulang setiap rerun fragmen,
+    karena Streamlit membuang elemen fragmen yang tidak dikirim lagi (~0,5 ms per pesan; lihat
+    `bench/bench_rerun.py --messages N`). Pesan berupa markdown polos yang digambar di browser, jadi tidak
+    ada hasil render di server yang bisa di-cache."""
+    with session_scope() as sess:
+        head = min(st.session_state.get("fawai_chat_head", 0), len(sess.texts))
+        for role, text in sess.messages(head):
+            _render_message(role, text)
+        _handle_chat_flow()
+    if sess.step == "done":
+        _render_delivery_status()
+
+_DELIVERY_FINAL = ("sent", "failed")
+
+def _delivery_items() -> List[Dict[str, object]] | None:
+    try:
+        return delivery_status(get_session().session_id)
+    except sqlite3.Error:
+        return None
+
+def _render_delivery_status() -> None:
+    """Status email/SMS dari outbox. Selama masih ada job yang belum terkirim/gagal, status di-refresh
+    sendiri oleh _poll_delivery_status; sesudahnya digambar sekali tanpa polling."""
+    items = _delivery_items()
+    if items is None or any(it["status"] not in _DELIVERY_FINAL for it in items):
+        _poll_delivery_status()
+    else:
+        _draw_delivery_status(items)
+
+@st.fragment(run_every=2)
+def _poll_delivery_status() -> None:
+    items = _delivery_items()
+    if items is None:
+        return
+    _draw_delivery_status(items)
+    if all(it["status"] in _DELIVERY_FINAL for it in items):
+        st.rerun()  # rerun penuh sekali: _render_delivery_status tidak lagi memakai fragmen run_every
+
+def _draw_delivery_status(items: List[Dict[str, object]]) -> None:
+    for it in items:
+        label = "Email" if it["channel"] == "email" else "SMS notifikasi"
+        if it["status"] == "sent":
+            extra = f". SID: {it['result']}" if it["result"] else ""
+            st.success(f"{label} terkirim ke {it['to']}{extra}")
+        elif it["status"] == "failed":
+            st.warning(f"{label} tidak terkirim: {it['last_error']}")
+        elif it["attempts"]:
+            st.info(f"{label} ke {it['to']} gagal ({it['attempts']}×), mencoba lagi… ({it['last_error']})")
+        else:
+            st.info(f"{label} ke {it['to']} sedang dikirim…")
+
+@st.fragment(run_every=5)
+def _render_admin_panel() -> None:
+    """Panel admin (?admin=<ADMIN_TOKEN>): persentil bergulir per tahap di proses ini."""
+    tracer = get_tracer()
+    st.markdown("**Admin – latensi per tahap (jendela bergulir)**")
+    rows = tracer.summary()
+    if rows:
+        st.dataframe(rows, hide_index=True, use_container_width=True)
+    else:
+        st.caption("Belum ada span tercatat.")
+    st.caption(f"Cache respons model: {llm_cache_stats()}")
+    st.caption(f"Governor OpenAI: {get_openai_governor().snapshot()}")
+    st.caption(f"Sesi di memori: {session_memory_stats()}")
+    st.download_button("Unduh metrics (Prometheus)", tracer.prometheus(), file_name="fawai_metrics.prom")
+
+def _render_results_panel() -> None:
+    """Rekap & pencarian arsip hasil skrining untuk petugas UKS (di bawah panel admin)."""
+    st.markdown("**Rekap hasil skrining**")
+    kelas = st.selectbox("Kelas", ["Semua", "7", "8", "9"], key="results_kelas")
+    weeks = int(st.number_input("Minggu terakhir", min_value=1, max_value=53, value=4, key="results_weeks"))
+    kelas_filter = None if kelas == "Semua" else kelas
+    try:
+        summary = diagnosis_summary(weeks, kelas_filter)
+        diagnosis = st.selectbox("Diagnosis", ["(semua)"] + known_diagnoses(), key="results_dx")
+        rows = find_results(kelas_filter, None if diagnosis == "(semua)" else diagnosis,
+                            day_from=(date.today() - timedelta(weeks=weeks)).isoformat(), limit=200)
+    except sqlite3.Error as e:
+        st.caption(f"Arsip hasil tidak bisa dibaca: {e}")
+        return
+    if summary:
+        st.dataframe(summary, hide_index=True, use_container_width=True)
+    else:
+        st.caption("Belum ada hasil pada periode ini.")
+    st.dataframe([{"tanggal": r["day"], "kelas": r["kelas"], "nama": r["nama"], "diagnosis": ", ".join(r["diagnoses"])}
+                  for r in rows], hide_index=True, use_container_width=True)
+    st.download_button("Unduh hasil (JSON)", json.dumps(rows, ensure_ascii=False, indent=1),
+                       file_name="fawai_hasil.json", mime="application/json")
+
+def _trace_session_done() -> None:
+    """Satu span ringkasan per sesi: durasi total, jumlah giliran, token & biaya model."""
+    sess = get_session()
+    calls = sess.llm_calls
+    trace_event(
+        "session",
+        duration_s=time.time() - sess.started_at,
+        turns=sess.question_count,
+        llm_calls=len(calls),
+        cache_hits=sum(1 for c in calls if c.get("cache") == "hit"),
+        total_tokens=sum(int(c.get("prompt_tokens", 0)) + int(c.get("completion_tokens", 0)) for c in calls),
+        total_cost_usd=round(sum(float(c.get("cost_usd", 0.0)) for c in calls), 6),
+    )
 
 def _handle_chat_flow() -> None:
-    user_input = st.chat_input("Jawaban Anda...") if st.session_state.step in ("chat", "done") else None
-    if not (user_input and st.session_state.step == "chat"):
+    sess = get_session()
+    if sess.step == "analyze":  # analisis sebelumnya gagal (model tidak tersedia): tawarkan ulang
+        if st.button("Coba buat analisis lagi", type="primary", key="retry_analysis"):
+            _finish_interview(sess, None)
+        return
+    user_input = None
+    if sess.step in ("chat", "done"):
+        with st.bottom:  # tetap menempel di bawah walau dipanggil dari dalam fragment
+            user_input = st.chat_input("Jawaban Anda...")
+    if not (user_input and sess.step == "chat"):
+        return
+    if st.session_state.get("fawai_seen_version", sess.version) != sess.version:
+        # Tab/perangkat lain menyimpan giliran baru sejak halaman ini digambar; pesan terbarunya sudah tampil di atas
+        st.warning("Percakapan ini sudah dilanjutkan di tab/perangkat lain. Jawaban barusan tidak dipakai; "
+                   "silakan jawab pertanyaan terakhir.")
         return
 
     # Tampilkan & simpan jawaban user
     st.chat_message("user").markdown(user_input)
-    st.session_state.chat_log.append({"role": "user", "content": user_input})
-
-    # Ambil pertanyaan asisten terakhir (sebelum jawaban user)
-    last_q = next(
-        (m["content"] for m in reversed(st.session_state.chat_log[:-1]) if m["role"] == "assistant"),
-        "(pertanyaan awal)",
-    )
-    st.session_state.qa_pairs.append((last_q, user_input))
-    st.session_state.question_count += 1
-
-    # Jika sudah mencapai batas pertanyaan, lakukan analisis final
-    if st.session_state.question_count >= st.session_state.max_questions:
-        with st.spinner("Mengambil referensi riset..."):
-            research_summary = fetch_research_summary()
-
-        with st.spinner("Menganalisis jawaban Anda berdasarkan riset..."):
-            result = analyze_health(st.session_state.bio_data, st.session_state.qa_pairs, research_summary)
-
-        # ======== HASIL BAGIAN 1: Analisis ========
-        st.session_state.final_analysis = result
-        st.chat_message("assistant").markdown("*Hasil analisis masalah kesehatan Anda:*")
-        st.chat_message("assistant").markdown(result)
-        st.session_state.chat_log.append({"role": "assistant", "content": result})
-        st.session_state.step = "done"
-
-        # ======== HASIL BAGIAN 2: Saran Obat OTC ========
-        diag_list = _extract_diagnoses_from_analysis(result)
-        last_answer = st.session_state.qa_pairs[-1][1] if st.session_state.qa_pairs else ""
-        otc_plan = suggest_otc_plan(diag_list, st.session_state.bio_data.get("usia", "15"), context_hint=(result + " " + last_answer))
-
-        st.chat_message("assistant").markdown(otc_plan["md"])
-        st.session_state.chat_log.append({"role": "assistant", "content": otc_plan["md"]})
-
-        # ====== Siapkan konten email ======
-        nama = st.session_state.bio_data.get("nama", "Siswa")
-        selected = extract_selected_sections(result)
-        subject = f"Hasil FawAI Dokter Remaja - {nama}"
-
-        text_body = (
-            f"Halo {nama},\n\n"
-            "Berikut hasil analisis FawAI Dokter Remaja:\n\n"
-            f"{selected}\n\n"
-            "-----\n"
-            "Saran Obat OTC & Perawatan di Rumah\n"
-            + "\n".join(f"- {b}" for b in otc_plan["bullets"]) + "\n\n"
-            + "\n".join(f"- {s}" for s in otc_plan["safety"]) + "\n\n"
-            "Disclaimer: Ini bukan diagnosis resmi. Jika Anda mengalami tanda bahaya atau nyeri berat, segera cari pertolongan medis darurat."
-        )
-
-        html_body = (
-            f"<p>Halo <b>{nama}</b>,</p>"
-            f"<p>Berikut hasil analisis <b>FawAI Dokter Remaja</b>:</p>"
-            f"<div style='border:1px solid #eee;padding:12px;border-radius:8px;white-space:pre-wrap;font-family:system-ui,Segoe UI,Arial;'>"
-            f"{selected}</div>"
-            f"<div style='height:10px'></div>"
-            f"<div style='border:1px solid #eee;padding:12px;border-radius:8px;font-family:system-ui,Segoe UI,Arial;'>"
-            f"{otc_plan['html']}</div>"
-            "<p style='color:#666'><i>Disclaimer: Ini bukan diagnosis resmi. "
-            "Jika Anda mengalami tanda bahaya atau nyeri berat, segera cari pertolongan medis darurat.</i></p>"
-        )
-
-        # ====== Kirim Email via SendGrid ======
-        to_email = (st.session_state.bio_data.get("email") or "").strip()
-        if to_email:
-            if MISSING_SENDGRID:
-                st.warning("Email tidak terkirim: kredensial SendGrid belum disetel (SENDGRID_API_KEY/EMAIL_FROM).")
-            else:
-                try:
-                    send_email_via_sendgrid(to_email, subject, html_body, text_body)
-                    st.success(f"Email terkirim ke {to_email}")
-                except Exception as e:
-                    st.warning(f"Email tidak terkirim: {e}")
+    sess.add(ROLE_USER, user_input)  # pasangan Q/A diturunkan dari urutan pesan
+    if not commit_session(sess):  # giliran ini sudah dijawab di tab/proses lain: tampilkan keadaan terbaru
+        st.rerun()
+    qa_pairs = sess.qa_pairs
+    maybe_prefetch_final_stage(len(qa_pairs), sess.max_questions)
+
+    # Lanjutkan anamnesis sampai batas pertanyaan, kecuali model menilai informasi sudah cukup / ada red flag
+    status = None
+    if len(qa_pairs) < sess.max_questions:
+        if ADAPTIVE_INTERVIEW:
+            status = InterviewStatus(allow_ready=len(qa_pairs) >= INTERVIEW_MIN_QUESTIONS)
+        slot = st.empty()
+        if STREAM_OUTPUT:
+            next_q = generate_next_question(qa_pairs, stream_to=slot.container().chat_message("assistant"),
+                                            status=status)
         else:
-            st.info("Email tidak diisi, jadi hasil lengkap tidak dikirim via email.")
-
-        # ====== Kirim SMS notifikasi singkat (opsional) ======
-        to_num = normalize_msisdn(st.session_state.bio_data.get("nohp", ""))
-        if to_num:
-            if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN and TWILIO_FROM:
-                sms_text = (
-                    f"Halo {nama}, hasil FawAI Dokter Remaja sudah dikirim ke email Anda. "
-                    f"Silakan cek inbox/SPAM dengan subjek: '{subject}'."
-                )
-                try:
-                    sid = send_sms_via_twilio(sms_text, to_num)
-                    st.success(f"SMS notifikasi terkirim ke {to_num}. SID: {sid}")
-                except Exception as e:
-                    st.warning(f"SMS tidak terkirim: {e}")
-            else:
-                st.info("Kredensial Twilio belum lengkap, SMS tidak dikirim.")
+            with st.spinner("Mempersiapkan pertanyaan selanjutnya..."):
+                next_q = generate_next_question(qa_pairs, status=status)
+        if status is None or not status.stop:
+            # Gambar ulang pertanyaan final: menimpa stream parsial bila dipakai pertanyaan cadangan
+            slot.container().chat_message("assistant").markdown(next_q)
+            sess.add(ROLE_ASSISTANT, next_q)
+            return
+        slot.empty()
+        trace_event("interview_early_stop", turns=len(qa_pairs), confidence=status.confidence,
+                    red_flag=status.red_flag)
+    _finish_interview(sess, status)
+    if sess.step == "analyze":  # gagal pada percobaan pertama; klik = rerun fragment -> cabang 'analyze' di atas
+        st.button("Coba buat analisis lagi", type="primary", key="retry_analysis")
+
+def _finish_interview(sess: SessionData, status: InterviewStatus | None) -> None:
+    """Tahap akhir: referensi -> analisis -> saran OTC -> arsip -> email/SMS."""
+    qa_pairs = sess.qa_pairs
+    if status is not None and status.red_flag:
+        st.error("Jawaban Anda menunjukkan tanda bahaya. Segera hubungi guru UKS, orang tua, "
+                 "atau fasilitas kesehatan terdekat.")
+    with st.spinner("Mengambil referensi riset..."):
+        research_summary = take_research_summary(qa_pairs)
+
+    # ======== HASIL BAGIAN 1: Analisis ========
+    slot = st.empty()
+    box = slot.container().chat_message("assistant")
+    box.markdown("*Hasil analisis masalah kesehatan Anda:*")
+    try:
+        if STREAM_OUTPUT and ANALYSIS_FORMAT != "json":
+            result, structured = run_analysis(sess.bio, qa_pairs, research_summary, stream_to=box)
         else:
-            st.info("Nomor HP tidak diisi, jadi tidak ada SMS notifikasi yang dikirim.")
+            with st.spinner("Menganalisis jawaban Anda berdasarkan riset..."):
+                result, structured = run_analysis(sess.bio, qa_pairs, research_summary)
+            box.markdown(result)
+    except (LLMUnavailable, openai.APIError) as e:
+        slot.empty()
+        sess.step = "analyze"
+        st.error(f"Analisis belum bisa dibuat: {e}")  # tombol ulang digambar oleh _handle_chat_flow
         return
-
-    # Lanjutkan anamnesis
-    with st.spinner("Mempersiapkan pertanyaan selanjutnya..."):
-        next_q = generate_next_question(st.session_state.qa_pairs)
-    st.chat_message("assistant").markdown(next_q)
-    st.session_state.chat_log.append({"role": "assistant", "content": next_q})
+    sess.final_index = sess.add(ROLE_ASSISTANT, result)
+    sess.step = "done"
+
+    # ======== HASIL BAGIAN 2: Saran Obat OTC ========
+    diagnoses, otc_plan = otc_from_analysis(result, structured, sess.bio.get("usia", "15"), qa_pairs[-1][1])
+
+    st.chat_message("assistant").markdown(otc_plan["md"])
+    sess.add(ROLE_ASSISTANT, otc_plan["md"])
+    record_result(sess.session_id, sess.bio, result, diagnoses, otc_plan["bullets"], source="ui", qa_pairs=qa_pairs)
+
+    # ====== Siapkan konten email ======
+    nama = sess.bio.get("nama", "Siswa")
+    msg = compose_result_messages(nama, result, otc_plan, structured)
+
+    # ====== Kirim Email via SendGrid (background, lewat outbox) ======
+    session_id = sess.session_id
+    to_email = (sess.bio.get("email") or "").strip()
+    if to_email:
+        if MISSING_SENDGRID:
+            st.warning("Email tidak terkirim: kredensial SendGrid belum disetel (SENDGRID_API_KEY/EMAIL_FROM).")
+        else:
+            enqueue_delivery(session_id, "email",
+                             {"to": to_email, "subject": msg["subject"], "html": msg["html"], "text": msg["text"]})
+    elif "email" in sess.contact_lost:
+        st.warning("Email yang Anda isi tidak ikut tersimpan saat sesi dilanjutkan (demi privasi), "
+                   "jadi hasil lengkap tidak dikirim via email.")
+    else:
+        st.info("Email tidak diisi, jadi hasil lengkap tidak dikirim via email.")
+
+    # ====== Kirim SMS notifikasi singkat (opsional) ======
+    to_num = normalize_msisdn(sess.bio.get("nohp", ""))
+    if to_num:
+        if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN and TWILIO_FROM:
+            enqueue_delivery(session_id, "sms", {"to": to_num, "body": msg["sms"]})
+        else:
+            st.info("Kredensial Twilio belum lengkap, SMS tidak dikirim.")
+    elif "nohp" in sess.contact_lost:
+        st.warning("Nomor HP yang Anda isi tidak ikut tersimpan saat sesi dilanjutkan (demi privasi), "
+                   "jadi tidak ada SMS notifikasi yang dikirim.")
+    else:
+        st.info("Nomor HP tidak diisi, jadi tidak ada SMS notifikasi yang dikirim.")
+    _trace_session_done()
 
 
 def main() -> None:
-    _init_state()
-    _render_header()
-
-    # UI Biodata (sekali tampil – hilang setelah 'Lanjut')
-    if st.session_state.step == "bio":
-        _bio_form()
-
-    # Tampilkan chat yang sudah ada
-    _render_chat_history()
-
-    # Alur chat
-    _handle_chat_flow()
-
-    # Disclaimer global
-    st.info(
-        "Disclaimer: Ini bukan diagnosis resmi. Jika Anda mengalami tanda bahaya atau nyeri berat, "
-        "segera cari pertolongan medis darurat."
-    )
+    with session_scope() as sess:
+        _render_header()
+        if ADMIN_TOKEN and hmac.compare_digest(str(st.query_params.get("admin", "")), ADMIN_TOKEN):
+            with st.sidebar:
+                _render_admin_panel()
+                _render_results_panel()
+
+        # UI Biodata (sekali tampil – hilang setelah 'Lanjut')
+        if sess.step == "bio":
+            _bio_form()
+        elif sess.contact_lost and sess.step in ("chat", "analyze"):
+            _contact_form()
+
+        # Tampilkan chat yang sudah ada, lalu alur chat (fragment: jawaban berikutnya tidak rerun seluruh halaman)
+        _render_chat_history()
+        _chat_fragment()
+
+        if sess.step != "bio":
+            st.button("Mulai sesi baru (siswa lain)", key="new_session", on_click=start_new_session)
+
+        # Disclaimer global
+        st.info(
+            "Disclaimer: Ini bukan diagnosis resmi. Jika Anda mengalami tanda bahaya atau nyeri berat, "
+            "segera cari pertolongan medis darurat."
+        )
 
 
 if __name__ == "__main__":